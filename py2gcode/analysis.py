@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+from collections import deque
+
+import numpy
+
+from py2gcode.toolpath import ToolpathProcessor, BLOCK_DTYPE, MOTION_CODES, segment_lengths
+
+LENGTH_BINS = (0, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, numpy.inf)
+DURATION_BINS = (0, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5, numpy.inf)
+
+
+class BufferAnalyzer():
+    """
+        Predict where the planner buffer of the firmware drains because the serial link can not send the codes as
+        fast as the moves are executed (stutter on short segments).
+        Each line is sent in bytes * bits_per_byte / baud seconds plus the latency of its acknowledgement, a move
+        can only be received when one of the buffer_size moves before it has finished and the machine waits
+        (stall) when the next move has not arrived yet. Accelerations are not simulated so the moves take
+        length / feed rate
+    """
+
+    def __init__(self, baud=115200, buffer_size=16, latency=0.0, bits_per_byte=10, newline='\n', checksum=False,
+                 default_feed=1000.0, max_hotspots=10, length_bins=LENGTH_BINS, duration_bins=DURATION_BINS):
+        """
+            :param baud: Bits per second of the link
+            :param buffer_size: Number of moves of the planner buffer of the firmware
+            :param latency: Seconds lost for each line (acknowledgement round trip)
+            :param bits_per_byte: Bits sent for each byte, 10 for 8N1
+            :param newline: End of line sent after each code
+            :param checksum: Boolean for lines sent with line number and checksum (N123 G1 X1*45)
+            :param default_feed: Feed rate in mm/min while the file has not set one
+            :param max_hotspots: Number of hotspots reported
+            :param length_bins: Edges in mm of the segment length histogram
+            :param duration_bins: Edges in seconds of the segment duration histogram
+        """
+        self.baud = baud
+        self.buffer_size = buffer_size
+        self.latency = latency
+        self.bits_per_byte = bits_per_byte
+        self.newline = newline
+        self.checksum = checksum
+        self.default_feed = default_feed
+        self.max_hotspots = max_hotspots
+        self.length_bins = numpy.asarray(length_bins, dtype=numpy.float64)
+        self.duration_bins = numpy.asarray(duration_bins, dtype=numpy.float64)
+
+    def send_times(self, blocks, codes):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :param codes: Dict {line: code} with the codes sent, ej: ToolpathProcessor.codes
+            :return: Array with the seconds needed to send each block
+        """
+        lines = blocks['line']
+        size = numpy.array([len(codes.get(line, '')) for line in lines.tolist()], dtype=numpy.float64)
+        size += len(self.newline)
+        if self.checksum:
+            size += numpy.floor(numpy.log10(numpy.maximum(lines, 1))) + 1 + 2 + 4
+        return size * self.bits_per_byte / float(self.baud) + self.latency
+
+    def moves(self, blocks, codes, pending=0.0):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :param codes: Dict {line: code} with the codes sent
+            :param pending: Seconds to send the codes after the last move of the previous blocks
+            :return: Tuple (dict with the arrays line, length, duration and send of the moves, pending seconds)
+            the lines without motion are sent with the next move
+        """
+        send = self.send_times(blocks, codes)
+        lengths = segment_lengths(blocks)
+        moving = numpy.isin(blocks['code'], MOTION_CODES) & (lengths > 0)
+        count = int(moving.sum())
+        group = numpy.cumsum(moving) - moving
+        sent = group < count
+        per_move = numpy.bincount(group[sent], weights=send[sent], minlength=count)
+        if count:
+            per_move[0] += pending
+            pending = 0.0
+        pending += float(send[~sent].sum())
+        feed = numpy.where(numpy.isnan(blocks['f'][moving]), self.default_feed, blocks['f'][moving])
+        return {
+            'line': blocks['line'][moving],
+            'length': lengths[moving],
+            'duration': lengths[moving] / (feed / 60.0),
+            'send': per_move,
+        }, pending
+
+    def stalls(self, send, duration):
+        """
+            Time the machine waits before each move, the buffer occupancy depends on the previous moves so the
+            recurrence is evaluated in order
+            :param send: Array with the seconds to send each move
+            :param duration: Array with the seconds to execute each move
+            :return: Array with the seconds waited before each move, the first move is not a stall
+        """
+        ends = deque([0.0] * self.buffer_size, maxlen=self.buffer_size)
+        arrival = end = 0.0
+        stalls = []
+        append = stalls.append
+        for seconds, running in zip(send.tolist(), duration.tolist()):
+            slot = ends[0]
+            arrival = (arrival if arrival > slot else slot) + seconds
+            if arrival > end:
+                append(arrival - end)
+                end = arrival + running
+            else:
+                append(0.0)
+                end += running
+            ends.append(end)
+        stalls = numpy.array(stalls, dtype=numpy.float64)
+        if len(stalls):
+            stalls[0] = 0.0
+        return stalls
+
+    def _histogram(self, values, bins, duration, stall):
+        index = numpy.clip(numpy.digitize(values, bins) - 1, 0, len(bins) - 2)
+        size = len(bins) - 1
+        return {
+            'edges': bins.tolist(),
+            'count': numpy.bincount(index, minlength=size).tolist(),
+            'duration': numpy.bincount(index, weights=duration, minlength=size).tolist(),
+            'stall': numpy.bincount(index, weights=stall, minlength=size).tolist(),
+        }
+
+    def hotspots(self, moves, stall):
+        """
+            :param moves: Dict of arrays like moves()
+            :param stall: Array of stalls()
+            :return: List of dicts {'first_line', 'last_line', 'moves', 'stall', 'mean_length', 'mean_duration'}
+            with the ranges of lines where the buffer drains, the worst first. Stalls less than buffer_size moves
+            apart are in the same range
+        """
+        starved = numpy.flatnonzero(stall > 0)
+        if not len(starved):
+            return []
+        group = numpy.concatenate(([0], numpy.cumsum(numpy.diff(starved) > self.buffer_size)))
+        first = starved[numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(group)) + 1))]
+        last = starved[numpy.concatenate((numpy.flatnonzero(numpy.diff(group)), [len(starved) - 1]))]
+        cumulative = {}
+        for key in ('length', 'duration'):
+            cumulative[key] = numpy.concatenate(([0], numpy.cumsum(moves[key])))
+        totals = numpy.bincount(group, weights=stall[starved])
+        counts = last - first + 1
+        order = numpy.argsort(-totals, kind='stable')[:self.max_hotspots]
+        return [{
+            'first_line': int(moves['line'][first[n]]),
+            'last_line': int(moves['line'][last[n]]),
+            'moves': int(counts[n]),
+            'stall': float(totals[n]),
+            'mean_length': float((cumulative['length'][last[n] + 1] - cumulative['length'][first[n]]) / counts[n]),
+            'mean_duration': float((cumulative['duration'][last[n] + 1] - cumulative['duration'][first[n]]) /
+                                   counts[n]),
+        } for n in order]
+
+    def analyse(self, moves):
+        """
+            :param moves: Dict with the arrays line, length, duration and send of the moves, ej: moves()
+            :return: Dict with moves, duration, send, stall (seconds), starved (number of moves after a stall),
+            hotspots and histograms {'length', 'duration'} with edges, count, duration and stall of each bin
+        """
+        stall = self.stalls(moves['send'], moves['duration'])
+        return {
+            'moves': len(stall),
+            'duration': float(moves['duration'].sum()),
+            'send': float(moves['send'].sum()),
+            'stall': float(stall.sum()),
+            'starved': int((stall > 0).sum()),
+            'hotspots': self.hotspots(moves, stall),
+            'histograms': {
+                'length': self._histogram(moves['length'], self.length_bins, moves['duration'], stall),
+                'duration': self._histogram(moves['duration'], self.duration_bins, moves['duration'], stall),
+            },
+        }
+
+    def analyse_file(self, instruction_set, file_obj, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet used for read the file
+            :param file_obj: File object with the codes
+            :param kwargs: Parameters for ToolpathProcessor
+            :return: Dict like analyse
+        """
+        processor = ToolpathProcessor(instruction_set, file_obj, **kwargs)
+        chunks = []
+        pending = 0.0
+        for blocks in processor.chunks():
+            moves, pending = self.moves(blocks, processor.codes, pending)
+            chunks.append(moves)
+        if not chunks:
+            return self.analyse(self.moves(numpy.zeros(0, dtype=BLOCK_DTYPE), {})[0])
+        return self.analyse(dict((key, numpy.concatenate([moves[key] for moves in chunks])) for key in chunks[0]))
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+import numpy
+import six
+
+import py2gcode as meta
+from py2gcode.processors import SpeedProcessor
+from py2gcode.progress import ProgressTable
+from py2gcode.spatial import SpatialIndex
+from py2gcode.toolpath import ToolpathProcessor
+
+HASH_BLOCK_SIZE = 1 << 20
+TMP_PREFIX = 'tmp-'
+"""Prefix of the directories of the entries being written, they are not entries"""
+RESULT_ATTRIBUTES = ('distance', 'size', 'orig', 'speeds', 'time')
+
+
+def content_hash(file_obj):
+    """
+        :param file_obj: File object, it is rewound after the hash
+        :return: String with the sha256 hexdigest of the content
+    """
+    digest = hashlib.sha256()
+    file_obj.seek(0)
+    while True:
+        block = file_obj.read(HASH_BLOCK_SIZE)
+        if not block:
+            break
+        if isinstance(block, six.text_type):
+            block = block.encode('utf-8')
+        digest.update(block)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
+def instruction_set_fingerprint(instruction_set):
+    """
+        :param instruction_set: StandardInstructionSet
+        :return: String that changes if the supported codes or their params change
+    """
+    codes = []
+    for key in sorted(instruction_set.code_supportered):
+        code = instruction_set.code_supportered[key]
+        if code is None:
+            codes.append((key, None))
+        else:
+            codes.append((key, code.gcode, sorted(code.valid_params), sorted(code.required_params), code.required_min,
+                          sorted(tuple(group) for group in getattr(code, 'required_any', []))))
+    return '%s.%s:%s:%s' % (instruction_set.__class__.__module__, instruction_set.__class__.__name__,
+                            instruction_set.strict, codes)
+
+
+def _to_json(value):
+    if isinstance(value, dict):
+        return dict((str(key), _to_json(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, timedelta):
+        return {'seconds': value.total_seconds()}
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def processor_results(processor):
+    """
+        :param processor: FileProcessor already read
+        :return: Dict with the analysis attributes of the processor (distance, size, orig, speeds, time)
+    """
+    counts = processor.diagnostics.counts
+    results = {'errors': counts['error'], 'comments': counts['comment']}
+    for attribute in RESULT_ATTRIBUTES:
+        if hasattr(processor, attribute):
+            results[attribute] = getattr(processor, attribute)
+    return results
+
+
+def _entry_size(entry):
+    """
+        :param entry: Path of a cache entry
+        :return: Size in bytes of the files of the entry
+    """
+    return sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+
+
+class AnalysisCache():
+    """
+        On disk cache of processor results, toolpath arrays and progress tables, the entries are keyed by the content
+        hash of the file, the instruction set and the processor configuration.
+        The least recently used entries are removed when the cache is bigger than max_size bytes. The size is read from
+        the disk at the first store and then kept as a running total, so a store only walks the cache when max_size is
+        crossed (the entries written by other processes are counted at that moment). Then the cache is reduced to
+        LOW_WATER of max_size, so the next stores do not walk it again
+    """
+    LOW_WATER = 0.9
+    RESULTS_FILE = 'results.json'
+    TOOLPATH_FILE = 'toolpath.npy'
+    PROGRESS_FILE = 'progress.npz'
+    SPATIAL_FILE = 'spatial.npz'
+
+    def __init__(self, path, max_size=1 << 30):
+        """
+            :param path: Directory of the cache, it is created if not exists
+            :param max_size: Maximum size in bytes of the cache
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, digest, instruction_set, kind, **config):
+        """
+            :param digest: Content hash of the file, see content_hash
+            :param instruction_set: StandardInstructionSet
+            :param kind: Name of the cached analysis
+            :param config: Configuration of the processor
+            :return: String with the key of the entry
+        """
+        parts = [meta.__version__, digest, instruction_set_fingerprint(instruction_set), kind, sorted(config.items())]
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _hit(self, key, filename):
+        path = os.path.join(self.entry_path(key), filename)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(self.entry_path(key), None)
+        return path
+
+    def _store(self, key, filename, writer):
+        entry = self.entry_path(key)
+        parent = os.path.dirname(entry)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=parent)
+        replaced = 0
+        try:
+            writer(os.path.join(tmp, filename))
+            if os.path.isdir(entry):
+                replaced = _entry_size(entry)
+                shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+        if self.total is None:
+            self.total = self.size()
+        else:
+            self.total += _entry_size(entry) - replaced
+        if self.total > self.max_size:
+            self.evict(keep=entry, size=int(self.max_size * self.LOW_WATER))
+        return os.path.join(entry, filename)
+
+    def analyse(self, instruction_set, file_obj, processor_class=SpeedProcessor, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet
+            :param file_obj: File object with the codes
+            :param processor_class: FileProcessor class used when the results are not cached
+            :param kwargs: Parameters for the processor, ej: mm=True
+            :return: Dict of processor_results
+        """
+        key = self.key(content_hash(file_obj), instruction_set, processor_class.__name__, **kwargs)
+        path = self._hit(key, self.RESULTS_FILE)
+        if path is not None:
+            with open(path) as results_file:
+                results = json.load(results_file)
+            if 'time' in results and isinstance(results['time'], dict):
+                results['time'] = timedelta(seconds=results['time']['seconds'])
+            return results
+        processor = processor_class(instruction_set, file_obj, **kwargs)
+        for _ in processor.read():
+            pass
+        results = processor_results(processor)
+
+        def writer(filename):
+            with open(filename, 'w') as results_file:
+                json.dump(_to_json(results), results_file)
+
+        self._store(key, self.RESULTS_FILE, writer)
+        return results
+
+    def toolpath(self, instruction_set, file_obj, mmap=True, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet
+            :param file_obj: File object with the codes
+            :param mmap: Boolean for load the cached array with memory mapping (read only)
+            :param kwargs: Parameters for ToolpathProcessor, ej: mm=True
+            :return: Array of BLOCK_DTYPE
+        """
+        key = self.key(content_hash(file_obj), instruction_set, ToolpathProcessor.__name__, **kwargs)
+        path = self._hit(key, self.TOOLPATH_FILE)
+        if path is None:
+            blocks = ToolpathProcessor(instruction_set, file_obj, **kwargs).toolpath()
+            path = self._store(key, self.TOOLPATH_FILE, lambda filename: numpy.save(filename, blocks))
+            if not mmap:
+                return blocks
+        return numpy.load(path, mmap_mode='r' if mmap else None)
+
+    def progress(self, instruction_set, file_obj, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet
+            :param file_obj: File object with the codes
+            :param kwargs: Parameters for ProgressTable.from_file, ej: resolution=1024
+            :return: ProgressTable
+        """
+        key = self.key(content_hash(file_obj), instruction_set, ProgressTable.__name__, **kwargs)
+        path = self._hit(key, self.PROGRESS_FILE)
+        if path is None:
+            table = ProgressTable.from_file(instruction_set, file_obj, **kwargs)
+            self._store(key, self.PROGRESS_FILE, table.save)
+            return table
+        return ProgressTable.load(path)
+
+    def spatial(self, instruction_set, file_obj, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet
+            :param file_obj: File object with the codes
+            :param kwargs: Parameters for SpatialIndex.from_file, ej: tolerance=0.05
+            :return: SpatialIndex
+        """
+        key = self.key(content_hash(file_obj), instruction_set, SpatialIndex.__name__, **kwargs)
+        path = self._hit(key, self.SPATIAL_FILE)
+        if path is None:
+            index = SpatialIndex.from_file(instruction_set, file_obj, **kwargs)
+            self._store(key, self.SPATIAL_FILE, index.save)
+            return index
+        return SpatialIndex.load(path)
+
+    def entries(self):
+        """
+            :return: List of (last access time, size in bytes, path) of the entries
+        """
+        entries = []
+        for prefix in os.listdir(self.path):
+            prefix = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix):
+                continue
+            for name in os.listdir(prefix):
+                if name.startswith(TMP_PREFIX):
+                    continue
+                entry = os.path.join(prefix, name)
+                try:
+                    entries.append((os.path.getmtime(entry), _entry_size(entry), entry))
+                except OSError:
+                    continue
+        return entries
+
+    def size(self):
+        """
+            :return: Size in bytes of the cache
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None, size=None):
+        """
+            Remove the least recently used entries until the cache fits in size
+            :param keep: Path of an entry that is not removed, ej: the one just stored
+            :param size: Size in bytes, default max_size
+        """
+        if size is None:
+            size = self.max_size
+        entries = sorted(self.entries())
+        total = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, entry in entries:
+            if total <= size:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= entry_size
+            self.evictions += 1
+        self.total = total
+
+    def clear(self):
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+        self.total = 0
+
+    def stats(self):
+        """
+            :return: Dict with hits, misses, evictions, hit_ratio and size
+        """
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / requests if requests else 0.0,
+            'size': self.size(),
+        }
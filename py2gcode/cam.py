@@ -0,0 +1,649 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import numpy
+
+from py2gcode.py2gcode import GCodeException
+from py2gcode.toolpath import AXES, format_numbers, _forward_fill, _integer_bytes, _join_lines, _text_bytes
+
+_BAYER_2 = numpy.array([[0, 2], [3, 1]])
+_BAYER_4 = numpy.block([[4 * _BAYER_2, 4 * _BAYER_2 + 2], [4 * _BAYER_2 + 3, 4 * _BAYER_2 + 1]])
+BAYER_8 = (numpy.block([[4 * _BAYER_4, 4 * _BAYER_4 + 2], [4 * _BAYER_4 + 3, 4 * _BAYER_4 + 1]]) + 0.5) / 64.0
+"""Thresholds of the ordered dithering"""
+
+
+def _place(points, origin=(0, 0), angle=0):
+    """
+        :param points: Array (N, 2)
+        :return: Array (N, 2) rotated angle degrees and moved to origin
+    """
+    if angle:
+        radians = numpy.radians(angle)
+        cos, sin = numpy.cos(radians), numpy.sin(radians)
+        points = numpy.column_stack((points[:, 0] * cos - points[:, 1] * sin, points[:, 0] * sin + points[:, 1] * cos))
+    return points + numpy.asarray(origin, dtype=numpy.float64)
+
+
+def facing(origin, size, stepover, tool_radius=0, angle=0):
+    """
+        Zig zag passes along X stepover apart that cover a rectangle, the passes go tool_radius beyond the sides
+        :param origin: (x, y) of the corner of the rectangle
+        :param size: (width, height) of the rectangle
+        :param stepover: Maximum distance in mm between passes
+        :param tool_radius: Radius in mm of the tool
+        :param angle: Degrees the pattern is rotated around origin
+        :return: Array (N, 2) with the points
+    """
+    width, height = size
+    count = max(int(numpy.ceil(height / float(stepover))), 0) + 1
+    ys = numpy.linspace(0, height, count)
+    ends = numpy.array([-tool_radius, width + tool_radius], dtype=numpy.float64)
+    xs = numpy.where((numpy.arange(count) % 2 == 1)[:, None], ends[::-1], ends)
+    return _place(numpy.column_stack((xs.ravel(), numpy.repeat(ys, 2))), origin, angle)
+
+
+def rectangle_pocket(origin, size, tool_radius, stepover):
+    """
+        Closed rectangles from the center to the walls of the pocket (offset by the tool radius), each one joined
+        to the next one
+        :param origin: (x, y) of the corner of the pocket
+        :param size: (width, height) of the pocket
+        :param tool_radius: Radius in mm of the tool
+        :param stepover: Maximum distance in mm between rectangles
+        :return: Array (N, 2) with the points
+        :raise GCodeException: If the tool does not fit in the pocket
+    """
+    half = numpy.array(size, dtype=numpy.float64) / 2 - tool_radius
+    if half.min() < 0:
+        raise GCodeException('Tool of radius %s does not fit in a pocket of %s' % (tool_radius, size))
+    count = max(int(numpy.ceil(half.min() / float(stepover))), 1)
+    steps = numpy.linspace(half.min(), 0, count + 1)
+    corners = numpy.array([[-1, -1], [1, -1], [1, 1], [-1, 1], [-1, -1]], dtype=numpy.float64)
+    halves = (half - steps[:, None])[:, None, :]
+    points = (corners * halves).reshape(-1, 2)
+    return points + numpy.asarray(origin, dtype=numpy.float64) + numpy.array(size, dtype=numpy.float64) / 2
+
+
+def spiral(center, radius, stepover, start_radius=0, segment=0.5, start_angle=0, clockwise=False):
+    """
+        Archimedean spiral from start_radius to radius growing stepover each turn
+        :param center: (x, y) of the center
+        :param radius: Final radius in mm
+        :param stepover: Distance in mm between turns
+        :param start_radius: Initial radius in mm
+        :param segment: Length in mm of the segments along the curve
+        :param start_angle: Degrees of the first point
+        :param clockwise: Boolean for turn clockwise
+        :return: Array (N, 2) with the points
+    """
+    growth = stepover / (2 * numpy.pi)
+    theta0, theta1 = start_radius / growth, radius / growth
+
+    def length(theta):
+        return growth / 2 * (theta * numpy.sqrt(1 + theta ** 2) + numpy.arcsinh(theta))
+
+    total = length(theta1) - length(theta0)
+    count = max(int(numpy.ceil(total / float(segment))), 1) + 1
+    thetas = numpy.linspace(theta0, theta1, count)
+    thetas = numpy.interp(numpy.linspace(length(theta0), length(theta1), count), length(thetas), thetas)
+    radii = growth * thetas
+    angles = numpy.radians(start_angle) + (thetas - theta0) * (-1 if clockwise else 1)
+    return numpy.column_stack((radii * numpy.cos(angles), radii * numpy.sin(angles))) + numpy.asarray(center)
+
+
+def circle(center, radius, segment=0.5, start_angle=0, clockwise=False):
+    """
+        :param center: (x, y) of the center
+        :param radius: Radius in mm
+        :param segment: Maximum length in mm of the chords
+        :param start_angle: Degrees of the first point
+        :param clockwise: Boolean for turn clockwise
+        :return: Array (N, 2) with the points of the closed circle
+    """
+    count = max(int(numpy.ceil(2 * numpy.pi * radius / float(segment))), 3)
+    angles = numpy.radians(start_angle) + numpy.linspace(0, 2 * numpy.pi, count + 1) * (-1 if clockwise else 1)
+    points = numpy.column_stack((radius * numpy.cos(angles), radius * numpy.sin(angles))) + numpy.asarray(center)
+    points[-1] = points[0]
+    return points
+
+
+def circle_pocket(center, radius, tool_radius, stepover, segment=0.5, clockwise=False):
+    """
+        Spiral from the center to the wall of the pocket (offset by the tool radius) and a finishing circle
+        :param center: (x, y) of the center
+        :param radius: Radius in mm of the pocket
+        :param tool_radius: Radius in mm of the tool
+        :param stepover: Distance in mm between turns
+        :param segment: Length in mm of the segments
+        :param clockwise: Boolean for turn clockwise
+        :return: Array (N, 2) with the points
+        :raise GCodeException: If the tool does not fit in the pocket
+    """
+    if tool_radius > radius:
+        raise GCodeException('Tool of radius %s does not fit in a pocket of radius %s' % (tool_radius, radius))
+    radius = float(radius) - tool_radius
+    points = spiral(center, radius, stepover, segment=segment, clockwise=clockwise)
+    end = numpy.degrees(numpy.arctan2(points[-1, 1] - center[1], points[-1, 0] - center[0]))
+    return numpy.concatenate((points, circle(center, radius, segment, end, clockwise)[1:]))
+
+
+def grid(origin, counts, spacing, serpentine=True):
+    """
+        :param origin: (x, y) of the first point
+        :param counts: (columns, rows)
+        :param spacing: (dx, dy) between points
+        :param serpentine: Boolean for alternate the direction of the rows so the travel is shorter
+        :return: Array (columns * rows, 2) with the points, row by row
+    """
+    columns, rows = counts
+    xs = numpy.tile(numpy.arange(columns, dtype=numpy.float64), (rows, 1))
+    if serpentine:
+        xs[1::2] = xs[1::2, ::-1]
+    ys = numpy.repeat(numpy.arange(rows, dtype=numpy.float64), columns)
+    return numpy.column_stack((xs.ravel() * spacing[0], ys * spacing[1])) + numpy.asarray(origin)
+
+
+def raster(polygon, spacing, angle=0):
+    """
+        Scan lines spacing apart inside a polygon (even odd rule), the direction alternates on each line
+        :param polygon: Array (N, 2) with the vertices, it is closed automatically
+        :param spacing: Distance in mm between lines
+        :param angle: Degrees of the lines
+        :return: Array (S, 2, 2) with the start and end point of each segment, line by line
+    """
+    polygon = _place(numpy.asarray(polygon, dtype=numpy.float64), angle=-angle)
+    x0, y0 = polygon[:, 0], polygon[:, 1]
+    x1, y1 = numpy.roll(x0, -1), numpy.roll(y0, -1)
+    low, high = y0.min(), y0.max()
+    count = int(numpy.floor((high - low) / float(spacing)))
+    ys = low + spacing * (numpy.arange(count) + 0.5) if count else numpy.array([(low + high) / 2.0])
+    ys = ys[:, None]
+    crossing = (y0 <= ys) != (y1 <= ys)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        xs = x0 + (ys - y0) * (x1 - x0) / (y1 - y0)
+    xs = numpy.sort(numpy.where(crossing, xs, numpy.nan), axis=1)
+    pairs = xs.shape[1] // 2
+    starts, ends = xs[:, 0:2 * pairs:2], xs[:, 1:2 * pairs:2]
+    reverse = (numpy.arange(len(ys)) % 2 == 1)[:, None]
+    starts, ends = numpy.where(reverse, ends[:, ::-1], starts), numpy.where(reverse, starts[:, ::-1], ends)
+    valid = ~numpy.isnan(starts) & ~numpy.isnan(ends)
+    lines = numpy.broadcast_to(ys, starts.shape)[valid]
+    segments = numpy.column_stack((starts[valid], lines, ends[valid], lines))
+    return _place(segments.reshape(-1, 2), angle=angle).reshape(-1, 2, 2)
+
+
+def laser_power(image, mode='greyscale', max_power=1000, min_power=0, invert=True, gamma=1.0, levels=None,
+                threshold=0.5):
+    """
+        Laser power of each pixel of an image
+        :param image: Array (rows, columns) with the grey levels, integers (0 to the maximum of the type) or floats
+        (0 to 1), the first row is the top of the image
+        :param mode: 'greyscale' for power proportional to the darkness, 'dither' for ordered dithering (Bayer 8x8)
+        with max_power or off, 'threshold' for max_power on the pixels darker than threshold
+        :param max_power: S value of the darkest pixels
+        :param min_power: S value of the lightest not blank pixels in greyscale
+        :param invert: Boolean, True if dark pixels are burnt
+        :param gamma: Exponent applied to the darkness
+        :param levels: Number of grey levels in greyscale, fewer levels make longer runs, None for all
+        :param threshold: Darkness (0 to 1) of the on pixels in threshold mode
+        :return: Array (rows, columns) of int32 with the S value of each pixel, 0 for blank
+        :raise GCodeException: If the mode is not valid
+    """
+    image = numpy.asarray(image)
+    if image.ndim != 2:
+        raise GCodeException('Image with shape %s is not greyscale' % (image.shape,))
+    if numpy.issubdtype(image.dtype, numpy.integer):
+        values = image / float(numpy.iinfo(image.dtype).max)
+    else:
+        values = numpy.clip(image.astype(numpy.float64), 0, 1)
+    darkness = (1 - values if invert else values) ** gamma
+    if mode == 'greyscale':
+        if levels:
+            darkness = numpy.round(darkness * (levels - 1)) / (levels - 1)
+        power = numpy.where(darkness > 0, min_power + darkness * (max_power - min_power), 0)
+    elif mode == 'dither':
+        rows, columns = darkness.shape
+        matrix = numpy.tile(BAYER_8, ((rows + 7) // 8, (columns + 7) // 8))[:rows, :columns]
+        power = numpy.where(darkness > matrix, max_power, 0)
+    elif mode == 'threshold':
+        power = numpy.where(darkness >= threshold, max_power, 0)
+    else:
+        raise GCodeException('Laser mode %s not valid' % mode)
+    return numpy.rint(power).astype(numpy.int32)
+
+
+class Toolpath():
+    """
+        Sequence of rapid (G0) and feed (G1) moves built from coordinate arrays, the codes are written in bulk from
+        the gcode and valid_params of the instruction set without calling get()
+    """
+
+    def __init__(self, feed=None, plunge_feed=None, safe_z=5.0, precision=3):
+        """
+            :param feed: Feed rate in mm/min of the cutting moves
+            :param plunge_feed: Feed rate in mm/min of the moves down, default feed
+            :param safe_z: Z in mm free of obstacles for the rapid moves
+            :param precision: Decimals of the coordinates and feed rates
+        """
+        self.feed = feed
+        self.plunge_feed = plunge_feed if plunge_feed is not None else feed
+        self.safe_z = safe_z
+        self.precision = precision
+        self.position = numpy.full(3, numpy.nan)
+        self._points = []
+        self._rapid = []
+        self._feed = []
+
+    def __len__(self):
+        return sum(len(points) for points in self._points)
+
+    def move(self, points, rapid=False, feed=None, z=None):
+        """
+            :param points: Array (N, 3) or (N, 2) with absolute coordinates, NaN keeps the previous value
+            :param rapid: Boolean for G0 moves
+            :param feed: Feed rate in mm/min or array (N,), default the feed of the Toolpath
+            :param z: Z for (N, 2) points, default the current Z
+            :return: self
+        """
+        points = numpy.array(points, dtype=numpy.float64, ndmin=2)
+        if points.shape[1] == 2:
+            points = numpy.column_stack((points, numpy.full(len(points), self.position[2] if z is None else z)))
+        if not len(points):
+            return self
+        for axis in range(3):
+            known = ~numpy.isnan(points[:, axis])
+            points[:, axis] = _forward_fill(points[:, axis], known, self.position[axis])
+        if feed is None:
+            feed = self.feed if self.feed is not None else numpy.nan
+        self._points.append(points)
+        self._rapid.append(numpy.full(len(points), bool(rapid)))
+        self._feed.append(numpy.broadcast_to(numpy.asarray(feed, dtype=numpy.float64), (len(points),)))
+        self.position = points[-1].copy()
+        return self
+
+    def rapid(self, x=None, y=None, z=None):
+        """
+            G0 to the point, None keeps the coordinate
+            :return: self
+        """
+        return self.move([[numpy.nan if value is None else value for value in (x, y, z)]], rapid=True)
+
+    def line(self, x=None, y=None, z=None, feed=None):
+        """
+            G1 to the point, None keeps the coordinate
+            :return: self
+        """
+        return self.move([[numpy.nan if value is None else value for value in (x, y, z)]], feed=feed)
+
+    def extend(self, other):
+        """
+            :param other: Toolpath added at the end
+            :return: self
+        """
+        points, rapid, feed = other.arrays()
+        if len(points):
+            self._points.append(points)
+            self._rapid.append(rapid)
+            self._feed.append(feed)
+            self.position = points[-1].copy()
+        return self
+
+    def arrays(self):
+        """
+            :return: Tuple with the arrays points (N, 3), rapid (N,) and feed (N,)
+        """
+        if not self._points:
+            return numpy.zeros((0, 3)), numpy.zeros(0, dtype=bool), numpy.zeros(0)
+        if len(self._points) > 1:
+            self._points = [numpy.concatenate(self._points)]
+            self._rapid = [numpy.concatenate(self._rapid)]
+            self._feed = [numpy.concatenate(self._feed)]
+        return self._points[0], self._rapid[0], self._feed[0]
+
+    def _ramp(self, path, top, bottom, angle):
+        """
+            :return: Array (M, 3) going down from top to bottom along the start of the path at angle degrees and
+            back to the start at bottom
+        """
+        lengths = numpy.concatenate(([0], numpy.cumsum(numpy.hypot(*numpy.diff(path, axis=0).T))))
+        distance = (top - bottom) / numpy.tan(numpy.radians(angle))
+        distance = min(distance, lengths[-1]) if lengths[-1] > 0 else 0
+        if distance <= 0:
+            return numpy.array([[path[0, 0], path[0, 1], bottom]])
+        inside = lengths < distance
+        end = [numpy.interp(distance, lengths, path[:, axis]) for axis in (0, 1)]
+        down = numpy.vstack((path[inside], end))
+        z = top - (top - bottom) * numpy.append(lengths[inside], distance) / distance
+        back = down[::-1][1:]
+        return numpy.vstack((numpy.column_stack((down, z)), numpy.column_stack((back, numpy.full(len(back), bottom)))))
+
+    def passes(self, path, depth, step_down, top=0.0, ramp_angle=None, closed=None):
+        """
+            Cut a 2D path in several passes from top to depth, the tool goes down plunging or ramping along the path
+            :param path: Array (N, 2) with the points, ej: rectangle_pocket
+            :param depth: Final Z in mm
+            :param step_down: Maximum Z in mm cut in each pass
+            :param top: Z in mm of the surface
+            :param ramp_angle: Degrees of the ramp, None for plunge
+            :param closed: Boolean for paths that end at the start, the tool does not go up between passes,
+            default auto detected
+            :return: self
+        """
+        path = numpy.asarray(path, dtype=numpy.float64)
+        if closed is None:
+            closed = bool(numpy.allclose(path[0], path[-1]))
+        count = max(int(numpy.ceil((top - depth) / float(step_down))), 1)
+        levels = numpy.maximum(top - step_down * numpy.arange(1, count + 1), depth)
+        previous = top
+        for n, level in enumerate(levels):
+            if n == 0 or not closed:
+                self.rapid(z=self.safe_z).rapid(x=path[0, 0], y=path[0, 1]).rapid(z=previous)
+            if ramp_angle:
+                self.move(self._ramp(path, previous, level, ramp_angle), feed=self.plunge_feed)
+            else:
+                self.line(z=level, feed=self.plunge_feed)
+            self.move(path[1:], z=level)
+            previous = level
+        return self.rapid(z=self.safe_z)
+
+    def drill(self, points, depth, top=0.0, peck=None, clearance=0.5):
+        """
+            Drill holes, with peck the tool goes up to clearance over top after each peck
+            :param points: Array (N, 2) with the centers, ej: grid
+            :param depth: Final Z in mm
+            :param top: Z in mm of the surface
+            :param peck: Maximum Z in mm cut in each peck, None for one plunge
+            :param clearance: Distance in mm over the surface and the last peck for the rapid moves
+            :return: self
+        """
+        points = numpy.asarray(points, dtype=numpy.float64)
+        count = max(int(numpy.ceil((top - depth) / float(peck))), 1) if peck else 1
+        levels = numpy.maximum(top - (peck or 0) * numpy.arange(1, count + 1), depth) if peck else numpy.array([depth])
+        z = [self.safe_z, top + clearance]
+        rapid = [True, True]
+        for n, level in enumerate(levels):
+            if n:
+                z += [top + clearance, levels[n - 1] + clearance]
+                rapid += [True, True]
+            z.append(level)
+            rapid.append(False)
+        z.append(self.safe_z)
+        rapid.append(True)
+        z = numpy.array(z)
+        holes = numpy.empty((len(points), len(z), 3))
+        holes[:, :, :2] = points[:, None, :]
+        holes[:, :, 2] = z
+        rapid = numpy.tile(rapid, len(points))
+        feed = numpy.where(rapid, numpy.nan, self.plunge_feed if self.plunge_feed is not None else numpy.nan)
+        self.rapid(z=self.safe_z)
+        self._points.append(holes.reshape(-1, 3))
+        self._rapid.append(rapid)
+        self._feed.append(feed)
+        if len(points):
+            self.position = self._points[-1][-1].copy()
+        return self
+
+    def segments(self, segments, z, link=0.0):
+        """
+            Cut segments at z, ej: raster, the tool goes to safe_z between segments farther than link
+            :param segments: Array (S, 2, 2) with the start and end of each segment
+            :param z: Z in mm of the cut
+            :param link: Maximum distance in mm between segments joined with a feed move
+            :return: self
+        """
+        segments = numpy.asarray(segments, dtype=numpy.float64)
+        if not len(segments):
+            return self
+        previous = numpy.vstack((self.position[None, :2], segments[:-1, 1]))
+        gap = numpy.hypot(*(segments[:, 0] - previous).T)
+        joined = gap <= link
+        joined[0] &= self.position[2] == z
+        rows = numpy.empty((len(segments), 5, 3))
+        rows[:, 0, :2] = previous
+        rows[:, 0, 2] = self.safe_z
+        rows[:, 1, :2] = segments[:, 0]
+        rows[:, 1, 2] = self.safe_z
+        rows[:, 2, :2] = segments[:, 0]
+        rows[:, 2, 2] = z
+        rows[:, 3, :2] = segments[:, 0]
+        rows[:, 3, 2] = z
+        rows[:, 4, :2] = segments[:, 1]
+        rows[:, 4, 2] = z
+        rapid = numpy.tile([True, True, False, False, False], (len(segments), 1))
+        keep = numpy.column_stack((~joined, ~joined, ~joined, joined, numpy.ones(len(segments), dtype=bool)))
+        feed = numpy.tile([numpy.nan, numpy.nan, self.plunge_feed, self.feed, self.feed], (len(segments), 1))
+        self._points.append(rows[keep])
+        self._rapid.append(rapid[keep])
+        self._feed.append(numpy.asarray(feed[keep], dtype=numpy.float64))
+        self.position = self._points[-1][-1].copy()
+        return self
+
+    def codes(self, instruction_set):
+        """
+            :param instruction_set: StandardInstructionSet used for write the codes
+            :return: List of strings with the codes, only the changed words are written, about 1 microsecond for
+            each point
+            :raise GCodeException: If the instruction set can not write the moves
+        """
+        points, rapid, feed = self.arrays()
+        if not len(points):
+            return []
+        moves = []
+        for name in ('line_fast', 'line_normal'):
+            try:
+                moves.append(getattr(instruction_set, name))
+            except AttributeError:
+                raise GCodeException('%s not supported by %s' % (name, instruction_set.__class__.__name__))
+            for word in AXES:
+                if word not in moves[-1].valid_params:
+                    raise GCodeException('%s without %s' % (moves[-1].gcode, word.upper()))
+        scaled = numpy.rint(points * 10 ** self.precision)
+        changed = ~numpy.isnan(points)
+        changed[1:] &= scaled[1:] != scaled[:-1]
+        moving = changed.any(axis=1)
+        points, rapid, feed, changed = points[moving], rapid[moving], feed[moving], changed[moving]
+        feeding = ~rapid & ~numpy.isnan(feed)
+        scaled = numpy.rint(feed * 10 ** self.precision)
+        last = _forward_fill(scaled, feeding, numpy.nan)
+        feed_changed = feeding & (scaled != numpy.concatenate(([numpy.nan], last[:-1])))
+        if feed_changed.any() and 'f' not in moves[1].valid_params:
+            raise GCodeException('%s without F' % moves[1].gcode)
+        columns = [_text_bytes([moves[1].gcode, moves[0].gcode])[rapid.astype(numpy.int8)]]
+        for values, letter, mask in zip(list(points.T) + [feed], [axis.upper() for axis in AXES] + ['F'],
+                                        list(changed.T) + [feed_changed]):
+            columns.append(self._words(letter, values, mask))
+        return _join_lines(columns)
+
+    def _words(self, letter, values, mask):
+        """
+            :return: Array (N, width) of uint8 with the text of the word of each value, empty where mask is False
+        """
+        scaled = numpy.rint(values[mask] * 10 ** self.precision).astype(numpy.int64)
+        words = numpy.zeros((len(values), 0), dtype=numpy.uint8)
+        if len(scaled):
+            text = _integer_bytes(scaled, self.precision)
+            words = numpy.zeros((len(values), text.shape[1] + 2), dtype=numpy.uint8)
+            words[mask, 0] = ord(' ')
+            words[mask, 1] = ord(letter)
+            words[mask, 2:] = text
+        return words
+
+    def write(self, file_obj, instruction_set):
+        """
+            :param file_obj: File object for write the codes
+            :param instruction_set: StandardInstructionSet used for write the codes
+        """
+        codes = self.codes(instruction_set)
+        if codes:
+            file_obj.write('\r\n'.join(codes) + '\r\n')
+
+
+class LaserRaster():
+    """
+        Raster engraving of an image with a laser driven by the spindle codes (M3 or M4 with S power, ej: Grbl in
+        laser mode). The pixels of each row are merged in runs of equal power written as G1 X S moves, the rows go
+        in alternate directions with overscan (laser off moves before and after each pass for the acceleration) and
+        the blank rows and blank gaps longer than skip are travelled with G0
+    """
+
+    def __init__(self, image, pixel_size, origin=(0, 0), feed=3000.0, overscan=2.0, skip=5.0, bidirectional=True,
+                 dynamic=True, precision=3, **kwargs):
+        """
+            :param image: Array (rows, columns) with the grey levels, see laser_power
+            :param pixel_size: Size in mm of the pixels, (x, y) or a number
+            :param origin: (x, y) of the bottom left corner of the image
+            :param feed: Feed rate in mm/min of the engraving moves
+            :param overscan: Distance in mm the laser moves off before and after each pass
+            :param skip: Blank gaps in mm longer than it are travelled with G0, None for engrave them with S0
+            :param bidirectional: Boolean for engrave in both directions
+            :param dynamic: Boolean for M4 (power scaled with the speed), False for M3
+            :param precision: Decimals of the coordinates and feed rate
+            :param kwargs: Parameters of laser_power, ej: mode='dither', max_power=255
+        """
+        self.power = laser_power(image, **kwargs)
+        self.pixel_size = numpy.broadcast_to(numpy.asarray(pixel_size, dtype=numpy.float64), (2,))
+        self.origin = numpy.asarray(origin, dtype=numpy.float64)
+        self.feed = feed
+        self.overscan = overscan
+        self.skip = skip
+        self.bidirectional = bidirectional
+        self.dynamic = dynamic
+        self.precision = precision
+
+    def runs(self):
+        """
+            Run length encoding of the rows of power
+            :return: Dict of arrays with row, start and end (columns, end excluded) and power of each run
+        """
+        rows, columns = self.power.shape
+        flat = self.power.ravel()
+        change = numpy.ones(len(flat), dtype=bool)
+        change[1:] = flat[1:] != flat[:-1]
+        change[::columns] = True
+        starts = numpy.flatnonzero(change)
+        ends = numpy.append(starts[1:], len(flat))
+        return {
+            'row': starts // columns,
+            'start': starts % columns,
+            'end': ends - starts + starts % columns,
+            'power': flat[starts],
+        }
+
+    def moves(self):
+        """
+            :return: Dict of arrays with x, y, rapid (Boolean) and power (-1 for the G0 moves) of the moves
+        """
+        runs = self.runs()
+        row, start, end, power = runs['row'], runs['start'], runs['end'], runs['power']
+        blank = power == 0
+        first = numpy.ones(len(row), dtype=bool)
+        first[1:] = row[1:] != row[:-1]
+        last = numpy.ones(len(row), dtype=bool)
+        last[:-1] = row[1:] != row[:-1]
+        gap = (blank & (first | last)) if self.skip is None else \
+            (blank & (first | last | ((end - start) * self.pixel_size[0] > self.skip)))
+        keep = ~gap
+        new_segment = keep & (first | numpy.concatenate(([True], gap[:-1])))
+        row, start, end, power, new_segment = row[keep], start[keep], end[keep], power[keep], new_segment[keep]
+        if not len(row):
+            return {'x': numpy.zeros(0), 'y': numpy.zeros(0), 'rapid': numpy.zeros(0, dtype=bool),
+                    'power': numpy.zeros(0, dtype=numpy.int32)}
+
+        lines, row_order = numpy.unique(row, return_inverse=True)
+        row_order = row_order.ravel()
+        reverse = (row_order % 2 == 1) if self.bidirectional else numpy.zeros(len(row), dtype=bool)
+        segment = numpy.cumsum(new_segment) - 1
+        order = numpy.lexsort((numpy.where(reverse, -start, start), row_order))
+        row, start, end, power, reverse = row[order], start[order], end[order], power[order], reverse[order]
+        segment = segment[order]
+        new_segment = numpy.ones(len(row), dtype=bool)
+        new_segment[1:] = segment[1:] != segment[:-1]
+        segment = numpy.cumsum(new_segment) - 1
+
+        direction = numpy.where(reverse, -1.0, 1.0)
+        left = self.origin[0] + start * self.pixel_size[0]
+        right = self.origin[0] + end * self.pixel_size[0]
+        x_from = numpy.where(reverse, right, left)
+        x_to = numpy.where(reverse, left, right)
+        y = self.origin[1] + (self.power.shape[0] - 1 - row + 0.5) * self.pixel_size[1]
+        heads = numpy.flatnonzero(new_segment)
+        tails = numpy.append(heads[1:], len(row)) - 1
+        count = len(segment) + 3 * len(heads)
+        moves = {
+            'x': numpy.empty(count),
+            'y': numpy.empty(count),
+            'rapid': numpy.zeros(count, dtype=bool),
+            'power': numpy.zeros(count, dtype=numpy.int32),
+        }
+        index = numpy.arange(len(row)) + 3 * segment + 2
+        moves['x'][index] = x_to
+        moves['y'][index] = y
+        moves['power'][index] = power
+        offsets = numpy.arange(len(heads))
+        for position, source, x, rapid in (
+                (heads + 3 * offsets, heads, x_from[heads] - direction[heads] * self.overscan, True),
+                (heads + 3 * offsets + 1, heads, x_from[heads], False),
+                (tails + 3 * offsets + 3, tails, x_to[tails] + direction[tails] * self.overscan, False)):
+            moves['x'][position] = x
+            moves['y'][position] = y[source]
+            moves['rapid'][position] = rapid
+            moves['power'][position] = -1 if rapid else 0
+        return moves
+
+    def codes(self, instruction_set):
+        """
+            :param instruction_set: StandardInstructionSet used for write the codes, G1 has to accept S
+            :return: List of strings with the codes, only the changed words are written
+            :raise GCodeException: If the instruction set can not write the moves
+        """
+        try:
+            rapid_code, feed_code = instruction_set.line_fast, instruction_set.line_normal
+            start = getattr(instruction_set, 'M4' if self.dynamic else 'M3').get(s='0')
+            stop = instruction_set.M5.get()
+        except AttributeError:
+            raise GCodeException('Laser codes not supported by %s' % instruction_set.__class__.__name__)
+        if 's' not in feed_code.valid_params:
+            raise GCodeException('%s without S' % feed_code.gcode)
+        moves = self.moves()
+        rapid = moves['rapid']
+        if not len(rapid):
+            return []
+        texts = format_numbers(numpy.column_stack((moves['x'], moves['y'])), self.precision)
+        y_changed = numpy.ones(len(rapid), dtype=bool)
+        y_changed[1:] = texts[1:, 1] != texts[:-1, 1]
+        feeding = ~rapid
+        power = moves['power']
+        last = _forward_fill(power.astype(numpy.float64), feeding, numpy.nan)
+        power_changed = feeding & (power != numpy.concatenate(([numpy.nan], last[:-1])))
+        lines = numpy.where(rapid, rapid_code.gcode, feed_code.gcode)
+        lines = numpy.char.add(numpy.char.add(lines, ' X'), texts[:, 0])
+        lines = numpy.char.add(lines, numpy.where(y_changed, numpy.char.add(' Y', texts[:, 1]), ''))
+        lines = numpy.char.add(lines, numpy.where(power_changed, numpy.char.add(' S', power.astype('U11')), ''))
+        lines = lines.tolist()
+        first = int(numpy.flatnonzero(feeding)[0])
+        lines[first] += ' F%s' % format_numbers(numpy.array([self.feed]), self.precision)[0]
+        return [start] + lines + [stop]
+
+    def write(self, file_obj, instruction_set):
+        """
+            :param file_obj: File object for write the codes
+            :param instruction_set: StandardInstructionSet used for write the codes
+        """
+        codes = self.codes(instruction_set)
+        if codes:
+            file_obj.write('\r\n'.join(codes) + '\r\n')
@@ -18,15 +18,23 @@ from __future__ import absolute_import
 
 from py2gcode.py2gcode import StandardInstructionSet, GCode, MCode
 
+ARC_REQUIRED = [('x', 'y', 'z'), ('i', 'j', 'k')]
+"""An end point axis and a centre offset, so the arcs of the G17, G18 and G19 planes are accepted"""
+
 
 class CNCGCode(StandardInstructionSet):
     """
         Implementation of common GCodes and MCodes used by CNC, see http://www.cncezpro.com/gcodes.cfm
     """
+    MODAL_MOTION = True
 
     def __init__(self, strict=False):
         StandardInstructionSet.__init__(self, strict)
         self.code_supportered.update({
+            'G2': GCode(2, valid_params=['x', 'y', 'z', 'i', 'j', 'k', 'f'], required_any=ARC_REQUIRED,
+                        param_alias={'speed': 'f'}, strict=self.strict),
+            'G3': GCode(3, valid_params=['x', 'y', 'z', 'i', 'j', 'k', 'f'], required_any=ARC_REQUIRED,
+                        param_alias={'speed': 'f'}, strict=self.strict),
             'G17': GCode(17, strict=self.strict),
             'G18': GCode(18, strict=self.strict),
             'G19': GCode(19, strict=self.strict)
@@ -43,6 +51,7 @@ class LinuxCNCGCode(CNCGCode):
         Implementation of common GCodes and MCodes used by LinuxCNC
         see http://www.linuxcnc.org/docs/2.5/html/gcode/gcode.html
     """
+    SUBROUTINES = True
 
     def __init__(self, strict=False):
         CNCGCode.__init__(self, strict)
@@ -72,10 +81,15 @@ class GrblGcode(LinuxCNCGCode):
     """
         Implementation of common GCodes and MCodes suported by Grbl, see https://github.com/grbl/grbl/wiki
     """
+    SUBROUTINES = False
 
     def __init__(self, strict=False):
         LinuxCNCGCode.__init__(self, strict)
         self.code_supportered.update({  # TODO Check parameters
+            'G0': GCode(0, valid_params=['x', 'y', 'z', 'f', 's'], param_alias={'speed': 'f', 'power': 's'},
+                        required_min=1, strict=self.strict),
+            'G1': GCode(1, valid_params=['x', 'y', 'z', 'f', 's'], param_alias={'speed': 'f', 'power': 's'},
+                        required_min=1, strict=self.strict),
             'G5': None,
             'G17.1': None,
             'G18.1': None,
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import re
+
+import numpy
+import six
+
+from py2gcode.cnc import CNCGCode, LinuxCNCGCode, GrblGcode
+from py2gcode.printer3d import Printer3D, SDGCode, MarlinGCode, RepRapGCode
+from py2gcode.py2gcode import ArgsMCode, GCodeException
+
+DIALECTS = [Printer3D, SDGCode, MarlinGCode, RepRapGCode, CNCGCode, LinuxCNCGCode, GrblGcode]
+PARAMS_RE = re.compile('^(?:[A-Za-z]\\-?\\d+\\.?\\d*)+$')
+PARAM_RE = re.compile('([A-Za-z])\\-?\\d+\\.?\\d*')
+
+
+def register_dialect(instruction_set_class):
+    """
+        Add an instruction set to the dialects checked by default
+        :param instruction_set_class: StandardInstructionSet subclass
+    """
+    if instruction_set_class not in DIALECTS:
+        DIALECTS.append(instruction_set_class)
+
+
+def split_code(line):
+    """
+        :param line: String with a line of a file
+        :return: Tuple (key, letters, args) with the code ej: G1, the sorted tuple of the parameter letters and the
+        number of other arguments (ej: the file name of M23) or None if the line has not a code
+    """
+    init_comment = line.find(';')
+    if init_comment != -1:
+        line = line[:init_comment]
+    line = line.strip()
+    if len(line) <= 1:
+        return None
+    tokens = line.split()
+    letters = []
+    args = 0
+    for token in tokens[1:]:
+        if PARAMS_RE.match(token):
+            letters.extend(letter.lower() for letter in PARAM_RE.findall(token))
+        else:
+            args += 1
+    return tokens[0], tuple(sorted(letters)), args
+
+
+class CapabilityMatrix():
+    """
+        Codes and parameters supported by several instruction sets compiled once, the dialects with the same
+        definition of a code share its check so a code is validated once for all of them.
+        A code is compatible if the strict clean_code of the dialect accepts it: supported, only valid parameters,
+        required parameters and arguments present. The parameters are checked with the regular expression and get of
+        the code itself over a line built from the signature
+    """
+
+    def __init__(self, instruction_sets=None):
+        """
+            :param instruction_sets: List of StandardInstructionSet instances or classes, default DIALECTS
+        """
+        instruction_sets = [instruction_set() if isinstance(instruction_set, six.class_types) else instruction_set
+                            for instruction_set in (instruction_sets or DIALECTS)]
+        self.names = [instruction_set.__class__.__name__ for instruction_set in instruction_sets]
+        self.codes = sorted(set(key for instruction_set in instruction_sets
+                                for key, code in instruction_set.code_supportered.items() if code is not None))
+        self.supported = numpy.zeros((len(self.codes), len(self.names)), dtype=bool)
+        self.specs = {}
+        for row, key in enumerate(self.codes):
+            groups = {}
+            for column, instruction_set in enumerate(instruction_sets):
+                code = instruction_set.code_supportered.get(key, None)
+                if code is None:
+                    continue
+                self.supported[row, column] = True
+                spec = self._spec(code)
+                if spec not in groups:
+                    groups[spec] = (code, [])
+                groups[spec][1].append(column)
+            self.specs[key] = [(spec, code, columns) for spec, (code, columns) in groups.items()]
+        self._cache = {}
+
+    def _spec(self, code):
+        if isinstance(code, ArgsMCode):
+            args = (code.required_args, not code.no_args)
+        else:
+            args = (0, False)
+        required_any = tuple(tuple(group) for group in getattr(code, 'required_any', []))
+        return (code.__class__, frozenset(code.valid_params), tuple(code.required_params), code.required_min,
+                required_any) + args
+
+    def _reason(self, spec, code, key, letters, args):
+        _, valid, _, _, _, required_args, accept_args = spec
+        for letter in letters:
+            if letter not in valid:
+                return 'Param %s not valid for %s' % (letter, key)
+        line = ' '.join([code.gcode] + ['%s0' % letter.upper() for letter in letters])
+        strict = code.strict
+        code.strict = True
+        try:
+            if isinstance(code, ArgsMCode):
+                code.get(*(['arg'] * args), **code.get_kwargs(line))
+            else:
+                code.get(**code.get_kwargs(line))
+        except GCodeException:
+            return code.error
+        finally:
+            code.strict = strict
+        if args < required_args:
+            return '%s argument requires for %s' % (required_args, key)
+        if args and not accept_args:
+            return 'Command %s do not accept any argument' % key
+        return None
+
+    def check(self, key, letters=(), args=0):
+        """
+            :param key: String code ej: G1
+            :param letters: Sorted tuple of the parameter letters ej: ('e', 'x')
+            :param args: Number of other arguments
+            :return: Tuple of (dialect index, reason) of the incompatible dialects, empty if all can run the code
+        """
+        signature = (key, letters, args)
+        if signature in self._cache:
+            return self._cache[signature]
+        failures = {}
+        specs = self.specs.get(key, [])
+        supported = set()
+        for spec, code, columns in specs:
+            supported.update(columns)
+            reason = self._reason(spec, code, key, letters, args)
+            if reason is not None:
+                for column in columns:
+                    failures[column] = reason
+        for column in range(len(self.names)):
+            if column not in supported:
+                failures[column] = 'Command not supported "%s"' % key
+        result = tuple(sorted(failures.items()))
+        self._cache[signature] = result
+        return result
+
+    def dialects_for(self, codes):
+        """
+            :param codes: Iterable with the codes used by a job ej: ['G0', 'G1', 'M104']
+            :return: List with the names of the dialects that support all the codes (parameters not checked)
+        """
+        mask = numpy.ones(len(self.names), dtype=bool)
+        index = dict((key, row) for row, key in enumerate(self.codes))
+        for code in codes:
+            if code not in index:
+                return []
+            mask &= self.supported[index[code]]
+        return [name for name, ok in zip(self.names, mask) if ok]
+
+
+class CompatibilityChecker():
+    """
+        Check which dialects can run a file reading it once, each different code signature (code, parameter
+        letters and arguments) is checked against the CapabilityMatrix only the first time it is found
+    """
+
+    def __init__(self, instruction_sets=None, max_lines=10):
+        """
+            :param instruction_sets: List of StandardInstructionSet instances or classes, default DIALECTS
+            :param max_lines: Number of incompatible lines reported for each dialect
+        """
+        self.matrix = CapabilityMatrix(instruction_sets)
+        self.max_lines = max_lines
+        self.reset()
+
+    def reset(self):
+        self.line_number = 0
+        self.counts = [0] * len(self.matrix.names)
+        self.lines = [[] for _ in self.matrix.names]
+
+    def add_line(self, line):
+        """
+            :param line: String with the next line of the file
+        """
+        self.line_number += 1
+        signature = split_code(line)
+        if signature is None:
+            return
+        for column, reason in self.matrix.check(*signature):
+            self.counts[column] += 1
+            if len(self.lines[column]) < self.max_lines:
+                self.lines[column].append((self.line_number, line.strip(), reason))
+
+    def report(self):
+        """
+            :return: Dict {dialect name: {'compatible', 'count', 'lines'}} with the number of incompatible lines and
+            the first ones as (line number, line, reason)
+        """
+        return dict((name, {
+            'compatible': not self.counts[column],
+            'count': self.counts[column],
+            'lines': list(self.lines[column]),
+        }) for column, name in enumerate(self.matrix.names))
+
+    def check_lines(self, lines):
+        """
+            :param lines: Iterable of lines
+            :return: Dict like report
+        """
+        self.reset()
+        for line in lines:
+            if isinstance(line, six.binary_type):
+                line = line.decode('utf-8')
+            self.add_line(line)
+        return self.report()
+
+    def check_file(self, file_obj):
+        """
+            :param file_obj: File object with the codes, it is rewound after the check
+            :return: Dict like report
+        """
+        try:
+            return self.check_lines(file_obj)
+        finally:
+            file_obj.seek(0)
+
+    def compatible(self, file_obj):
+        """
+            :param file_obj: File object with the codes
+            :return: List with the names of the dialects that can run the file
+        """
+        report = self.check_file(file_obj)
+        return [name for name in self.matrix.names if report[name]['compatible']]
@@ -0,0 +1,435 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import io
+import re
+
+import numpy
+
+from py2gcode.py2gcode import GCodeException
+from py2gcode.toolpath import ToolpathProcessor, AXES, MOTION_CODES, WORD_MASK, format_integers
+from py2gcode.transforms import MODAL_CODES
+
+HASH_BASE = numpy.uint64(1000003)
+OWORD_RE = re.compile('^[oO](\\d+)\\s+(sub|endsub|call|repeat|endrepeat)\\s*(?:\\[\\s*(\\d+)\\s*\\])?', re.IGNORECASE)
+
+
+def expand(codes):
+    """
+        Inline the O word subroutines and repeat loops written by PatternCompressor
+        :param codes: Iterable of codes
+        :return: List of codes without O words
+    """
+    subroutines = {}
+    main = []
+    body = None
+    for code in codes:
+        code = code.strip()
+        match = OWORD_RE.match(code)
+        if match and match.group(2).lower() == 'sub':
+            body = subroutines[match.group(1)] = []
+        elif match and match.group(2).lower() == 'endsub':
+            body = None
+        elif body is not None:
+            body.append(code)
+        else:
+            main.append(code)
+    return _expand(main, subroutines)
+
+
+def _expand(codes, subroutines):
+    result = []
+    loops = []
+    for code in codes:
+        match = OWORD_RE.match(code)
+        target = loops[-1][1] if loops else result
+        if not match:
+            target.append(code)
+            continue
+        word = match.group(2).lower()
+        if word == 'call':
+            if match.group(1) not in subroutines:
+                raise GCodeException('Subroutine o%s not defined' % match.group(1))
+            target.extend(_expand(subroutines[match.group(1)], subroutines))
+        elif word == 'repeat':
+            loops.append((int(match.group(3) or 0), []))
+        elif word == 'endrepeat':
+            count, body = loops.pop()
+            (loops[-1][1] if loops else result).extend(body * count)
+    return result
+
+
+class PatternCompressor():
+    """
+        Compress the repeated parts of a program (ej: a plate of identical parts) writing them once as O word
+        subroutines and repeat loops in relative mode (G91), for firmwares without them (SUBROUTINES = False) the
+        repeated parts are written as G91 relative blocks.
+        The moves are compared by their relative text so the same part at other place is a repetition, the matches
+        are found with a rolling hash of min_length codes extended code by code (LZ77 like parse)
+    """
+
+    def __init__(self, instruction_set, min_length=8, precision=4, max_candidates=8, first_oword=100):
+        """
+            :param instruction_set: StandardInstructionSet used for read and write the program, ej: LinuxCNCGCode
+            :param min_length: Minimum number of codes of a repetition
+            :param precision: Decimals of the coordinates
+            :param max_candidates: Previous positions compared for each hash
+            :param first_oword: Number of the first O word
+        """
+        self.instruction_set = instruction_set
+        self.min_length = min_length
+        self.precision = precision
+        self.max_candidates = max_candidates
+        self.first_oword = first_oword
+        self.reset()
+
+    def reset(self):
+        self.stats = {'lines_in': 0, 'bytes_in': 0, 'lines_out': 0, 'bytes_out': 0, 'subroutines': 0, 'calls': 0,
+                      'loops': 0}
+
+    def texts(self, blocks, codes):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :param codes: Dict {line: code} with the cleaned codes
+            :return: Tuple (absolute, relative, barrier) with the lists of the code of each block in absolute and
+            relative millimetres (None if not written) and the blocks that can not be repeated
+        """
+        unit = 10 ** self.precision
+        scaled = dict((key, numpy.rint(numpy.nan_to_num(blocks[key]) * unit).astype(numpy.int64))
+                      for key in AXES + tuple(axis + '0' for axis in AXES) + ('e', 'de', 'f', 'i', 'j', 'k'))
+        words = blocks['words']
+        given = dict((word, (words & WORD_MASK[word]) != 0) for word in WORD_MASK)
+        moving = numpy.isin(blocks['code'], MOTION_CODES)
+        absolute = blocks['code'].astype('U64')
+        relative = absolute.copy()
+        changed = {}
+        for axis in AXES:
+            changed[axis] = scaled[axis] != scaled[axis + '0']
+            absolute = self._add(absolute, moving & (given[axis] | changed[axis]), axis, scaled[axis])
+        delta = dict((axis, scaled[axis] - scaled[axis + '0']) for axis in AXES)
+        empty = ~(changed['x'] | changed['y'] | changed['z'] | (scaled['de'] != 0))
+        for axis in AXES:
+            relative = self._add(relative, moving & (changed[axis] | (empty & given[axis])), axis, delta[axis])
+        extruding = moving & (given['e'] | (scaled['de'] != 0))
+        absolute = self._add(absolute, extruding, 'e', scaled['e'])
+        relative = self._add(relative, extruding, 'e', scaled['de'])
+        for word in ('i', 'j', 'k'):
+            absolute = self._add(absolute, moving & given[word], word, scaled[word])
+            relative = self._add(relative, moving & given[word], word, scaled[word])
+        feed = moving & given['f'] & ~numpy.isnan(blocks['f'])
+        absolute = self._add(absolute, feed, 'f', scaled['f'])
+        relative = self._add(relative, feed, 'f', scaled['f'])
+
+        absolute = absolute.tolist()
+        relative = relative.tolist()
+        barrier = numpy.isin(blocks['code'], MODAL_CODES + ('G28', 'G92')).tolist()
+        for n, (gcode, line, move) in enumerate(zip(blocks['code'].tolist(), blocks['line'].tolist(),
+                                                    moving.tolist())):
+            if move:
+                continue
+            if gcode in MODAL_CODES:
+                text = None
+            elif gcode == 'G92':
+                text = gcode
+                for word in AXES + ('e',):
+                    if given[word][n]:
+                        text += ' %s%s' % (word.upper(), format_integers(scaled[word][n:n + 1], self.precision)[0])
+            else:
+                text = codes.get(line, None)
+            absolute[n] = relative[n] = text
+        return absolute, relative, barrier
+
+    def _add(self, texts, mask, word, values):
+        if not mask.any():
+            return texts
+        numbers = format_integers(numpy.where(mask, values, 0), self.precision)
+        return numpy.char.add(texts, numpy.where(mask, numpy.char.add(' %s' % word.upper(), numbers), ''))
+
+    def _ids(self, relative, barrier):
+        known = {}
+        ids = numpy.empty(len(relative), dtype=numpy.int64)
+        for n, (text, stop) in enumerate(zip(relative, barrier)):
+            if stop or text is None:
+                ids[n] = -1 - n
+            else:
+                ids[n] = known.setdefault(text, len(known))
+        return ids
+
+    def _hashes(self, ids):
+        count = len(ids) - self.min_length + 1
+        if count <= 0:
+            return []
+        values = ids.astype(numpy.uint64)
+        hashes = numpy.zeros(count, dtype=numpy.uint64)
+        with numpy.errstate(over='ignore'):
+            for n in range(self.min_length):
+                hashes = hashes * HASH_BASE + values[n:n + count]
+        return hashes.tolist()
+
+    def _match(self, ids, source, start):
+        """
+            :return: Number of equal codes from source and start, they can overlap (periodic repetition)
+        """
+        limit = len(ids) - start
+        length = 0
+        step = self.min_length
+        while length < limit:
+            size = min(step, limit - length)
+            equal = ids[source + length:source + length + size] == ids[start + length:start + length + size]
+            if not equal.all():
+                return length + int(numpy.argmin(equal))
+            length += size
+            step *= 2
+        return length
+
+    def parse(self, ids):
+        """
+            :param ids: Array with an integer for each code, equal codes have the same integer
+            :return: List of items ('literal', start, end), ('call', source, length, start) and
+            ('loop', start, unit, count) that cover the codes in order
+        """
+        hashes = self._hashes(ids)
+        table = {}
+        items = []
+
+        def insert(position):
+            if position < len(hashes):
+                bucket = table.setdefault(hashes[position], [])
+                bucket.append(position)
+                if len(bucket) > self.max_candidates:
+                    del bucket[0]
+
+        literal = 0
+        start = 0
+        total = len(ids)
+        while start < total:
+            best, source = 0, -1
+            if start < len(hashes):
+                for candidate in reversed(table.get(hashes[start], ())):
+                    length = self._match(ids, candidate, start)
+                    if length > best:
+                        best, source = length, candidate
+            if best < self.min_length:
+                insert(start)
+                start += 1
+                continue
+            if literal < start:
+                items.append(('literal', literal, start))
+            unit = start - source
+            if best >= unit:
+                count = best // unit
+                best = count * unit
+                first = start
+                if items and items[-1][0] == 'literal' and items[-1][2] == start and items[-1][1] <= source:
+                    _, begin, _ = items.pop()
+                    if begin < source:
+                        items.append(('literal', begin, source))
+                    count += 1
+                    first = source
+                items.append(('loop', first, unit, count))
+            else:
+                items.append(('call', source, best, start))
+            for position in range(start, start + best):
+                insert(position)
+            start += best
+            literal = start
+        if literal < total:
+            items.append(('literal', literal, total))
+        return self._first_calls(items)
+
+    def _first_calls(self, items):
+        """
+            Replace the first copy of the called codes by a call when it is inside a literal
+        """
+        sources = sorted(set((item[1], item[2]) for item in items if item[0] == 'call'))
+        result = []
+        for item in items:
+            if item[0] != 'literal':
+                result.append(item)
+                continue
+            position = item[1]
+            for source, length in sources:
+                if source < position or source + length > item[2]:
+                    continue
+                if position < source:
+                    result.append(('literal', position, source))
+                result.append(('call', source, length, source))
+                position = source + length
+            if position < item[2]:
+                result.append(('literal', position, item[2]))
+        return result
+
+    def header(self):
+        """
+            :return: List of codes that set the modes of the output
+        """
+        codes = [self.instruction_set.set_mm(), self.instruction_set.set_absolute()]
+        try:
+            codes.append(self.instruction_set.extruder_absolute())
+        except AttributeError:
+            pass
+        return [code for code in codes if code]
+
+    def compress_blocks(self, blocks, codes):
+        """
+            :param blocks: Array of BLOCK_DTYPE of the whole program
+            :param codes: Dict {line: code} with the cleaned codes
+            :return: List of codes
+        """
+        absolute, relative, barrier = self.texts(blocks, codes)
+        ids = self._ids(relative, barrier)
+        subroutines = {}
+        definitions = []
+        oword = [self.first_oword]
+        relative_mode = self.instruction_set.set_relative()
+        absolute_mode = self.instruction_set.set_absolute()
+
+        mode_size = len(relative_mode) + len(absolute_mode) + 2
+
+        def inline(item, out):
+            """
+                Write a repetition as a G91 block only if it is shorter than the absolute codes it replaces
+            """
+            if item[0] == 'call':
+                start, length = item[1], item[2]
+                block = [text for text in relative[start:start + length] if text is not None]
+                literal = [text for text in absolute[item[3]:item[3] + length] if text is not None]
+            else:
+                start, unit, count = item[1], item[2], item[3]
+                block = [text for text in relative[start:start + unit] if text is not None] * count
+                literal = [text for text in absolute[start:start + unit * count] if text is not None]
+            merge = bool(out) and out[-1] == absolute_mode
+            size = sum(len(text) + 1 for text in block) + (0 if merge else mode_size)
+            if size >= sum(len(text) + 1 for text in literal):
+                out.extend(literal)
+                return
+            if merge:
+                out.pop()
+            else:
+                out.append(relative_mode)
+            out.extend(block)
+            out.append(absolute_mode)
+
+        def render(base, items, out, nested):
+            """
+                Write the items of the codes from base, the repeated parts inside nested parts are compressed too
+            """
+            for item in items:
+                if item[0] == 'literal':
+                    texts = relative if nested else absolute
+                    out.extend(text for text in texts[base + item[1]:base + item[2]] if text is not None)
+                    continue
+                if not self.instruction_set.SUBROUTINES:
+                    inline(item, out)
+                    continue
+                if not nested:
+                    if out and out[-1] == absolute_mode:
+                        out.pop()
+                    else:
+                        out.append(relative_mode)
+                start, end = base + item[1], base + item[1] + item[2]
+                if item[0] == 'call':
+                    key = ids[start:end].tobytes()
+                    if key not in subroutines:
+                        body = []
+                        render(start, self.parse(ids[start:end]), body, True)
+                        subroutines[key] = oword[0]
+                        oword[0] += 1
+                        definitions.append('o%s sub' % subroutines[key])
+                        definitions.extend(body)
+                        definitions.append('o%s endsub' % subroutines[key])
+                    out.append('o%s call' % subroutines[key])
+                    self.stats['calls'] += 1
+                else:
+                    body = []
+                    render(start, self.parse(ids[start:end]), body, True)
+                    number = oword[0]
+                    oword[0] += 1
+                    out.append('o%s repeat [%s]' % (number, item[3]))
+                    out.extend(body)
+                    out.append('o%s endrepeat' % number)
+                    self.stats['loops'] += 1
+                if not nested:
+                    out.append(absolute_mode)
+
+        main = []
+        render(0, self.parse(ids), main, False)
+        self.stats['subroutines'] = len(subroutines)
+        return self.header() + definitions + main
+
+    def compress(self, file_obj, newline='\n'):
+        """
+            :param file_obj: File object with the program
+            :param newline: End of line used for count the bytes
+            :return: List of codes, the lines of the file if the compressed program is not shorter
+        """
+        self.reset()
+        lines = []
+        for line in file_obj:
+            lines.append(line.rstrip('\r\n'))
+            self.stats['lines_in'] += 1
+            self.stats['bytes_in'] += len(lines[-1]) + len(newline)
+        file_obj.seek(0)
+        processor = ToolpathProcessor(self.instruction_set, file_obj)
+        codes = {}
+        chunks = []
+        for blocks in processor.chunks():
+            codes.update(processor.codes)
+            chunks.append(blocks)
+        blocks = numpy.concatenate(chunks) if chunks else processor.resolve_rows([])
+        result = self.compress_blocks(blocks, codes)
+        size = sum(len(code) + len(newline) for code in result)
+        if size >= self.stats['bytes_in']:
+            result, size = lines, self.stats['bytes_in']
+            for key in ('subroutines', 'calls', 'loops'):
+                self.stats[key] = 0
+        self.stats['lines_out'] = len(result)
+        self.stats['bytes_out'] = size
+        return result
+
+    def verify(self, file_obj, codes):
+        """
+            :param file_obj: File object with the original program
+            :param codes: List of codes of compress
+            :return: Float with the maximum difference in mm of the positions after each move
+            :raise GCodeException: If the expanded program does not have the same moves
+        """
+        original = ToolpathProcessor(self.instruction_set, file_obj).toolpath()
+        text = ''.join('%s\n' % code for code in expand(codes))
+        compressed = ToolpathProcessor(self.instruction_set, io.StringIO(text)).toolpath()
+        original = original[numpy.isin(original['code'], MOTION_CODES)]
+        compressed = compressed[numpy.isin(compressed['code'], MOTION_CODES)]
+        if len(original) != len(compressed) or (original['code'] != compressed['code']).any():
+            raise GCodeException('The compressed program has other moves')
+        difference = 0.0
+        for axis in AXES:
+            if len(original):
+                difference = max(difference, float(numpy.abs(original[axis] - compressed[axis]).max()))
+        if difference > 10 ** -self.precision:
+            raise GCodeException('The compressed program differs %s mm' % difference)
+        return difference
+
+    def report(self):
+        """
+            :return: Dict with lines_in, lines_out, bytes_in, bytes_out, bytes_saved, ratio (out / in), subroutines,
+            calls and loops
+        """
+        report = dict(self.stats)
+        report['bytes_saved'] = report['bytes_in'] - report['bytes_out']
+        report['ratio'] = float(report['bytes_out']) / report['bytes_in'] if report['bytes_in'] else 1.0
+        return report
@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import numpy
+
+from py2gcode.toolpath import ToolpathProcessor, AXES, MOTION_CODES, extents, is_arc, segment_lengths
+
+SEGMENT_DTYPE = numpy.dtype([
+    ('line', numpy.int64), ('kind', numpy.int8),
+    ('x0', numpy.float64), ('y0', numpy.float64), ('z0', numpy.float64),
+    ('x', numpy.float64), ('y', numpy.float64), ('z', numpy.float64),
+    ('i', numpy.float64), ('j', numpy.float64), ('k', numpy.float64), ('de', numpy.float64),
+    ('length', numpy.float64), ('time', numpy.float64),
+])
+"""
+    Moves of a program: line of the code, kind: index of the code in MOTION_CODES * 2 + 1 if it extrudes,
+    start and end points in mm, arc centre offsets in mm (0 for the straight moves), extrusion in mm, length in mm
+    and time in seconds (length / feed rate)
+"""
+POINT_KEYS = ('x0', 'y0', 'z0', 'x', 'y', 'z')
+OFFSET_KEYS = ('i', 'j', 'k')
+HASH_SEED = numpy.uint64(1469598103934665603)
+HASH_PRIME = numpy.uint64(1099511628211)
+
+
+def segments(blocks, default_feed=1000.0):
+    """
+        :param blocks: Array of BLOCK_DTYPE
+        :param default_feed: Feed rate in mm/min while the file has not set one
+        :return: Tuple (Array of SEGMENT_DTYPE with the moves, dict of extents of the moves)
+    """
+    lengths = segment_lengths(blocks)
+    moving = numpy.isin(blocks['code'], MOTION_CODES) & (lengths > 0)
+    blocks = blocks[moving]
+    result = numpy.zeros(len(blocks), dtype=SEGMENT_DTYPE)
+    result['line'] = blocks['line']
+    kind = numpy.zeros(len(blocks), dtype=numpy.int8)
+    for n, code in enumerate(MOTION_CODES):
+        kind[blocks['code'] == code] = n * 2
+    result['kind'] = kind + (blocks['de'] > 0)
+    for key in POINT_KEYS:
+        result[key] = blocks[key]
+    arcs = is_arc(blocks)
+    for key in OFFSET_KEYS:
+        result[key] = numpy.where(arcs, blocks[key], 0.0)
+    result['de'] = blocks['de']
+    result['length'] = lengths[moving]
+    feed = numpy.where(numpy.isnan(blocks['f']), default_feed, blocks['f'])
+    result['time'] = result['length'] / (numpy.maximum(feed, 1e-9) / 60.0)
+    bounds = {}
+    if len(blocks):
+        for key, values in extents(blocks).items():
+            bounds[key] = float(values.min() if key.startswith('min') else values.max())
+    return result, bounds
+
+
+def row_hashes(rows):
+    """
+        :param rows: Array (N, K) of integers
+        :return: Array (N,) uint64 with a hash of each row
+    """
+    hashes = numpy.full(len(rows), HASH_SEED, dtype=numpy.uint64)
+    with numpy.errstate(over='ignore'):
+        for column in rows.T:
+            hashes = (hashes ^ column.astype(numpy.uint64)) * HASH_PRIME
+    return hashes
+
+
+def _exact_match(a, b):
+    """
+        Multiset match of two arrays of integer rows, the n-th copy of a row in a is paired with the n-th in b
+        :return: Tuple of arrays (index in a, index in b) of the pairs
+    """
+    hash_a, hash_b = row_hashes(a), row_hashes(b)
+    order_a = numpy.argsort(hash_a, kind='stable')
+    order_b = numpy.argsort(hash_b, kind='stable')
+    sorted_a, sorted_b = hash_a[order_a], hash_b[order_b]
+    rank = numpy.arange(len(a)) - numpy.searchsorted(sorted_a, sorted_a, side='left')
+    first = numpy.searchsorted(sorted_b, sorted_a, side='left')
+    count = numpy.searchsorted(sorted_b, sorted_a, side='right') - first
+    paired = rank < count
+    index_a = order_a[paired]
+    index_b = order_b[(first + rank)[paired]]
+    same = (a[index_a] == b[index_b]).all(axis=1)
+    return index_a[same], index_b[same]
+
+
+def _window_match(a, b, radius, accept, window=32):
+    """
+        Greedy match of the segments of a with the nearest candidates of b sorted by x0
+        :param a: Array of SEGMENT_DTYPE
+        :param b: Array of SEGMENT_DTYPE
+        :param radius: Maximum difference of x0 between a pair
+        :param accept: Function(a rows, b rows) that returns a boolean array with the valid pairs
+        :param window: Maximum number of candidates checked for each segment
+        :return: Tuple of arrays (index in a, index in b) of the pairs
+    """
+    if not len(a) or not len(b):
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    order = numpy.argsort(b['x0'], kind='stable')
+    x0 = b['x0'][order]
+    low = numpy.searchsorted(x0, a['x0'] - radius, side='left')
+    high = numpy.searchsorted(x0, a['x0'] + radius, side='right')
+    done = numpy.zeros(len(a), dtype=bool)
+    used = numpy.zeros(len(b), dtype=bool)
+    found_a, found_b = [], []
+    for step in range(min(window, int((high - low).max()))):
+        candidate = low + step
+        rows = numpy.flatnonzero(~done & (candidate < high))
+        if not len(rows):
+            break
+        other = order[candidate[rows]]
+        valid = ~used[other] & accept(a[rows], b[other])
+        rows, other = rows[valid], other[valid]
+        other, first = numpy.unique(other, return_index=True)
+        rows = rows[first]
+        done[rows] = True
+        used[other] = True
+        found_a.append(rows)
+        found_b.append(other)
+    if not found_a:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    return numpy.concatenate(found_a), numpy.concatenate(found_b)
+
+
+def line_ranges(lines, indices, limit=None):
+    """
+        :param lines: Array with the line of each segment
+        :param indices: Sorted array with the indices of the selected segments
+        :param limit: Maximum number of ranges, None for all
+        :return: List of (first line, last line, segments) of the runs of consecutive selected segments
+    """
+    if not len(indices):
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(indices) != 1) + 1
+    starts = numpy.concatenate(([0], breaks))
+    ends = numpy.concatenate((breaks, [len(indices)]))
+    if limit is not None:
+        starts, ends = starts[:limit], ends[:limit]
+    return [(int(lines[indices[start]]), int(lines[indices[end - 1]]), int(end - start))
+            for start, end in zip(starts, ends)]
+
+
+class ToolpathDiff():
+    """
+        Geometric diff of two programs: the moves of both are aligned by their start and end points with a
+        tolerance, independent of the format, precision and order of the codes.
+        Equal segments have the same kind, points and arc centre offsets within tolerance and the same extrusion
+        within e_tolerance.
+        The segments are matched first by hashes of their values rounded to the tolerances (twice, with the grid
+        moved half cell), the rest with a search of the nearest candidates. Unmatched segments with the same
+        displacement and a start closer than max_move are moved, the others are added (only in b) or removed (only
+        in a)
+    """
+
+    def __init__(self, tolerance=0.01, max_move=1.0, default_feed=1000.0, window=32, max_ranges=20,
+                 e_tolerance=0.001):
+        """
+            :param tolerance: Maximum difference in mm of the coordinates and arc centre offsets of equal segments
+            :param max_move: Maximum distance in mm of a moved segment
+            :param default_feed: Feed rate in mm/min while the file has not set one
+            :param window: Maximum number of candidates checked for each unmatched segment
+            :param max_ranges: Maximum number of line ranges reported by type
+            :param e_tolerance: Maximum difference in mm of the extrusion of equal segments
+        """
+        self.tolerance = tolerance
+        self.e_tolerance = e_tolerance
+        self.max_move = max_move
+        self.default_feed = default_feed
+        self.window = window
+        self.max_ranges = max_ranges
+        self.a = self.b = numpy.zeros(0, dtype=SEGMENT_DTYPE)
+        self.matched = self.added = self.removed = numpy.zeros(0, dtype=numpy.int64)
+        self.moved = numpy.zeros((0, 2), dtype=numpy.int64)
+
+    def _same_shape(self, a, b):
+        same = (a['kind'] == b['kind']) & (numpy.abs(a['de'] - b['de']) <= self.e_tolerance)
+        for key in OFFSET_KEYS:
+            same &= numpy.abs(a[key] - b[key]) <= self.tolerance
+        return same
+
+    def _same(self, a, b):
+        close = self._same_shape(a, b)
+        for key in POINT_KEYS:
+            close &= numpy.abs(a[key] - b[key]) <= self.tolerance
+        return close
+
+    def _shifted(self, a, b):
+        shifted = self._same_shape(a, b)
+        for axis in AXES:
+            shifted &= numpy.abs((a[axis] - a[axis + '0']) - (b[axis] - b[axis + '0'])) <= self.tolerance
+        distance = numpy.sqrt(sum((a[axis + '0'] - b[axis + '0']) ** 2 for axis in AXES))
+        return shifted & (distance <= self.max_move)
+
+    def align(self, a, b):
+        """
+            :param a: Array of SEGMENT_DTYPE of the first program
+            :param b: Array of SEGMENT_DTYPE of the second program
+            :return: Tuple of arrays (matched pairs (M, 2), moved pairs (K, 2), removed indices of a, added indices
+            of b)
+        """
+        def rounded(segments, shift):
+            points = numpy.column_stack([segments[key] for key in POINT_KEYS + OFFSET_KEYS])
+            return numpy.column_stack((segments['kind'], numpy.floor(points / self.tolerance + shift),
+                                       numpy.floor(segments['de'] / self.e_tolerance + shift))).astype(numpy.int64)
+
+        free_a = numpy.ones(len(a), dtype=bool)
+        free_b = numpy.ones(len(b), dtype=bool)
+        pairs = []
+        for shift in (0.0, 0.5):
+            rest_a, rest_b = numpy.flatnonzero(free_a), numpy.flatnonzero(free_b)
+            index_a, index_b = _exact_match(rounded(a[rest_a], shift), rounded(b[rest_b], shift))
+            index_a, index_b = rest_a[index_a], rest_b[index_b]
+            free_a[index_a] = False
+            free_b[index_b] = False
+            pairs.append(numpy.column_stack((index_a, index_b)))
+        moved = []
+        for accept, radius, result in ((self._same, self.tolerance, pairs), (self._shifted, self.max_move, moved)):
+            rest_a, rest_b = numpy.flatnonzero(free_a), numpy.flatnonzero(free_b)
+            found_a, found_b = _window_match(a[rest_a], b[rest_b], radius, accept, self.window)
+            found_a, found_b = rest_a[found_a], rest_b[found_b]
+            free_a[found_a] = False
+            free_b[found_b] = False
+            result.append(numpy.column_stack((found_a, found_b)))
+        matched = numpy.concatenate(pairs).astype(numpy.int64)
+        moved = moved[0].astype(numpy.int64)
+        return matched[numpy.argsort(matched[:, 0])], moved[numpy.argsort(moved[:, 0])], \
+            numpy.flatnonzero(free_a), numpy.flatnonzero(free_b)
+
+    def compare(self, blocks_a, blocks_b):
+        """
+            :param blocks_a: Array of BLOCK_DTYPE of the first program
+            :param blocks_b: Array of BLOCK_DTYPE of the second program
+            :return: Dict with identical (Boolean), segments (counts of a, b, matched, added, removed and moved),
+            distance (mm) and time (seconds) of a, b and change, extents of a and b, max_offset (mm of the moved
+            segments) and ranges with the (first line, last line, segments) of added (lines of b), removed and
+            moved (lines of a)
+        """
+        self.a, bounds_a = segments(blocks_a, self.default_feed)
+        self.b, bounds_b = segments(blocks_b, self.default_feed)
+        self.matched, self.moved, self.removed, self.added = self.align(self.a, self.b)
+        offset = 0.0
+        if len(self.moved):
+            first, second = self.a[self.moved[:, 0]], self.b[self.moved[:, 1]]
+            offset = float(numpy.sqrt(sum((first[axis + '0'] - second[axis + '0']) ** 2 for axis in AXES)).max())
+        totals = {}
+        for key in ('length', 'time'):
+            first, second = float(self.a[key].sum()), float(self.b[key].sum())
+            totals[key] = {'a': first, 'b': second, 'change': second - first}
+        return {
+            'identical': not (len(self.added) or len(self.removed) or len(self.moved)),
+            'segments': {
+                'a': len(self.a),
+                'b': len(self.b),
+                'matched': len(self.matched),
+                'added': len(self.added),
+                'removed': len(self.removed),
+                'moved': len(self.moved),
+            },
+            'distance': totals['length'],
+            'time': totals['time'],
+            'extents': {'a': bounds_a, 'b': bounds_b},
+            'max_offset': offset,
+            'ranges': {
+                'added': line_ranges(self.b['line'], self.added, self.max_ranges),
+                'removed': line_ranges(self.a['line'], self.removed, self.max_ranges),
+                'moved': line_ranges(self.a['line'], self.moved[:, 0], self.max_ranges),
+            },
+        }
+
+    def compare_files(self, instruction_set, file_a, file_b, instruction_set_b=None, cache=None, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet used for read the files
+            :param file_a: File object with the first program
+            :param file_b: File object with the second program
+            :param instruction_set_b: StandardInstructionSet for the second program, default instruction_set
+            :param cache: AnalysisCache used for reuse the toolpaths, None for read the files
+            :param kwargs: Parameters for ToolpathProcessor
+            :return: Dict like compare
+        """
+        toolpaths = []
+        for current_set, file_obj in ((instruction_set, file_a), (instruction_set_b or instruction_set, file_b)):
+            if cache is not None:
+                toolpaths.append(cache.toolpath(current_set, file_obj, **kwargs))
+            else:
+                toolpaths.append(ToolpathProcessor(current_set, file_obj, **kwargs).toolpath())
+        return self.compare(*toolpaths)
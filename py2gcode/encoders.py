@@ -0,0 +1,524 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import io
+import re
+from timeit import default_timer
+
+import numpy
+
+from py2gcode.py2gcode import GCodeException
+from py2gcode.toolpath import ToolpathProcessor, MOTION_CODES, AXES, format_number
+
+WORD_RE = re.compile('([A-Za-z])\\s*([-+]?\\d*\\.?\\d*)')
+
+
+def split_words(code):
+    """
+        :param code: String with a code ej: G1 X10 Y5
+        :return: List of (letter, value) ej: [('G', '1'), ('X', '10'), ('Y', '5')]
+    """
+    return [(letter.upper(), value) for letter, value in WORD_RE.findall(code)]
+
+
+class ModalEncoder():
+    """
+        Output encoder that removes the redundant words of the codes: unchanged coordinates, extrusion and feed
+        rate, repeated mode codes and, when the instruction set has MODAL_MOTION, the repeated motion G word.
+        The numbers are written with the given precision, in relative mode the rounding error is carried to the
+        next move so the positions never drift
+    """
+    STATE_CODES = ('G20', 'G21', 'G90', 'G91', 'M82', 'M83')
+
+    def __init__(self, instruction_set, precision=3, e_precision=5, separator=' ', newline='\n'):
+        """
+            :param instruction_set: StandardInstructionSet of the firmware that receives the codes
+            :param precision: Decimals for the coordinates and feed rates
+            :param e_precision: Decimals for the extrusion
+            :param separator: String between words, '' is accepted by most firmwares
+            :param newline: End of line used for count the bytes
+        """
+        self.instruction_set = instruction_set
+        self.precision = precision
+        self.e_precision = e_precision
+        self.separator = separator
+        self.newline = newline
+        self.reset()
+
+    def reset(self):
+        self.state = {'G20': None, 'G90': None, 'M82': None}
+        self.machine = dict((axis, None) for axis in AXES + ('e',))
+        self.error = dict((axis, 0.0) for axis in AXES + ('e',))
+        self.feed = None
+        self.motion = None
+        self.lines_in = 0
+        self.lines_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _format(self, axis, value):
+        return format_number(value, self.e_precision if axis == 'e' else self.precision)
+
+    def _forget(self):
+        for axis in self.machine:
+            self.machine[axis] = None
+            self.error[axis] = 0.0
+        self.feed = None
+
+    def _set_state(self, code):
+        group, value = {
+            'G20': ('G20', True), 'G21': ('G20', False), 'G90': ('G90', True), 'G91': ('G90', False),
+            'M82': ('M82', True), 'M83': ('M82', False),
+        }[code]
+        if self.state[group] == value:
+            return False
+        if group == 'G20' and self.state[group] is not None:
+            self._forget()
+        self.state[group] = value
+        if code in ('G90', 'G91'):
+            self.state['M82'] = value
+        return True
+
+    def _absolute(self, axis):
+        if axis == 'e':
+            return self.state['M82'] is not False
+        return self.state['G90'] is not False
+
+    def _encode_axis(self, axis, text, force=False):
+        """
+            :param force: Boolean for write the word even if it is redundant
+            :return: String with the value to write or None if the word is redundant
+        """
+        value = float(text)
+        if self._absolute(axis):
+            out = self._format(axis, value)
+            redundant = self.machine[axis] is not None and out == self._format(axis, self.machine[axis])
+            self.machine[axis] = float(out)
+            self.error[axis] = value - self.machine[axis]
+        else:
+            exact = value + self.error[axis]
+            out = self._format(axis, exact)
+            self.error[axis] = exact - float(out)
+            redundant = float(out) == 0
+            if self.machine[axis] is not None:
+                self.machine[axis] += float(out)
+        if redundant and not force:
+            return None
+        return out
+
+    def _join(self, words):
+        return self.separator.join('%s%s' % word for word in words)
+
+    def _encode(self, code):
+        words = split_words(code)
+        if not words:
+            return code
+        gcode = '%s%s' % words[0]
+        if gcode in self.STATE_CODES and len(words) == 1:
+            if not self._set_state(gcode):
+                return None
+            if gcode.startswith('G'):
+                self.motion = None
+            return code
+        if gcode == 'G28':
+            homed = [letter.lower() for letter, _ in words[1:] if letter.lower() in AXES] or list(AXES)
+            for axis in homed:
+                self.machine[axis] = 0.0
+                self.error[axis] = 0.0
+            self.motion = None
+            return code
+        if gcode == 'G92':
+            for letter, value in words[1:]:
+                axis = letter.lower()
+                if axis in self.machine and value:
+                    self.machine[axis] = float(value)
+                    self.error[axis] = 0.0
+            self.motion = None
+            return code
+        if gcode not in MOTION_CODES:
+            if words[0][0] == 'G':
+                self.motion = None
+            return code
+        arc = gcode in ('G2', 'G3')
+        out = []
+        for letter, value in words[1:]:
+            word = letter.lower()
+            if not value:
+                out.append((letter, value))
+            elif word in self.machine:
+                value = self._encode_axis(word, value, force=arc and word in ('x', 'y'))
+                if value is not None:
+                    out.append((letter, value))
+            elif word == 'f':
+                text = self._format(word, float(value))
+                if text != self.feed:
+                    self.feed = text
+                    out.append((letter, text))
+            elif word in ('i', 'j', 'k'):
+                out.append((letter, self._format(word, float(value))))
+            else:
+                out.append((letter, value))
+        if not out:
+            return None
+        if self.instruction_set.MODAL_MOTION and self.motion == gcode:
+            return self._join(out)
+        self.motion = gcode
+        return self._join([('G', gcode[1:])] + out)
+
+    def encode(self, code):
+        """
+            :param code: String with a code, ej: the result of a BaseCode or FileProcessor.read
+            :return: String with the compacted code or None if the whole code is redundant
+        """
+        code = code.strip()
+        self.lines_in += 1
+        self.bytes_in += len(code) + len(self.newline)
+        result = self._encode(code)
+        if result is not None:
+            self.lines_out += 1
+            self.bytes_out += len(result) + len(self.newline)
+        return result
+
+    def encode_lines(self, codes):
+        """
+            :param codes: Iterable of codes
+            :return: Generator of compacted codes ended with newline
+        """
+        for code in codes:
+            result = self.encode(code)
+            if result is not None:
+                yield result + self.newline
+
+    def _positions(self, codes):
+        """
+            :return: Array (len(codes) + 1, 5) with x, y, z, e and f after each code, row 0 is the start
+        """
+        text = ''.join('%s\n' % code for code in codes)
+        blocks = ToolpathProcessor(self.instruction_set, io.StringIO(text)).toolpath()
+        table = numpy.full((len(codes) + 1, 5), numpy.nan)
+        table[0, :4] = 0
+        for n, key in enumerate(AXES + ('e', 'f')):
+            table[blocks['line'], n] = blocks[key]
+        known = numpy.zeros(len(table), dtype=bool)
+        known[0] = True
+        known[blocks['line']] = True
+        index = numpy.where(known, numpy.arange(len(table)), 0)
+        numpy.maximum.accumulate(index, out=index)
+        return table[index]
+
+    def verify(self, codes):
+        """
+            Round trip check: the codes are encoded with a new encoder of the same configuration, both programs are
+            read with ToolpathProcessor and after each original code the position (x, y, z, e) and feed rate of the
+            encoded program have to be the same up to the rounding of the precision
+            :param codes: Iterable with the original codes
+            :return: Float with the maximum difference found
+            :raise GCodeException: If the geometry is not the same
+        """
+        codes = [code.strip() for code in codes]
+        encoder = ModalEncoder(self.instruction_set, precision=self.precision, e_precision=self.e_precision,
+                               separator=self.separator, newline=self.newline)
+        encoded = []
+        mapping = [0]
+        for code in codes:
+            result = encoder.encode(code)
+            if result is not None:
+                encoded.append(result)
+            mapping.append(len(encoded))
+        original = self._positions(codes)
+        decoded = self._positions(list(decode(encoded)))[mapping]
+        tolerance = numpy.array([0.5 * 10 ** -self.precision] * 3 + [0.5 * 10 ** -self.e_precision] +
+                                [0.5 * 10 ** -self.precision]) * (1 + 1e-6) + 1e-9
+        unknown = numpy.isnan(original) | numpy.isnan(decoded)
+        difference = numpy.where(unknown, 0, numpy.abs(original - decoded))
+        difference[numpy.isnan(original) != numpy.isnan(decoded)] = numpy.inf
+        wrong = difference > tolerance
+        if wrong.any():
+            line, column = numpy.argwhere(wrong)[0]
+            raise GCodeException('Encoded %s differs %s at line %s "%s"' % (
+                (AXES + ('e', 'f'))[column], difference[line, column], line, codes[line - 1]))
+        return float(difference.max()) if len(difference) else 0.0
+
+    def report(self):
+        """
+            :return: Dict with lines_in, lines_out, bytes_in, bytes_out, bytes_saved and ratio (out / in)
+        """
+        return {
+            'lines_in': self.lines_in,
+            'lines_out': self.lines_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_in - self.bytes_out,
+            'ratio': float(self.bytes_out) / self.bytes_in if self.bytes_in else 1.0,
+        }
+
+
+def decode(codes):
+    """
+        Expand compacted codes so they can be read by the processors: restore the modal motion G word and the spaces
+        :param codes: Iterable of codes
+        :return: Generator of codes
+    """
+    motion = None
+    for code in codes:
+        code = code.strip()
+        words = split_words(code)
+        if not words:
+            continue
+        letter = words[0][0]
+        if letter == 'G' and 'G%s' % words[0][1] in MOTION_CODES:
+            motion = 'G%s' % words[0][1]
+        elif letter == 'G':
+            motion = None
+        elif letter in 'XYZEFIJK' and motion is not None:
+            words.insert(0, ('G', motion[1:]))
+        if WORD_RE.sub('', code).strip():
+            yield code
+        else:
+            yield ' '.join('%s%s' % word for word in words)
+
+
+MEATPACK_SIGNAL = b'\xff\xff'
+MEATPACK_ENABLE = 0xFB
+MEATPACK_DISABLE = 0xFA
+MEATPACK_RESET = 0xF9
+MEATPACK_QUERY = 0xF8
+MEATPACK_NO_SPACES = 0xF7
+MEATPACK_SPACES = 0xF6
+MEATPACK_FULL = 0b1111
+MEATPACK_CHARS = '0123456789. \nGX'
+MEATPACK_TEXT_CODES = ('M23', 'M28', 'M30', 'M117', 'M118', 'M928')
+
+
+def meatpack_table(no_spaces=False):
+    """
+        :param no_spaces: Boolean for the no spaces mode, the space code is used by E
+        :return: Array of 256 uint8 with the 4 bits code of each byte, MEATPACK_FULL if it is not packed
+    """
+    table = numpy.full(256, MEATPACK_FULL, dtype=numpy.uint8)
+    for code, char in enumerate(MEATPACK_CHARS):
+        table[ord('E' if no_spaces and char == ' ' else char)] = code
+    return table
+
+
+class MeatPackEncoder():
+    """
+        Serial stream packing of Marlin (MeatPack): the most common characters of the codes (digits, '.', ' ' or E
+        without spaces, newline, G and X) are sent in 4 bits, two by byte, the first one in the low bits. A 0b1111
+        code means that the character follows as a full byte. The lines are packed with numpy over the whole
+        buffer, each line has an even number of characters (padded with a newline) so it can be sent alone.
+        The mode is changed with the signal 0xFF 0xFF and a command byte
+    """
+
+    def __init__(self, instruction_set=None, no_spaces=True):
+        """
+            :param instruction_set: StandardInstructionSet of the firmware, it has to have MEATPACK
+            :param no_spaces: Boolean for remove the spaces of the codes and pack E instead of space
+            :raise GCodeException: If the firmware can not read the packed stream
+        """
+        if instruction_set is not None and not instruction_set.MEATPACK:
+            raise GCodeException('%s does not support MeatPack' % instruction_set.__class__.__name__)
+        self.no_spaces = no_spaces
+        self.table = meatpack_table(no_spaces)
+        self.lines = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @staticmethod
+    def command(command):
+        """
+            :param command: Command byte ej: MEATPACK_ENABLE
+            :return: Bytes with the signal and the command
+        """
+        return MEATPACK_SIGNAL + bytearray([command])
+
+    def start(self):
+        """
+            :return: Bytes to send before the packed lines: enable packing and the spaces mode
+        """
+        spaces = MEATPACK_NO_SPACES if self.no_spaces else MEATPACK_SPACES
+        return self.command(MEATPACK_ENABLE) + self.command(spaces)
+
+    def stop(self):
+        """
+            :return: Bytes that return the firmware to plain text
+        """
+        return self.command(MEATPACK_DISABLE)
+
+    def prepare(self, line):
+        """
+            :param line: String with a code
+            :return: String with the text the firmware receives (without comment, spaces and with newline) or
+            None if the line has not a code, the line number and checksum have to be calculated over it
+        """
+        init_comment = line.find(';')
+        if init_comment != -1:
+            line = line[:init_comment]
+        line = line.strip()
+        if not line:
+            return None
+        if self.no_spaces and line.split(' ', 1)[0].upper() not in MEATPACK_TEXT_CODES:
+            line = line.replace(' ', '')
+        return line + '\n'
+
+    def pack(self, lines):
+        """
+            :param lines: Iterable of codes
+            :return: Bytes with the packed lines
+        """
+        texts = []
+        for line in lines:
+            text = self.prepare(line)
+            if text is None:
+                continue
+            self.bytes_in += len(text)
+            if len(text) % 2:
+                text += '\n'
+            texts.append(text)
+        self.lines += len(texts)
+        packed = self.pack_bytes(''.join(texts).encode('utf-8'))
+        self.bytes_out += len(packed)
+        return packed
+
+    def pack_bytes(self, data):
+        """
+            :param data: Bytes with an even number of characters
+            :return: Bytes packed
+        """
+        chars = numpy.frombuffer(data, dtype=numpy.uint8)
+        if len(chars) % 2:
+            raise GCodeException('MeatPack needs an even number of characters')
+        codes = self.table[chars]
+        first, second = codes[0::2], codes[1::2]
+        full_first = first == MEATPACK_FULL
+        full_second = second == MEATPACK_FULL
+        sizes = 1 + full_first.astype(numpy.int64) + full_second
+        starts = numpy.cumsum(sizes) - sizes
+        out = numpy.empty(int(sizes.sum()), dtype=numpy.uint8)
+        out[starts] = first | (second << 4)
+        out[starts[full_first] + 1] = chars[0::2][full_first]
+        out[starts[full_second] + 1 + full_first[full_second]] = chars[1::2][full_second]
+        return out.tobytes()
+
+    def report(self):
+        """
+            :return: Dict with lines, bytes_in, bytes_out and ratio (out / in)
+        """
+        return {
+            'lines': self.lines,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': float(self.bytes_out) / self.bytes_in if self.bytes_in else 1.0,
+        }
+
+
+class MeatPackDecoder():
+    """
+        Firmware side of MeatPack for check the packed streams, it follows the signals and modes like Marlin
+    """
+
+    def __init__(self):
+        self.packing = False
+        self.no_spaces = False
+        self.pending = bytearray()
+
+    def _chars(self):
+        chars = bytearray(MEATPACK_CHARS.encode('ascii'))
+        if self.no_spaces:
+            chars[MEATPACK_CHARS.index(' ')] = ord('E')
+        return chars
+
+    def _command(self, command):
+        if command == MEATPACK_ENABLE:
+            self.packing = True
+        elif command == MEATPACK_DISABLE:
+            self.packing = False
+        elif command == MEATPACK_NO_SPACES:
+            self.no_spaces = True
+        elif command == MEATPACK_SPACES:
+            self.no_spaces = False
+        elif command == MEATPACK_RESET:
+            self.packing = self.no_spaces = False
+
+    def decode(self, data):
+        """
+            :param data: Bytes received, a packed pair can be split between calls
+            :return: Bytes with the plain text
+        """
+        data = self.pending + bytearray(data)
+        self.pending = bytearray()
+        out = bytearray()
+        chars = self._chars()
+        size = len(data)
+        n = 0
+        while n < size:
+            byte = data[n]
+            if byte == 0xFF and n + 1 < size and data[n + 1] == 0xFF:
+                if n + 2 >= size:
+                    self.pending = data[n:]
+                    break
+                self._command(data[n + 2])
+                chars = self._chars()
+                n += 3
+                continue
+            if not self.packing:
+                out.append(byte)
+                n += 1
+                continue
+            low, high = byte & 0x0F, byte >> 4
+            needed = 1 + (low == MEATPACK_FULL) + (high == MEATPACK_FULL)
+            if n + needed > size or (byte == 0xFF and n + 1 >= size):
+                self.pending = data[n:]
+                break
+            n += 1
+            for code in (low, high):
+                if code == MEATPACK_FULL:
+                    out.append(data[n])
+                    n += 1
+                else:
+                    out.append(chars[code])
+        return bytes(out)
+
+
+def meatpack_benchmark(lines, baud=115200, bits_per_byte=10, no_spaces=True):
+    """
+        :param lines: List of codes
+        :param baud: Bits per second of the link
+        :param bits_per_byte: Bits sent for each byte, 10 for 8N1
+        :param no_spaces: Boolean for the no spaces mode
+        :return: Dict with lines, bytes_plain (the prepared text, without comments and spaces like the packed one),
+        bytes_packed, ratio, lines_per_second_plain and lines_per_second_packed (limited by the link) and
+        pack_seconds and pack_mb_per_second of the encoder
+    """
+    encoder = MeatPackEncoder(no_spaces=no_spaces)
+    start = default_timer()
+    packed = len(encoder.pack(lines))
+    seconds = default_timer() - start
+    plain = encoder.bytes_in
+    count = encoder.lines
+    link = float(baud) / bits_per_byte
+    return {
+        'lines': count,
+        'bytes_plain': plain,
+        'bytes_packed': packed,
+        'ratio': float(packed) / plain if plain else 1.0,
+        'lines_per_second_plain': count * link / plain if plain else 0.0,
+        'lines_per_second_packed': count * link / packed if packed else 0.0,
+        'pack_seconds': seconds,
+        'pack_mb_per_second': plain / seconds / 1e6 if seconds else 0.0,
+    }
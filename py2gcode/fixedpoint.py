@@ -0,0 +1,427 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import io
+from fractions import Fraction
+from timeit import default_timer
+
+import numpy
+
+from py2gcode.py2gcode import GCodeException
+from py2gcode.toolpath import ToolpathProcessor, BLOCK_DTYPE, CHUNK_SIZE, AXES, WORDS, WORD_MASK, MOTION_CODES, \
+    POSITION_CODES, format_integers, _forward_fill
+from py2gcode.transforms import MODAL_CODES, TransformProcessor
+
+DIGITS = 3
+E_DIGITS = 5
+UNKNOWN_FEED = -1
+INT32_LIMIT = (1 << 31) - 1
+
+RAW_FIXED_DTYPE = numpy.dtype([
+    ('line', numpy.int64), ('offset', numpy.int64), ('code', 'U8'), ('plane', numpy.int8),
+    ('abs', numpy.bool_), ('eabs', numpy.bool_), ('words', numpy.uint16),
+    ('x', numpy.int64), ('y', numpy.int64), ('z', numpy.int64), ('e', numpy.int64),
+    ('f', numpy.int64), ('i', numpy.int64), ('j', numpy.int64), ('k', numpy.int64),
+])
+"""Codes as read from the file in fixed point millimetres, the words not present (see words) are 0"""
+
+FIXED_DTYPE = numpy.dtype([
+    ('line', numpy.int64), ('offset', numpy.int64), ('code', 'U8'), ('plane', numpy.int8),
+    ('words', numpy.uint16),
+    ('x0', numpy.int32), ('y0', numpy.int32), ('z0', numpy.int32),
+    ('x', numpy.int32), ('y', numpy.int32), ('z', numpy.int32),
+    ('i', numpy.int32), ('j', numpy.int32), ('k', numpy.int32),
+    ('e', numpy.int64), ('de', numpy.int64), ('f', numpy.int32),
+])
+"""
+    BLOCK_DTYPE with the positions, offsets and feed rate as integers in units of 10 ** -digits mm (micrometres with
+    3 digits) and the extrusion in units of 10 ** -e_digits mm, f is UNKNOWN_FEED while the file has not set one
+"""
+
+
+def fixed_fraction(text, digits=DIGITS, inch=False):
+    """
+        Exact value of a decimal number in units of 10 ** -digits mm
+        :param text: String with the number ej: -12.5
+        :param digits: Decimals of the fixed point
+        :param inch: Boolean for convert from inches to millimetres (25.4 exactly)
+        :return: Tuple of integers (numerator, denominator), the denominator is positive
+    """
+    text = text.strip()
+    integer, _, fraction = text.lstrip('+-').partition('.')
+    numerator = int((integer + fraction) or '0') * 10 ** digits
+    denominator = 10 ** len(fraction)
+    if inch:
+        numerator *= 254
+        denominator *= 10
+    return (-numerator if text.startswith('-') else numerator), denominator
+
+
+def round_fraction(numerator, denominator):
+    """
+        :return: Integer nearest to numerator / denominator, rounding half away from zero
+    """
+    value = (abs(numerator) * 2 + denominator) // (denominator * 2)
+    return -value if numerator < 0 else value
+
+
+def parse_fixed(text, digits=DIGITS, inch=False):
+    """
+        Exact conversion of a decimal number without float, rounding half away from zero
+        :param text: String with the number ej: -12.5
+        :param digits: Decimals of the fixed point
+        :param inch: Boolean for convert from inches to millimetres (25.4 exactly)
+        :return: Integer with the number multiplied by 10 ** digits
+    """
+    return round_fraction(*fixed_fraction(text, digits, inch))
+
+
+def to_float(blocks, digits=DIGITS, e_digits=E_DIGITS):
+    """
+        :param blocks: Array of FIXED_DTYPE
+        :param digits: Decimals of the fixed point
+        :param e_digits: Decimals of the fixed point of the extrusion
+        :return: Array of BLOCK_DTYPE for the float functions (segment_lengths, extents, BufferAnalyzer...)
+    """
+    result = numpy.zeros(len(blocks), dtype=BLOCK_DTYPE)
+    for key in BLOCK_DTYPE.names:
+        if key in ('line', 'offset', 'code', 'plane', 'words'):
+            result[key] = blocks[key]
+        else:
+            result[key] = blocks[key] / float(10 ** (e_digits if key in ('e', 'de') else digits))
+    result['f'][blocks['f'] == UNKNOWN_FEED] = numpy.nan
+    return result
+
+
+def from_float(blocks, digits=DIGITS, e_digits=E_DIGITS):
+    """
+        :param blocks: Array of BLOCK_DTYPE
+        :param digits: Decimals of the fixed point
+        :param e_digits: Decimals of the fixed point of the extrusion
+        :return: Array of FIXED_DTYPE with the values rounded to the fixed point
+        :raise GCodeException: If a value does not fit in the integers
+    """
+    result = numpy.zeros(len(blocks), dtype=FIXED_DTYPE)
+    for key in FIXED_DTYPE.names:
+        if key in ('line', 'offset', 'code', 'plane', 'words'):
+            result[key] = blocks[key]
+            continue
+        values = numpy.rint(blocks[key] * 10 ** (e_digits if key in ('e', 'de') else digits))
+        if key == 'f':
+            values = numpy.where(numpy.isnan(values), UNKNOWN_FEED, values)
+        _check_range(values, key, blocks, result.dtype[key])
+        result[key] = values
+    return result
+
+
+def _check_range(values, key, blocks, dtype):
+    if dtype != numpy.int32 or not len(values):
+        return
+    wrong = numpy.abs(values) > INT32_LIMIT
+    if wrong.any():
+        raise GCodeException('%s at line %s does not fit in the fixed point integers' % (
+            key.upper(), blocks['line'][wrong][0]))
+
+
+def resolve_fixed(raw, position):
+    """
+        resolve with integers, the relative moves are added without rounding errors (FixedPointProcessor rounds
+        the relative words so their sum is the rounded exact position)
+        :param raw: Array of RAW_FIXED_DTYPE
+        :param position: Dict with x, y, z, e and f integers before the chunk, it is updated after it
+        :return: Array of FIXED_DTYPE
+        :raise GCodeException: If a position does not fit in the integers
+    """
+    blocks = numpy.zeros(len(raw), dtype=FIXED_DTYPE)
+    for key in ('line', 'offset', 'code', 'plane', 'words'):
+        blocks[key] = raw[key]
+    if len(raw) == 0:
+        return blocks
+    code = raw['code']
+    positional = numpy.isin(code, POSITION_CODES)
+    setting = code == 'G92'
+    homing = code == 'G28'
+    given = dict((word, (raw['words'] & WORD_MASK[word]) != 0) for word in WORDS)
+    specified = dict((axis, positional & given[axis]) for axis in AXES)
+    home_all = homing & ~(specified['x'] | specified['y'] | specified['z'])
+
+    for axis in AXES + ('e',):
+        value = raw[axis]
+        if axis == 'e':
+            present = positional & ~homing & given['e']
+            absolute = raw['eabs'] | setting
+            home = numpy.zeros(len(raw), dtype=bool)
+        else:
+            present = specified[axis]
+            absolute = raw['abs'] | setting
+            home = homing & (present | home_all)
+            value = numpy.where(home, 0, value)
+        is_set = (present & absolute) | home
+        cumulative = numpy.cumsum(numpy.where(present & ~is_set, value, 0))
+        end = _forward_fill(value - cumulative, is_set, position[axis]) + cumulative
+        start = numpy.empty_like(end)
+        start[0] = position[axis]
+        start[1:] = end[:-1]
+        position[axis] = int(end[-1])
+        if axis == 'e':
+            blocks['e'] = end
+            blocks['de'] = numpy.where(setting, 0, end - start)
+        else:
+            _check_range(end, axis, blocks, numpy.int32)
+            blocks[axis + '0'] = start
+            blocks[axis] = end
+
+    feed = numpy.isin(code, MOTION_CODES) & given['f']
+    blocks['f'] = _forward_fill(raw['f'], feed, position['f'])
+    position['f'] = int(blocks['f'][-1])
+    for offset in ('i', 'j', 'k', 'f'):
+        _check_range(raw[offset], offset, blocks, numpy.int32)
+    for offset in ('i', 'j', 'k'):
+        blocks[offset] = raw[offset]
+    return blocks
+
+
+def distance(blocks, digits=DIGITS):
+    """
+        :param blocks: Array of FIXED_DTYPE
+        :param digits: Decimals of the fixed point
+        :return: Dict {'x', 'y', 'z', 'total'} with the travelled mm of the straight moves, the axes are exact sums
+    """
+    moves = numpy.isin(blocks['code'], ('G0', 'G1', 'G28'))
+    deltas = dict((axis, (blocks[axis].astype(numpy.int64) - blocks[axis + '0'])[moves]) for axis in AXES)
+    unit = float(10 ** digits)
+    result = dict((axis, int(numpy.abs(deltas[axis]).sum()) / unit) for axis in AXES)
+    squares = sum(deltas[axis].astype(numpy.float64) ** 2 for axis in AXES)
+    result['total'] = float(numpy.sqrt(squares).sum()) / unit
+    return result
+
+
+def translate(blocks, x=0, y=0, z=0, digits=DIGITS):
+    """
+        Exact translation of a toolpath
+        :param blocks: Array of FIXED_DTYPE
+        :param x: Offset in mm (number or string, ej: '0.125')
+        :param digits: Decimals of the fixed point
+        :return: Array of FIXED_DTYPE
+    """
+    blocks = blocks.copy()
+    for axis, value in zip(AXES, (x, y, z)):
+        offset = parse_fixed(str(value), digits)
+        for key in (axis + '0', axis):
+            values = blocks[key].astype(numpy.int64) + offset
+            _check_range(values, axis, blocks, numpy.int32)
+            blocks[key] = values
+    return blocks
+
+
+def emit_fixed(blocks, codes=None, digits=DIGITS, e_digits=E_DIGITS, feed=UNKNOWN_FEED):
+    """
+        Write the moves in absolute millimetres without float formatting, a word is written when the code has it
+        or its value changes
+        :param blocks: Array of FIXED_DTYPE
+        :param codes: Dict {line: code} for the rows that are not moves, ej: ToolpathProcessor.codes
+        :param digits: Decimals of the fixed point
+        :param e_digits: Decimals of the fixed point of the extrusion
+        :param feed: Feed rate written before the blocks
+        :return: List of strings with the codes, the unit and mode codes are not written
+    """
+    codes = codes or {}
+    words = blocks['words']
+    given = dict((word, (words & WORD_MASK[word]) != 0) for word in WORDS)
+    setting = blocks['code'] == 'G92'
+    moving = numpy.isin(blocks['code'], MOTION_CODES)
+    texts = numpy.where(moving | setting, blocks['code'], '')
+    for axis in AXES:
+        write = given[axis] | (moving & (blocks[axis] != blocks[axis + '0']))
+        texts = _add_word(texts, write & (moving | setting), axis, blocks[axis], digits)
+    texts = _add_word(texts, (given['e'] | (blocks['de'] != 0)) & (moving | setting), 'e', blocks['e'], e_digits)
+    for offset in ('i', 'j', 'k'):
+        texts = _add_word(texts, given[offset] & moving, offset, blocks[offset], digits)
+    previous = numpy.empty(len(blocks), dtype=numpy.int64)
+    previous[:1] = feed
+    previous[1:] = blocks['f'][:-1]
+    write = moving & (blocks['f'] != UNKNOWN_FEED) & (given['f'] | (blocks['f'] != previous))
+    texts = _add_word(texts, write, 'f', blocks['f'], digits)
+    result = []
+    for gcode, line, text, move in zip(blocks['code'].tolist(), blocks['line'].tolist(), texts.tolist(),
+                                       (moving | setting).tolist()):
+        if move:
+            if text != gcode:
+                result.append(text)
+        elif gcode not in MODAL_CODES and line in codes:
+            result.append(codes[line])
+    return result
+
+
+def _add_word(texts, mask, word, values, digits):
+    if not mask.any():
+        return texts
+    numbers = format_integers(numpy.where(mask, values, 0), digits)
+    return numpy.char.add(texts, numpy.where(mask, numpy.char.add(' %s' % word.upper(), numbers), ''))
+
+
+class FixedPointProcessor(ToolpathProcessor):
+    """
+        ToolpathProcessor that keeps the coordinates, extrusion and feed rates as integers of 10 ** -digits mm
+        (FIXED_DTYPE) from the parse of the words to the output, so the relative moves and the inch conversion do not
+        drift and the output is formatted from integers.
+        The relative words carry the rounding remainder of the previous ones, so only the absolute position is
+        rounded to the fixed point.
+        Subclasses can change the geometry overriding transform_chunk like TransformProcessor
+    """
+
+    def __init__(self, instruction_set, file_obj, digits=DIGITS, e_digits=E_DIGITS, mm=True, absolute=True,
+                 extruder_absolute=True, chunk_size=CHUNK_SIZE, diagnostics=None):
+        """
+            :param instruction_set: StandardInstructionSet used for clean and write the codes
+            :param file_obj: File object with the codes
+            :param digits: Decimals of the fixed point, 3 for micrometres
+            :param e_digits: Decimals of the fixed point of the extrusion
+        """
+        self.digits = digits
+        self.e_digits = e_digits
+        ToolpathProcessor.__init__(self, instruction_set, file_obj, mm=mm, absolute=absolute,
+                                   extruder_absolute=extruder_absolute, chunk_size=chunk_size,
+                                   diagnostics=diagnostics)
+
+    def reset_state(self):
+        ToolpathProcessor.reset_state(self)
+        self.position = {'x': 0, 'y': 0, 'z': 0, 'e': 0, 'f': UNKNOWN_FEED}
+        self.last_feed = UNKNOWN_FEED
+        self.remainders = dict((word, 0) for word in AXES + ('e',))
+
+    def make_row(self, gcode, kwargs):
+        words = 0
+        values = []
+        positional = gcode in POSITION_CODES
+        if gcode == 'G28' and all(kwargs.get(axis, None) is None for axis in AXES):
+            for axis in AXES:
+                self.remainders[axis] = 0
+        for word in WORDS:
+            value = kwargs.get(word, None)
+            if value is None:
+                values.append(0)
+                continue
+            words |= WORD_MASK[word]
+            numerator, denominator = fixed_fraction(value, self.e_digits if word == 'e' else self.digits,
+                                                    inch=not self.mm)
+            if positional and word in self.remainders:
+                relative = gcode not in ('G28', 'G92') and not (self.extruder_abs if word == 'e' else self.abs)
+                if not relative:
+                    self.remainders[word] = 0
+                elif self.remainders[word] or numerator % denominator:
+                    exact = Fraction(numerator, denominator) + self.remainders[word]
+                    value = round_fraction(exact.numerator, exact.denominator)
+                    self.remainders[word] = exact - value
+                    values.append(value)
+                    continue
+            values.append(round_fraction(numerator, denominator))
+        return (self.line_number, self.offset, gcode, self.plane, self.abs, self.extruder_abs, words) + tuple(values)
+
+    def resolve_rows(self, rows):
+        return resolve_fixed(numpy.array(rows, dtype=RAW_FIXED_DTYPE), self.position)
+
+    def transform_chunk(self, blocks):
+        """
+            :param blocks: Array of FIXED_DTYPE
+            :return: Array of FIXED_DTYPE written by process
+        """
+        return blocks
+
+    def header(self):
+        """
+            :return: List of codes that set the modes of the output
+        """
+        codes = [self.instruction_set.set_mm(), self.instruction_set.set_absolute()]
+        try:
+            codes.append(self.instruction_set.extruder_absolute())
+        except AttributeError:
+            pass
+        return [code for code in codes if code]
+
+    def process(self, raise_exception=False):
+        """
+            Generator with the codes of the file in absolute millimetres
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: Generator of strings with the codes
+        """
+        for code in self.header():
+            yield "%s\r\n" % code
+        for blocks in self.chunks(raise_exception=raise_exception):
+            blocks = self.transform_chunk(blocks)
+            for gcode in numpy.unique(blocks['code']).tolist():
+                if gcode in MOTION_CODES and self.instruction_set.code_supportered.get(gcode, None) is None:
+                    raise GCodeException('%s is not supported by %s' % (
+                        gcode, self.instruction_set.__class__.__name__))
+            for code in emit_fixed(blocks, self.codes, self.digits, self.e_digits, self.last_feed):
+                yield "%s\r\n" % code
+            if len(blocks):
+                self.last_feed = int(blocks['f'][-1])
+
+    def write(self, file_obj, raise_exception=False):
+        """
+            :param file_obj: File object for write the codes
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+        """
+        for code in self.process(raise_exception=raise_exception):
+            file_obj.write(code)
+
+
+def benchmark(instruction_set, file_obj, digits=DIGITS, e_digits=E_DIGITS):
+    """
+        Compare the float path (ToolpathProcessor and TransformProcessor) with the fixed point path for a file
+        :param instruction_set: StandardInstructionSet used for read and write the codes
+        :param file_obj: File object with the codes
+        :param digits: Decimals of the fixed point and of the float output
+        :param e_digits: Decimals of the fixed point and of the float output of the extrusion
+        :return: Dict with the seconds of read (parse and resolve) and write (the whole rewrite) of 'float' and
+        'fixed', the maximum difference in mm between both toolpaths and round_trip, True if reading the fixed
+        output gives the same integers
+    """
+    timings = {}
+    start = default_timer()
+    floats = ToolpathProcessor(instruction_set, file_obj).toolpath()
+    timings['float'] = {'read': default_timer() - start}
+    start = default_timer()
+    TransformProcessor(instruction_set, file_obj, precision=digits, e_precision=e_digits).write(io.StringIO())
+    timings['float']['write'] = default_timer() - start
+
+    start = default_timer()
+    fixed = FixedPointProcessor(instruction_set, file_obj, digits=digits, e_digits=e_digits).toolpath()
+    timings['fixed'] = {'read': default_timer() - start}
+    output = io.StringIO()
+    start = default_timer()
+    FixedPointProcessor(instruction_set, file_obj, digits=digits, e_digits=e_digits).write(output)
+    timings['fixed']['write'] = default_timer() - start
+
+    output.seek(0)
+    again = FixedPointProcessor(instruction_set, output, digits=digits, e_digits=e_digits).toolpath()
+    moves = numpy.isin(fixed['code'], MOTION_CODES)
+    moves_again = numpy.isin(again['code'], MOTION_CODES)
+    round_trip = bool(moves.sum() == moves_again.sum())
+    if round_trip:
+        for key in AXES + ('e',):
+            round_trip &= bool(numpy.array_equal(fixed[key][moves], again[key][moves_again]))
+    converted = to_float(fixed, digits, e_digits)
+    difference = 0.0
+    for key in AXES + ('e',):
+        if len(floats):
+            difference = max(difference, float(numpy.abs(floats[key] - converted[key]).max()))
+    timings['max_difference'] = difference
+    timings['round_trip'] = round_trip
+    return timings
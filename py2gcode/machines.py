@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import numpy
+
+from py2gcode.processors import Diagnostics
+from py2gcode.py2gcode import GCodeException
+from py2gcode.toolpath import ToolpathProcessor, AXES, MOTION_CODES, PLANE_AXES, is_arc, extents, segment_lengths
+
+
+class MachineProfile():
+    """
+        Description of a machine: instruction set, travel limits, feed and acceleration limits, all in mm, mm/min and
+        mm/s^2
+    """
+
+    def __init__(self, name, instruction_set, travel=None, max_feed=None, max_acceleration=None, time_factor=1.0):
+        """
+            :param name: Name of the machine
+            :param instruction_set: StandardInstructionSet of the firmware
+            :param travel: Dict {axis: (min, max)} with the soft limits of the machine coordinates
+            :param max_feed: Dict {axis: mm/min} with the maximum feed rate of each axis
+            :param max_acceleration: Dict {axis: mm/s^2} with the maximum acceleration of each axis
+            :param time_factor: Real time of a job divided by its estimated time in this machine
+        """
+        self.name = name
+        self.instruction_set = instruction_set
+        self.travel = travel or {}
+        self.max_feed = max_feed or {}
+        self.max_acceleration = max_acceleration or {}
+        self.time_factor = time_factor
+
+    def span(self, axis):
+        """
+            :param axis: x, y or z
+            :return: Length in mm of the travel of the axis, infinite if unknown
+        """
+        if axis not in self.travel:
+            return float('inf')
+        low, high = self.travel[axis]
+        return high - low
+
+    def supports(self, code):
+        """
+            :param code: String code ej: G2
+            :return: True if the instruction set of the machine support the code
+        """
+        return self.instruction_set.code_supportered.get(code, None) is not None
+
+
+class RejectedDiagnostics(Diagnostics):
+    """
+        Diagnostics that also gives the lines rejected by the instruction set to a callback, so they can be reported
+        with the problems of the blocks
+    """
+
+    def __init__(self, callback, **kwargs):
+        """
+            :param callback: Function(line, code, reason) called for each error
+            :param kwargs: Parameters for Diagnostics
+        """
+        Diagnostics.__init__(self, **kwargs)
+        self.callback = callback
+
+    def add(self, kind, line, offset, code, reason):
+        Diagnostics.add(self, kind, line, offset, code, reason)
+        if kind == 'error':
+            self.callback(line, code, reason)
+
+
+class EnvelopeChecker():
+    """
+        Pre flight check of a toolpath (array of BLOCK_DTYPE) against a MachineProfile: travel limits (arcs
+        included), feed rate of each axis and supported codes
+    """
+
+    def __init__(self, profile, max_lines=10, check_rapid=False):
+        """
+            :param profile: MachineProfile
+            :param max_lines: Number of offending line numbers reported for each problem
+            :param check_rapid: Boolean for check the feed rate of the G0 moves too
+        """
+        self.profile = profile
+        self.max_lines = max_lines
+        self.check_rapid = check_rapid
+
+    def _add_problem(self, problems, reason, axis, count, lines, worst=None):
+        key = (reason, axis)
+        if key not in problems:
+            problems[key] = {'reason': reason, 'axis': axis, 'count': 0, 'first_line': None, 'lines': [],
+                             'worst': None}
+        problem = problems[key]
+        problem['count'] += count
+        first = int(min(lines))
+        if problem['first_line'] is None or first < problem['first_line']:
+            problem['first_line'] = first
+        problem['lines'] = (problem['lines'] + [int(line) for line in lines[:self.max_lines]])[:self.max_lines]
+        if worst is not None and (problem['worst'] is None or worst > problem['worst']):
+            problem['worst'] = worst
+
+    def _problem(self, problems, blocks, mask, reason, axis=None, values=None):
+        if not mask.any():
+            return
+        worst = float(numpy.max(values[mask])) if values is not None else None
+        self._add_problem(problems, reason, axis, int(mask.sum()), blocks['line'][mask], worst)
+
+    def _rejected(self, problems, line, code, reason):
+        """
+            Problem of a line rejected by the instruction set used for read the file
+        """
+        word = code.split(' ')[0].upper()
+        if reason == 'not supported':
+            reason = 'unsupported code %s' % word
+        else:
+            reason = 'invalid code %s' % word
+        self._add_problem(problems, reason, None, 1, [line])
+
+    def _check(self, blocks, problems):
+        codes = numpy.unique(blocks['code'])
+        for code in codes:
+            if not self.profile.supports(str(code)):
+                self._problem(problems, blocks, blocks['code'] == code, 'unsupported code %s' % code)
+
+        moves = numpy.isin(blocks['code'], MOTION_CODES + ('G28',))
+        bounds = extents(blocks)
+        for axis in AXES:
+            if axis not in self.profile.travel:
+                continue
+            low, high = self.profile.travel[axis]
+            self._problem(problems, blocks, moves & (bounds['min_' + axis] < low), 'under travel', axis,
+                          low - bounds['min_' + axis])
+            self._problem(problems, blocks, moves & (bounds['max_' + axis] > high), 'over travel', axis,
+                          bounds['max_' + axis] - high)
+
+        feed_codes = MOTION_CODES if self.check_rapid else ('G1', 'G2', 'G3')
+        feeding = numpy.isin(blocks['code'], feed_codes) & ~numpy.isnan(blocks['f'])
+        lengths = segment_lengths(blocks)
+        feeding &= lengths > 0
+        arcs = is_arc(blocks)
+        for axis in AXES:
+            if axis not in self.profile.max_feed:
+                continue
+            share = numpy.abs(blocks[axis] - blocks[axis + '0']) / numpy.where(lengths > 0, lengths, 1)
+            planes = [plane for plane in PLANE_AXES if axis in PLANE_AXES[plane][:2]]
+            share = numpy.where(arcs & numpy.isin(blocks['plane'], planes), 1.0, share)
+            speed = blocks['f'] * share
+            self._problem(problems, blocks, feeding & (speed > self.profile.max_feed[axis]), 'over feed', axis,
+                          speed - self.profile.max_feed[axis])
+
+    def check(self, blocks):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :return: List of dicts {'reason', 'axis', 'count', 'first_line', 'lines', 'worst'} with the problems
+            sorted by first_line, empty if all is ok. lines has at most max_lines of the lines
+        """
+        problems = {}
+        self._check(blocks, problems)
+        return sorted(problems.values(), key=lambda problem: problem['first_line'])
+
+    def check_file(self, instruction_set, file_obj, stop_on_error=False, **kwargs):
+        """
+            Check a file chunk by chunk, the lines rejected by instruction_set are problems too (unsupported code or
+            invalid code).
+            Every line is parsed by the instruction set like in a full read, so the cost is the one of
+            ToolpathProcessor.chunks plus the checks, it is not faster than reading the toolpath
+            :param instruction_set: StandardInstructionSet used for read the file
+            :param file_obj: File object with the codes
+            :param stop_on_error: Boolean for stop at the first chunk with problems
+            :param kwargs: Parameters for ToolpathProcessor, diagnostics is replaced by a RejectedDiagnostics
+            :return: List of problems like check
+        """
+        problems = {}
+        kwargs['diagnostics'] = RejectedDiagnostics(lambda line, code, reason: self._rejected(problems, line, code,
+                                                                                              reason))
+        processor = ToolpathProcessor(instruction_set, file_obj, **kwargs)
+        for blocks in processor.chunks():
+            self._check(blocks, problems)
+            if stop_on_error and problems:
+                file_obj.seek(0)
+                break
+        return sorted(problems.values(), key=lambda problem: problem['first_line'])
+
+    def validate(self, blocks):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :raise GCodeException: With the first problem if the toolpath can not run in the machine
+        """
+        problems = self.check(blocks)
+        if problems:
+            problem = problems[0]
+            raise GCodeException('%s %s at lines %s (%s blocks) for %s' % (
+                problem['reason'], problem['axis'] or '', problem['lines'] or [problem['first_line']], problem['count'],
+                self.profile.name))
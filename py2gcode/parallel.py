@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import multiprocessing
+import re
+from timeit import default_timer
+
+import six
+
+from py2gcode.py2gcode import GCodeException
+
+FEED_RE = re.compile('\\s[Ff](\\-?\\d+\\.?\\d*)')
+UNITS_CODES = {'G20': False, 'G21': True}
+DISTANCE_CODES = {'G90': True, 'G91': False}
+FEED_MOTION_CODES = ('G1', 'G2', 'G3')
+
+_worker_instruction_set = None
+
+
+def fragment_codes(result, instruction_set):
+    """
+        :param result: Value returned by a feature function: Toolpath (or any object with codes(instruction_set)),
+        string with lines or iterable of codes
+        :param instruction_set: StandardInstructionSet of the worker
+        :return: List of strings with the codes
+    """
+    if hasattr(result, 'codes'):
+        result = result.codes(instruction_set)
+    if isinstance(result, six.string_types):
+        result = result.splitlines()
+    return [six.text_type(code).strip() for code in result if code is not None and six.text_type(code).strip()]
+
+
+def reconcile(codes, mm=True, absolute=True):
+    """
+        Modal state of a fragment generated from the base state, the mode codes that do not change it are removed
+        :param codes: List of strings with the codes of the fragment
+        :param mm: Boolean, units of the base state
+        :param absolute: Boolean, distance mode of the base state
+        :return: Dict with codes, needs_feed (True if a feed move comes before any F word), feed_index (index of that
+        move or None), inherited (True if the units did not change before it, so the feed of the previous fragment
+        applies), first_feed (index, value) of the F word that sets the feed before any feed move and units change
+        or None, and the state after the fragment: mm, absolute, feed (value of the last F word or None) and
+        feed_reset (True if the units changed after it)
+    """
+    result = []
+    first_feed = None
+    needs_feed = False
+    feed_index = None
+    searching = True
+    inherited = True
+    feed = None
+    reset = False
+    for code in codes:
+        key = code.split(' ', 1)[0].upper()
+        if key in UNITS_CODES:
+            if UNITS_CODES[key] == mm:
+                continue
+            mm = UNITS_CODES[key]
+            feed = None
+            reset = True
+            if searching:
+                inherited = False
+        elif key in DISTANCE_CODES:
+            if DISTANCE_CODES[key] == absolute:
+                continue
+            absolute = DISTANCE_CODES[key]
+        init_comment = code.find(';')
+        match = FEED_RE.search(code if init_comment == -1 else code[:init_comment])
+        if match:
+            feed = match.group(1)
+            reset = False
+            if searching and inherited:
+                first_feed = (len(result), feed)
+            searching = False
+        elif key in FEED_MOTION_CODES and searching:
+            needs_feed = True
+            feed_index = len(result)
+            searching = False
+        result.append(code)
+    return {
+        'codes': result,
+        'needs_feed': needs_feed,
+        'feed_index': feed_index,
+        'inherited': inherited,
+        'first_feed': first_feed,
+        'mm': mm,
+        'absolute': absolute,
+        'feed': feed,
+        'feed_reset': reset,
+    }
+
+
+def _init_worker(instruction_set):
+    global _worker_instruction_set
+    _worker_instruction_set = instruction_set
+
+
+def _emit(task):
+    """
+        :param task: Tuple (function, args, kwargs, mm, absolute)
+        :return: Dict of reconcile with the codes joined in head and tail texts around first (the code with the
+        first feed, the feed move that needs one or None), so the results are sent between processes as few strings
+    """
+    function, args, kwargs, mm, absolute = task
+    codes = fragment_codes(function(_worker_instruction_set, *args, **kwargs), _worker_instruction_set)
+    fragment = reconcile(codes, mm=mm, absolute=absolute)
+    codes = fragment.pop('codes')
+    if fragment['first_feed'] is not None:
+        index = fragment['first_feed'][0]
+    elif fragment['needs_feed']:
+        index = fragment['feed_index']
+    else:
+        index = len(codes)
+    fragment['head'] = ''.join("%s\r\n" % code for code in codes[:index])
+    fragment['first'] = codes[index] if index < len(codes) else None
+    fragment['tail'] = ''.join("%s\r\n" % code for code in codes[index + 1:])
+    return fragment
+
+
+def _same_feed(feed, other):
+    if feed is None or other is None:
+        return False
+    return float(feed) == float(other)
+
+
+class ParallelGenerator():
+    """
+        Generate the codes of independent feature blocks in a process pool and merge them in the order they were
+        added, the output is the same as the serial generation.
+        Each block is a function(instruction_set, *args, **kwargs) defined at module level (it is pickled) that
+        returns a Toolpath or the codes, each worker has its own copy of the instruction set.
+        The blocks are generated from the base state (units and distance mode of the header), between blocks the
+        modes left by the previous one are restored and the redundant mode codes and feed words are removed
+    """
+
+    def __init__(self, instruction_set, processes=None, chunk_size=1, mm=True, absolute=True, header=True):
+        """
+            :param instruction_set: StandardInstructionSet used for write the codes
+            :param processes: Number of worker processes, default the number of cores, 1 for generate in this process
+            :param chunk_size: Blocks sent together to a worker, higher for many small blocks
+            :param mm: Boolean, units of the base state (G21 or G20)
+            :param absolute: Boolean, distance mode of the base state (G90 or G91)
+            :param header: Boolean for start the output with the codes of the base state
+        """
+        self.instruction_set = instruction_set
+        self.processes = processes if processes is not None else multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.mm = mm
+        self.absolute = absolute
+        self.header = header
+        self.blocks = []
+
+    def add(self, function, *args, **kwargs):
+        """
+            :param function: Function(instruction_set, *args, **kwargs) that returns the codes of the block
+            :param args: Arguments of the function
+            :param kwargs: Keyword arguments of the function, feed is the feed rate set before the first feed move
+            of the block if it comes before any F word, in the units of the block at that move (mm/min or
+            inches/min)
+            :return: Index of the block
+        """
+        feed = kwargs.pop('feed', None)
+        self.blocks.append((function, args, kwargs, feed))
+        return len(self.blocks) - 1
+
+    def _mode_code(self, mm=None, absolute=None):
+        if mm is not None:
+            name = 'set_mm' if mm else 'set_inches'
+        else:
+            name = 'set_absolute' if absolute else 'set_relative'
+        try:
+            return getattr(self.instruction_set, name)()
+        except AttributeError:
+            raise GCodeException('%s not supported by %s' % (name, self.instruction_set.__class__.__name__))
+
+    def _feed_code(self, feed):
+        return self.instruction_set.line_normal(f=feed)
+
+    def fragments(self):
+        """
+            :return: Generator of the reconcile dicts of the blocks in order
+        """
+        tasks = [(function, args, kwargs, self.mm, self.absolute) for function, args, kwargs, _ in self.blocks]
+        if self.processes <= 1 or len(tasks) <= 1:
+            _init_worker(self.instruction_set)
+            try:
+                for task in tasks:
+                    yield _emit(task)
+            finally:
+                _init_worker(None)
+            return
+        pool = multiprocessing.Pool(min(self.processes, len(tasks)), initializer=_init_worker,
+                                    initargs=(self.instruction_set,))
+        try:
+            for fragment in pool.imap(_emit, tasks, self.chunk_size):
+                yield fragment
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def process(self):
+        """
+            Generator with the merged codes
+            :return: Generator of strings with one or more codes ended by new line
+        """
+        mm, absolute, feed = self.mm, self.absolute, None
+        if self.header:
+            yield "%s\r\n" % self._mode_code(mm=mm)
+            yield "%s\r\n" % self._mode_code(absolute=absolute)
+        for (_, _, _, block_feed), fragment in zip(self.blocks, self.fragments()):
+            if mm != self.mm:
+                yield "%s\r\n" % self._mode_code(mm=self.mm)
+                feed = None
+            if absolute != self.absolute:
+                yield "%s\r\n" % self._mode_code(absolute=self.absolute)
+            yield fragment['head']
+            if not fragment['inherited']:
+                feed = None
+            if fragment['needs_feed'] and block_feed is not None and not _same_feed(feed, block_feed):
+                feed = six.text_type(block_feed)
+                yield "%s\r\n" % self._feed_code(block_feed)
+            first = fragment['first']
+            if first is not None:
+                if fragment['first_feed'] is not None and _same_feed(feed, fragment['first_feed'][1]):
+                    first = FEED_RE.sub('', first, count=1)
+                if ' ' in first.strip():
+                    yield "%s\r\n" % first
+            yield fragment['tail']
+            mm, absolute = fragment['mm'], fragment['absolute']
+            if fragment['feed'] is not None:
+                feed = fragment['feed']
+            elif fragment['feed_reset']:
+                feed = None
+
+    def write(self, file_obj):
+        """
+            :param file_obj: File object for write the codes
+        """
+        for code in self.process():
+            file_obj.write(code)
+
+
+def benchmark(instruction_set, blocks, processes=None, chunk_size=1):
+    """
+        :param instruction_set: StandardInstructionSet used for write the codes
+        :param blocks: List of (function, args) or (function, args, kwargs) of the blocks
+        :param processes: Number of worker processes, default the number of cores
+        :param chunk_size: Blocks sent together to a worker
+        :return: Dict with processes, bytes, serial and parallel (seconds), speedup and same (Boolean, True if both
+        outputs are equal)
+    """
+    outputs = []
+    times = []
+    used = None
+    for count in (1, processes):
+        generator = ParallelGenerator(instruction_set, processes=count, chunk_size=chunk_size)
+        for block in blocks:
+            generator.add(block[0], *block[1], **(block[2] if len(block) > 2 else {}))
+        used = generator.processes
+        start = default_timer()
+        outputs.append(''.join(generator.process()))
+        times.append(default_timer() - start)
+    serial, parallel = times
+    return {
+        'processes': used,
+        'bytes': len(outputs[0]),
+        'serial': serial,
+        'parallel': parallel,
+        'speedup': serial / parallel if parallel else 0.0,
+        'same': outputs[0] == outputs[1],
+    }
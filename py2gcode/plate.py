@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import numpy
+
+from py2gcode.processors import DistanceProcessor, SizeProcessor
+from py2gcode.py2gcode import GCodeException
+from py2gcode.toolpath import format_number
+from py2gcode.transforms import AffineTransform, TransformProcessor
+
+WORK_CODES = ('G1', 'G2', 'G3')
+STRIP_START = ('G28', 'G29')
+"""Codes removed from the start sequence of the jobs after the first one"""
+STRIP_END = ('G28', 'M2', 'M30', 'M18', 'M84', 'M104', 'M140', 'M106', 'M107')
+"""Codes removed from the end sequence of the jobs before the last one"""
+
+
+class JobScanner(SizeProcessor):
+    """
+        SizeProcessor that only measures the work moves (G1, G2 and G3 with E on printers), so the homing and
+        parking moves of the start and end sequences are not in the bounding box.
+        The start sequence are the lines before the first work move and the end sequence the lines after the last
+    """
+
+    def __init__(self, instruction_set, file_path, mm=True, absolute=True, diagnostics=None):
+        SizeProcessor.__init__(self, instruction_set, file_path, mm=mm, absolute=absolute, diagnostics=diagnostics)
+        self.extruder = 'e' in getattr(instruction_set, 'G1').valid_params
+        self.first_line = None
+        self.last_line = None
+        self.start = None
+
+    def on_start(self):
+        SizeProcessor.on_start(self)
+        self.first_line = None
+        self.last_line = None
+        self.start = None
+
+    def callback_manager(self, gcode=None, **kwargs):
+        if gcode not in WORK_CODES or (self.extruder and kwargs.get('e', None) is None):
+            DistanceProcessor.callback_manager(self, gcode=gcode, **kwargs)
+            return
+        if self.first_line is None:
+            self.first_line = self.line_number
+            self.start = dict(self.last_abs_pos)
+            for axis in ('x', 'y'):
+                self.orig[axis] = self.size[axis] = self.last_abs_pos[axis]
+        self.last_line = self.line_number
+        SizeProcessor.callback_manager(self, gcode=gcode, **kwargs)
+
+    def scan(self, raise_exception=False):
+        """
+            Read the file and rewind it
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: Dict with orig (x, y), size (x, y, z max) first_line, last_line and start (position before the
+            first work move) or None if the file has not work moves
+        """
+        try:
+            for _ in self.read(raise_exception=raise_exception):
+                pass
+        finally:
+            self.file.seek(0)
+        if self.first_line is None:
+            return None
+        return {
+            'orig': dict(self.orig),
+            'size': dict(self.size),
+            'first_line': self.first_line,
+            'last_line': self.last_line,
+            'start': self.start,
+        }
+
+
+class PlateMerger():
+    """
+        Merge several jobs in one program printed one after the other on the same bed. The jobs are placed in rows
+        by their bounding boxes (JobScanner) and each one is streamed through a TransformProcessor that translates it,
+        so the memory used does not depend on the size of the files.
+        All the jobs are written in millimetres, absolute coordinates and absolute extruder. Between jobs the tool
+        goes up over the highest job already done, moves to the start of the next one and resets E (G92 E0); the
+        STRIP_START codes of the start sequences after the first job and the STRIP_END codes of the end sequences
+        before the last job are removed
+    """
+
+    def __init__(self, instruction_set, bed_size, bed_origin=(0, 0), spacing=5.0, clearance=5.0,
+                 strip_start=STRIP_START, strip_end=STRIP_END, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet used for write the program
+            :param bed_size: (x, y) size in mm of the bed
+            :param bed_origin: (x, y) of the corner of the bed
+            :param spacing: Distance in mm between jobs
+            :param clearance: Distance in mm over the highest job for the moves between jobs
+            :param strip_start: Codes removed from the start sequence of the jobs after the first one
+            :param strip_end: Codes removed from the end sequence of the jobs before the last one
+            :param kwargs: Parameters for TransformProcessor, ej: precision=3
+        """
+        self.instruction_set = instruction_set
+        self.bed_size = numpy.asarray(bed_size, dtype=numpy.float64)
+        self.bed_origin = numpy.asarray(bed_origin, dtype=numpy.float64)
+        self.spacing = spacing
+        self.clearance = clearance
+        self.strip_start = strip_start
+        self.strip_end = strip_end
+        self.kwargs = kwargs
+        self.jobs = []
+
+    def add(self, file_obj, instruction_set=None, position=None, mm=True, absolute=True):
+        """
+            :param file_obj: File object with the job, it is read twice (scan and merge)
+            :param instruction_set: StandardInstructionSet used for read the job, default the one of the merger
+            :param position: (x, y) of the corner of the job on the bed, None for place it automatically
+            :param mm: Boolean units at start of the job
+            :param absolute: Boolean mode at start of the job
+            :return: Index of the job
+            :raise GCodeException: If the job has not work moves
+        """
+        instruction_set = instruction_set or self.instruction_set
+        scan = JobScanner(instruction_set, file_obj, mm=mm, absolute=absolute).scan()
+        if scan is None:
+            raise GCodeException('Job %s has not work moves' % len(self.jobs))
+        scan.update({
+            'file': file_obj,
+            'instruction_set': instruction_set,
+            'position': position,
+            'mm': mm,
+            'absolute': absolute,
+        })
+        self.jobs.append(scan)
+        return len(self.jobs) - 1
+
+    def place(self):
+        """
+            Place the jobs without position left to right in rows from bed_origin, in the order they were added
+            :return: List of dicts with position (x, y of the corner), size (x, y, z) and offset (x, y translation)
+            :raise GCodeException: If a job does not fit in the bed
+        """
+        layout = []
+        cursor = self.bed_origin.copy()
+        row_depth = 0.0
+        limit = self.bed_origin + self.bed_size
+        for index, job in enumerate(self.jobs):
+            orig = numpy.array([job['orig']['x'], job['orig']['y']])
+            size = numpy.array([job['size']['x'], job['size']['y']]) - orig
+            position = job['position']
+            if position is None:
+                if cursor[0] + size[0] > limit[0] and cursor[0] > self.bed_origin[0]:
+                    cursor = numpy.array([self.bed_origin[0], cursor[1] + row_depth + self.spacing])
+                    row_depth = 0.0
+                position = cursor.copy()
+                cursor[0] += size[0] + self.spacing
+                row_depth = max(row_depth, size[1])
+            position = numpy.asarray(position, dtype=numpy.float64)
+            if (position < self.bed_origin).any() or (position + size > limit).any():
+                raise GCodeException('Job %s of %sx%s mm does not fit in the bed at %s' % (
+                    index, size[0], size[1], position.tolist()))
+            layout.append({
+                'position': tuple(position.tolist()),
+                'size': (float(size[0]), float(size[1]), float(job['size']['z'])),
+                'offset': tuple((position - orig).tolist()),
+            })
+        return layout
+
+    def _transition(self, processor, height, start):
+        output_set = processor.output_set
+        codes = [output_set.line_fast(z=format_number(height, processor.precision)),
+                 output_set.line_fast(x=format_number(start[0], processor.precision),
+                                      y=format_number(start[1], processor.precision))]
+        try:
+            if 'e' in output_set.set_position.valid_params:
+                codes.append(output_set.set_position(e='0'))
+        except AttributeError:
+            pass
+        return [code for code in codes if code]
+
+    def process(self, raise_exception=False):
+        """
+            Generator with the codes of the merged program
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: Generator of strings with the codes
+        """
+        layout = self.place()
+        height = None
+        last = len(self.jobs) - 1
+        for index, (job, place) in enumerate(zip(self.jobs, layout)):
+            transform = AffineTransform().translate(x=place['offset'][0], y=place['offset'][1])
+            processor = TransformProcessor(job['instruction_set'], job['file'], transform=transform,
+                                           mm=job['mm'], absolute=job['absolute'], output_set=self.instruction_set,
+                                           **self.kwargs)
+            if index == 0:
+                codes = processor.header()
+            else:
+                start = (job['start']['x'] + place['offset'][0], job['start']['y'] + place['offset'][1])
+                codes = self._transition(processor, height + self.clearance, start)
+            for code in codes:
+                yield "%s\r\n" % code
+            try:
+                for blocks in processor.chunks(raise_exception=raise_exception):
+                    blocks = processor.transform_chunk(blocks)
+                    keep = numpy.ones(len(blocks), dtype=bool)
+                    if index > 0:
+                        keep &= ~((blocks['line'] < job['first_line']) & numpy.isin(blocks['code'], self.strip_start))
+                    if index < last:
+                        keep &= ~((blocks['line'] > job['last_line']) & numpy.isin(blocks['code'], self.strip_end))
+                    for block in blocks[keep]:
+                        code = processor.emit_block(block)
+                        if code is not None:
+                            yield "%s\r\n" % code
+            finally:
+                job['file'].seek(0)
+            height = max(height, place['size'][2]) if height is not None else place['size'][2]
+
+    def write(self, file_obj, raise_exception=False):
+        """
+            :param file_obj: File object for write the merged program
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+        """
+        for code in self.process(raise_exception=raise_exception):
+            file_obj.write(code)
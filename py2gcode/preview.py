@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import struct
+import zlib
+
+import numpy
+
+from py2gcode.toolpath import is_arc, arc_geometry, interpolate_arcs
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def write_png(file_obj, image):
+    """
+        :param file_obj: Binary file object
+        :param image: Array of uint8 with shape (height, width) for gray or (height, width, 3) for RGB
+    """
+    image = numpy.ascontiguousarray(image, dtype=numpy.uint8)
+    height, width = image.shape[:2]
+    color = 2 if image.ndim == 3 else 0
+    rows = numpy.hstack((numpy.zeros((height, 1), dtype=numpy.uint8), image.reshape(height, -1)))
+    file_obj.write(b'\x89PNG\r\n\x1a\n')
+    file_obj.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color, 0, 0, 0)))
+    file_obj.write(_png_chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+    file_obj.write(_png_chunk(b'IEND', b''))
+
+
+def write_pgm(file_obj, image):
+    """
+        :param file_obj: Binary file object
+        :param image: Array of uint8 with shape (height, width)
+    """
+    image = numpy.ascontiguousarray(image, dtype=numpy.uint8)
+    file_obj.write(('P5\n%d %d\n255\n' % (image.shape[1], image.shape[0])).encode('ascii'))
+    file_obj.write(image.tobytes())
+
+
+def to_gray(values, invert=True, empty_value=0):
+    """
+        :param values: Array returned by PreviewRenderer.render or height_map, NaN are empty pixels
+        :param invert: Boolean for draw dark lines over white background
+        :param empty_value: Value of the empty pixels, None for height maps
+        :return: Array of uint8
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    empty = numpy.isnan(values)
+    if empty_value is not None:
+        empty |= values == empty_value
+    gray = numpy.zeros(values.shape)
+    if not empty.all():
+        low = values[~empty].min()
+        high = values[~empty].max()
+        gray[~empty] = 55 + 200 * ((values[~empty] - low) / (high - low) if high > low else 1)
+    if invert:
+        gray = 255 - gray
+    return gray.astype(numpy.uint8)
+
+
+class PreviewRenderer():
+    """
+        Top down raster preview of a toolpath (array of BLOCK_DTYPE), the segments are drawn all at once with numpy
+    """
+
+    def __init__(self, width=256, height=None, margin=2, travel=False, arc_angle=5):
+        """
+            :param width: Width in pixels of the images
+            :param height: Height in pixels, None for keep the aspect ratio of the toolpath
+            :param margin: Empty pixels around the toolpath
+            :param travel: Boolean for draw the G0 moves
+            :param arc_angle: Degrees of each chord used for draw the arcs
+        """
+        self.width = width
+        self.height = height
+        self.margin = margin
+        self.travel = travel
+        self.arc_angle = arc_angle
+
+    def segments(self, blocks):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :return: Dict with the x0, y0, z0, x, y, z arrays of the segments to draw
+        """
+        codes = ['G1'] + (['G0'] if self.travel else [])
+        lines = blocks[numpy.isin(blocks['code'], codes)]
+        segments = dict((key, lines[key]) for key in ('x0', 'y0', 'z0', 'x', 'y', 'z'))
+        arcs = blocks[is_arc(blocks)]
+        if len(arcs):
+            chord = numpy.abs(numpy.radians(self.arc_angle))
+            counts = numpy.ceil(numpy.abs(arc_geometry(arcs)['sweep']) / chord).astype(numpy.int64)
+            points = interpolate_arcs(arcs, counts)
+            first = numpy.ones(len(points['parents']), dtype=bool)
+            first[1:] = points['parents'][1:] != points['parents'][:-1]
+            for axis in ('x', 'y', 'z'):
+                start = numpy.empty_like(points[axis])
+                start[1:] = points[axis][:-1]
+                start[first] = arcs[axis + '0'][points['parents'][first]]
+                segments[axis + '0'] = numpy.concatenate((segments[axis + '0'], start))
+                segments[axis] = numpy.concatenate((segments[axis], points[axis]))
+        return segments
+
+    def bounds(self, segments):
+        """
+            :return: Tuple (min x, min y, max x, max y) of the segments
+        """
+        if not len(segments['x']):
+            return 0.0, 0.0, 1.0, 1.0
+        xs = numpy.concatenate((segments['x0'], segments['x']))
+        ys = numpy.concatenate((segments['y0'], segments['y']))
+        return xs.min(), ys.min(), xs.max(), ys.max()
+
+    def _frame(self, bounds):
+        min_x, min_y, max_x, max_y = bounds
+        span_x = max(max_x - min_x, 1e-9)
+        span_y = max(max_y - min_y, 1e-9)
+        usable = max(self.width - 2 * self.margin - 1, 1)
+        scale = usable / span_x
+        height = self.height
+        if height is None:
+            height = int(numpy.ceil(span_y * scale)) + 2 * self.margin + 1
+        else:
+            scale = min(scale, max(height - 2 * self.margin - 1, 1) / span_y)
+        return scale, self.width, max(height, 1)
+
+    def _pixels(self, segments, bounds, heights=False):
+        """
+            :return: Tuple (flat pixel index, z or None) of every pixel touched by the segments and the image shape, the
+            samples out of the image are skipped
+        """
+        scale, width, height = self._frame(bounds)
+        px0 = (segments['x0'] - bounds[0]) * scale + self.margin
+        px1 = (segments['x'] - bounds[0]) * scale + self.margin
+        py0 = height - 1 - ((segments['y0'] - bounds[1]) * scale + self.margin)
+        py1 = height - 1 - ((segments['y'] - bounds[1]) * scale + self.margin)
+        steps = numpy.ceil(numpy.maximum(numpy.abs(px1 - px0), numpy.abs(py1 - py0))).astype(numpy.int64) + 1
+        owner = numpy.repeat(numpy.arange(len(steps)), steps)
+        first = numpy.concatenate(([0], numpy.cumsum(steps)[:-1]))
+        t = (numpy.arange(len(owner)) - first[owner]) / numpy.maximum(steps - 1, 1)[owner]
+        column = numpy.rint(px0[owner] + (px1 - px0)[owner] * t).astype(numpy.int64)
+        row = numpy.rint(py0[owner] + (py1 - py0)[owner] * t).astype(numpy.int64)
+        inside = (column >= 0) & (column < width) & (row >= 0) & (row < height)
+        z = None
+        if heights:
+            z = (segments['z0'][owner] + (segments['z'] - segments['z0'])[owner] * t)[inside]
+        return row[inside] * width + column[inside], z, (height, width)
+
+    def render(self, blocks, bounds=None):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :param bounds: Tuple (min x, min y, max x, max y) of the image, default the toolpath bounds
+            :return: Array (height, width) with the number of samples drawn in each pixel
+        """
+        segments = self.segments(blocks)
+        if bounds is None:
+            bounds = self.bounds(segments)
+        index, _, shape = self._pixels(segments, bounds)
+        return numpy.bincount(index, minlength=shape[0] * shape[1]).reshape(shape)
+
+    def height_map(self, blocks, bounds=None):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :param bounds: Tuple (min x, min y, max x, max y) of the image, default the toolpath bounds
+            :return: Array (height, width) with the highest Z drawn in each pixel, NaN for empty pixels
+        """
+        segments = self.segments(blocks)
+        if bounds is None:
+            bounds = self.bounds(segments)
+        index, z, shape = self._pixels(segments, bounds, heights=True)
+        heights = numpy.full(shape[0] * shape[1], -numpy.inf)
+        numpy.maximum.at(heights, index, z)
+        heights[numpy.isinf(heights)] = numpy.nan
+        return heights.reshape(shape)
+
+    def layers(self, blocks):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :return: Sorted array with the Z of the layers, the heights where something is extruded or cut
+        """
+        moves = blocks[numpy.isin(blocks['code'], ('G1', 'G2', 'G3'))]
+        extruding = moves['de'] > 0
+        if extruding.any():
+            moves = moves[extruding]
+        moves = moves[moves['z'] == moves['z0']]
+        return numpy.unique(moves['z'])
+
+    def render_layer(self, blocks, z, bounds=None, tolerance=1e-3):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :param z: Height of the layer, see layers
+            :param bounds: Tuple (min x, min y, max x, max y) of the image, default the bounds of the whole toolpath
+            :param tolerance: Maximum Z difference of the segments of the layer
+            :return: Array (height, width) like render
+        """
+        if bounds is None:
+            bounds = self.bounds(self.segments(blocks))
+        layer = blocks[(numpy.abs(blocks['z'] - z) <= tolerance) & (numpy.abs(blocks['z0'] - z) <= tolerance)]
+        return self.render(layer, bounds=bounds)
+
+    def save(self, file_obj, blocks, height_map=False):
+        """
+            Write a PNG preview
+            :param file_obj: Binary file object
+            :param blocks: Array of BLOCK_DTYPE
+            :param height_map: Boolean for shade the pixels with the height instead of the density
+        """
+        if height_map:
+            write_png(file_obj, to_gray(self.height_map(blocks), empty_value=None))
+        else:
+            write_png(file_obj, to_gray(self.render(blocks)))
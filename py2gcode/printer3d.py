@@ -34,8 +34,8 @@ class Printer3D(StandardInstructionSet):
         self.code_supportered['G1'].valid_params.append('e')
         self.code_supportered['G1'].valid_params.append('s')
         self.code_supportered['G1'].param_alias['endstop_check'] = 's'
-        self.code_supportered['G2'].valid_params.append('e')
-        self.code_supportered['G3'].valid_params.append('e')
+        self.code_supportered['G2'].valid_params.extend(['z', 'e'])
+        self.code_supportered['G3'].valid_params.extend(['z', 'e'])
         self.code_supportered['G92'].valid_params.append('e')
 
         self.code_supportered.update({
@@ -62,7 +62,7 @@ class Printer3D(StandardInstructionSet):
                           strict=self.strict),
             'M190': MCode(190, valid_params=['s'], param_alias={'grade': 's'}, required_params=['s'],
                           strict=self.strict),
-            'M203': MCode(190, valid_params=['x', 'y', 'z', 'e'], required_min=1, strict=self.strict),
+            'M203': MCode(203, valid_params=['x', 'y', 'z', 'e'], required_min=1, strict=self.strict),
             'M301': MCode(301, valid_params=['p', 'i', 'd'], required_params=['p', 'i', 'd'], strict=self.strict),
             'M400': MCode(400, strict=self.strict)
         })
@@ -179,6 +179,8 @@ class MarlinGCode(SDGCode):
         Implementation of common MCodes used by Marlin Driver
         https://github.com/MarlinFirmware/Marlin/blob/Development/Marlin/Marlin_main.cpp
     """
+    MEATPACK = True
+
     def __init__(self, strict=False):
         SDGCode.__init__(self, strict=strict)
         self.code_supportered['M109'].valid_params.append('r')
@@ -16,60 +16,198 @@
 """
 from __future__ import absolute_import
 
+import re
+import time
+from collections import deque
+
 import numpy
+import six
 from datetime import timedelta
 
 from py2gcode.py2gcode import StandardInstructionSet, GCodeException
 
+SLICER_METADATA = {
+    'layer': re.compile(';\\s*LAYER:\\s*(-?\\d+)'),
+    'layer_change': re.compile(';\\s*(LAYER_CHANGE)'),
+    'z': re.compile(';\\s*Z:\\s*(-?\\d+\\.?\\d*)'),
+    'type': re.compile(';\\s*TYPE:\\s*(.+)'),
+    'time': re.compile(';\\s*TIME:\\s*(\\d+)'),
+    'flavor': re.compile(';\\s*FLAVOR:\\s*(.+)'),
+    'filament_used': re.compile(';\\s*Filament used:\\s*(\\d+\\.?\\d*)'),
+}
+
+
+class Diagnostics():
+    """
+        Bounded collection of what is found while a file is read: a counter for each kind (comment, error), the
+        last records of each kind in ring buffers and the metadata extracted from the comments.
+        A record is a dict {'line', 'offset', 'code', 'reason'}, the comment text is only kept in the records
+    """
+
+    def __init__(self, samples=0, metadata=None, markers=('layer',)):
+        """
+            :param samples: Number of records kept of each kind, 0 for only count
+            :param metadata: Dict {name: compiled regular expression with one group} applied to the comments
+            ej: SLICER_METADATA
+            :param markers: Metadata names whose every match is kept as (line, offset, value), ej: layer changes
+        """
+        self.samples = samples
+        self.patterns = metadata or {}
+        self.marker_names = [name for name in markers if name in self.patterns]
+        self.reset()
+
+    def reset(self):
+        self.counts = {'comment': 0, 'error': 0}
+        self.records = {'comment': deque(maxlen=self.samples), 'error': deque(maxlen=self.samples)}
+        self.metadata = {}
+        self.markers = dict((name, []) for name in self.marker_names)
+
+    def add(self, kind, line, offset, code, reason):
+        """
+            :param kind: comment or error
+            :param line: Line number
+            :param offset: Byte offset of the line
+            :param code: Text of the code
+            :param reason: String with the reason
+        """
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if self.samples:
+            if kind not in self.records:
+                self.records[kind] = deque(maxlen=self.samples)
+            self.records[kind].append({'line': line, 'offset': offset, 'code': code, 'reason': reason})
+
+    def comment(self, line, offset, text):
+        """
+            Count the comment, keep a sample and extract the metadata without keeping the text
+            :param text: Comment text starting with ;
+        """
+        self.add('comment', line, offset, text, 'comment')
+        for name, pattern in self.patterns.items():
+            match = pattern.match(text)
+            if match is None:
+                continue
+            value = match.group(1).strip()
+            self.metadata[name] = value
+            if name in self.markers:
+                self.markers[name].append((line, offset, value))
+
+    def report(self):
+        """
+            :return: Dict with counts, records (lists), metadata and markers
+        """
+        return {
+            'counts': dict(self.counts),
+            'records': dict((kind, list(records)) for kind, records in self.records.items()),
+            'metadata': dict(self.metadata),
+            'markers': dict((name, list(values)) for name, values in self.markers.items()),
+        }
+
 
 class FileProcessor():
-    def __init__(self, instruction_set, file_obj):
+    def __init__(self, instruction_set, file_obj, diagnostics=None):
+        """
+            :param instruction_set: StandardInstructionSet used for clean the codes
+            :param file_obj: File object with the codes
+            :param diagnostics: Diagnostics for the comments and errors, default only counters
+        """
         assert isinstance(instruction_set, StandardInstructionSet)
         self.instruction_set = instruction_set
         self.file = file_obj
         self.process_end = False
         self.process_start = False
-        self.comments = []
-        self.errors = []
+        if diagnostics is None:
+            diagnostics = Diagnostics()
+        self.diagnostics = diagnostics
+        self.line_number = 0
+        self.offset = 0
+
+    @property
+    def comments(self):
+        """
+            :return: List with the last comments kept by the diagnostics (text from the ;), empty if the diagnostics
+            only count
+        """
+        return [record['code'] for record in self.diagnostics.records.get('comment', ())]
+
+    @property
+    def errors(self):
+        """
+            :return: List with the last lines rejected kept by the diagnostics, empty if the diagnostics only count
+        """
+        return [record['code'] for record in self.diagnostics.records.get('error', ())]
 
     def on_start(self):
-        self.comments = []
-        self.errors = []
+        self.diagnostics.reset()
+        self.line_number = 0
+        self.offset = 0
         self.process_start = True
         self.process_end = False
 
     def on_complete(self):
         self.process_end = True
-        self.file.seek(0)
+        if self.file is not None:
+            self.file.seek(0)
 
     def raw_read(self, line):
         return line.strip()
 
     def read(self, raise_exception=False):
+        """
+            Generator with the cleaned codes of the file.
+            While a line is processed self.line_number (starting at 1) and self.offset (byte offset of the line
+            start) point to it, so the callbacks can know where the code comes from. At the end self.offset is the
+            size of the file in bytes.
+            The offsets are exact for binary files (open(path, 'rb')), whose lines are decoded as utf-8. Text files
+            opened with the default newline translation count \r\n as one byte
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: Generator of strings with the cleaned code
+        """
         self.on_start()
-        for line in self.file.readlines():
-            line = self.raw_read(line)
-            init_comment = line.find(';')
-            if init_comment != -1:
-                self.comments.append(line)
-                line = line[:init_comment].strip()
-            if len(line) <= 1:
-                continue
-            try:
-                gcode = self.instruction_set.clean_code(line, self.callback_manager)
-                if gcode is None:
-                    if raise_exception:
-                        raise GCodeException('Command not supported "%s"' % line)
-                    self.errors.append(line)
-                    continue
+        next_offset = 0
+        for line in self.file:
+            self.line_number += 1
+            self.offset = next_offset
+            if isinstance(line, six.text_type):
+                next_offset += len(line.encode('utf-8'))
+            else:
+                next_offset += len(line)
+                if six.PY3:
+                    line = line.decode('utf-8', 'replace')
+            gcode = self.process_line(line, raise_exception=raise_exception)
+            if gcode is not None:
                 yield "%s\r\n" % gcode
-            except GCodeException as ex:
-                if raise_exception:
-                    raise ex
-                self.errors.append(line)
-                continue
+        self.offset = next_offset
         self.on_complete()
 
+    def process_line(self, line, raise_exception=False):
+        """
+            Clean a line calling the callbacks, self.line_number and self.offset have to point to the line
+            :param line: String with the line
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: String with the cleaned code or None if the line has not a valid code
+        """
+        line = self.raw_read(line)
+        init_comment = line.find(';')
+        if init_comment != -1:
+            self.diagnostics.comment(self.line_number, self.offset, line[init_comment:])
+            line = line[:init_comment].strip()
+        if len(line) <= 1:
+            return None
+        try:
+            gcode = self.instruction_set.clean_code(line, self.callback_manager)
+            if gcode is None:
+                if raise_exception:
+                    raise GCodeException('Command not supported "%s"' % line)
+                code = self.instruction_set.code_supportered.get(line.split(' ')[0], None)
+                reason = code.error if code and code.error else 'not supported'
+                self.diagnostics.add('error', self.line_number, self.offset, line, reason)
+            return gcode
+        except GCodeException as ex:
+            if raise_exception:
+                raise ex
+            self.diagnostics.add('error', self.line_number, self.offset, line, str(ex))
+            return None
+
     def callback_manager(self, gcode=None, **kwargs):
         pass
 
@@ -77,13 +215,22 @@ class FileProcessor():
 class DistanceProcessor(FileProcessor):
     INCH_2_MM = 0.0393700787
 
-    def __init__(self, instruction_set, file_path, mm=True, absolute=True):
-        FileProcessor.__init__(self, instruction_set, file_path)
+    def __init__(self, instruction_set, file_path, mm=True, absolute=True, diagnostics=None):
+        FileProcessor.__init__(self, instruction_set, file_path, diagnostics=diagnostics)
+        self.init_mm = mm
+        self.init_abs = absolute
         self.mm = mm
         self.abs = absolute
         self.distance = {'x': 0, 'y': 0, 'z': 0, 'total': 0}
         self.last_abs_pos = {'x': 0, 'y': 0, 'z': 0}
 
+    def on_start(self):
+        FileProcessor.on_start(self)
+        self.mm = self.init_mm
+        self.abs = self.init_abs
+        self.distance = {'x': 0, 'y': 0, 'z': 0, 'total': 0}
+        self.last_abs_pos = {'x': 0, 'y': 0, 'z': 0}
+
     def callback_manager(self, gcode=None, **kwargs):
         FileProcessor.callback_manager(self, gcode=gcode, **kwargs)
         if gcode in ['G20', 'G21']:
@@ -156,12 +303,13 @@ class DistanceProcessor(FileProcessor):
 
 
 class SizeProcessor(DistanceProcessor):
-    def __init__(self, instruction_set, file_path, mm=True, absolute=True):
-        DistanceProcessor.__init__(self, instruction_set, file_path, mm=mm, absolute=absolute)
+    def __init__(self, instruction_set, file_path, mm=True, absolute=True, diagnostics=None):
+        DistanceProcessor.__init__(self, instruction_set, file_path, mm=mm, absolute=absolute, diagnostics=diagnostics)
         self.size = {'x': -1, 'y': -1, 'z': -1}
         self.orig = {'x': -1, 'y': -1}
 
     def on_start(self):
+        DistanceProcessor.on_start(self)
         self.size = {'x': -1, 'y': -1, 'z': -1}
         self.orig = {'x': -1, 'y': -1}
 
@@ -182,8 +330,8 @@ class SizeProcessor(DistanceProcessor):
 
 
 class SpeedProcessor(SizeProcessor):
-    def __init__(self, instruction_set, file_path, mm=True, absolute=True):
-        SizeProcessor.__init__(self, instruction_set, file_path, mm=mm, absolute=absolute)
+    def __init__(self, instruction_set, file_path, mm=True, absolute=True, diagnostics=None):
+        SizeProcessor.__init__(self, instruction_set, file_path, mm=mm, absolute=absolute, diagnostics=diagnostics)
         self.speeds = {
             'unknown': {'x': 0, 'y': 0, 'z': 0, 'total': 0}
         }
@@ -192,6 +340,7 @@ class SpeedProcessor(SizeProcessor):
         self.time = -1
 
     def on_start(self):
+        SizeProcessor.on_start(self)
         self.speeds = {
             'unknown': {'x': 0, 'y': 0, 'z': 0, 'total': 0}
         }
@@ -209,8 +358,8 @@ class SpeedProcessor(SizeProcessor):
         td = 0
         for v in self.speeds:
             try:
-                td += 60 / (float(v) / self.speeds[v]['total'])
-            except ValueError:
+                td += self.speeds[v]['total'] / float(v)
+            except (ValueError, ZeroDivisionError):
                 pass
         self.time = timedelta(minutes=td)
         SizeProcessor.on_complete(self)
@@ -236,3 +385,112 @@ class SpeedProcessor(SizeProcessor):
                     self.speeds[self.speed]['total'] += dt
                 self.last_speed_distance = pre_distance
                 self.speed = f
+
+
+class LiveProcessor(SpeedProcessor):
+    """
+        SpeedProcessor in push mode for running jobs: the executed lines are given one by one with push() or, from
+        a sender, queued with send() when they are written and processed with ack() when the firmware acknowledges
+        them. Each line costs O(1) and snapshot() is cheap enough to be published several times a second.
+        on_complete() sets time, like in SpeedProcessor
+    """
+
+    def __init__(self, instruction_set, total_time=None, default_feed=None, mm=True, absolute=True,
+                 diagnostics=None):
+        """
+            :param instruction_set: StandardInstructionSet used for clean the codes
+            :param total_time: Estimated seconds (or timedelta) of the whole job for the remaining time
+            ej: SpeedProcessor.time
+            :param default_feed: Feed rate in mm/min while the job has not set one, None for not count those moves
+            :param mm: Boolean units at start, True for G21 False for G20
+            :param absolute: Boolean mode at start, True for G90 False for G91
+            :param diagnostics: Diagnostics for the comments and errors
+        """
+        SpeedProcessor.__init__(self, instruction_set, None, mm=mm, absolute=absolute, diagnostics=diagnostics)
+        if isinstance(total_time, timedelta):
+            total_time = total_time.total_seconds()
+        self.total_time = total_time
+        self.default_feed = default_feed
+        self.start()
+
+    def start(self, now=None):
+        """
+            Reset the state for a new job
+            :param now: Time in seconds (time.time()) of the start
+        """
+        self.on_start()
+        self.bytes = 0
+        self.estimated = 0.0
+        self.pending = deque()
+        self.started = time.time() if now is None else now
+
+    def push(self, line, raise_exception=False):
+        """
+            :param line: String with the executed line
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: String with the cleaned code or None if the line has not a valid code
+        """
+        self.line_number += 1
+        self.offset = self.bytes
+        if isinstance(line, six.text_type):
+            self.bytes += len(line.encode('utf-8'))
+        else:
+            self.bytes += len(line)
+        return self.process_line(line, raise_exception=raise_exception)
+
+    def send(self, line):
+        """
+            :param line: String with the line written to the firmware, it is processed when acknowledged
+        """
+        self.pending.append(line)
+
+    def ack(self, raise_exception=False):
+        """
+            The firmware acknowledged the oldest sent line
+            :return: String with the cleaned code or None, like push
+            :raise GCodeException: If there are not sent lines
+        """
+        if not self.pending:
+            raise GCodeException('Acknowledgement without sent lines')
+        return self.push(self.pending.popleft(), raise_exception=raise_exception)
+
+    def callback_manager(self, gcode=None, **kwargs):
+        total = self.distance['total']
+        SpeedProcessor.callback_manager(self, gcode=gcode, **kwargs)
+        moved = self.distance['total'] - total
+        if moved:
+            try:
+                feed = float(self.speed)
+            except ValueError:
+                feed = self.default_feed
+            if feed:
+                self.estimated += float(moved) * 60.0 / feed
+
+    def snapshot(self, now=None):
+        """
+            :param now: Time in seconds (time.time()) of the snapshot
+            :return: Dict with line, offset (bytes executed), pending (sent lines not acknowledged), position,
+            distance, orig and size (extents so far), feed, estimated (seconds of the executed moves), elapsed (real
+            seconds), remaining (estimated seconds, None without total_time) and remaining_real (remaining scaled by
+            the real speed of the job)
+        """
+        now = time.time() if now is None else now
+        elapsed = now - self.started
+        remaining = remaining_real = None
+        if self.total_time is not None:
+            remaining = max(self.total_time - self.estimated, 0.0)
+            remaining_real = remaining * elapsed / self.estimated if self.estimated > 0 else remaining
+        return {
+            'line': self.line_number,
+            'offset': self.bytes,
+            'pending': len(self.pending),
+            'position': dict(self.last_abs_pos),
+            'distance': dict((axis, float(value)) for axis, value in self.distance.items()),
+            'orig': dict(self.orig),
+            'size': dict(self.size),
+            'feed': self.speed,
+            'estimated': self.estimated,
+            'elapsed': elapsed,
+            'remaining': remaining,
+            'remaining_real': remaining_real,
+        }
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import io
+
+import numpy
+
+from py2gcode.processors import Diagnostics, SLICER_METADATA
+from py2gcode.py2gcode import GCodeException
+from py2gcode.toolpath import ToolpathProcessor, MOTION_CODES, segment_lengths
+
+LAYER_EPSILON = 1e-6
+
+
+class ProgressTable():
+    """
+        Estimated time by byte offset of a file, so the position reported by the firmware while printing from SD
+        (M27 SD printing byte) is converted in elapsed and remaining time and layer with a binary search.
+        The table keeps the cumulative time at the first line of each resolution bytes and the time between two
+        entries is interpolated. Accelerations and dwells are not simulated so the moves take length / feed rate
+    """
+
+    def __init__(self, resolution=1024, default_feed=1000.0):
+        """
+            :param resolution: Bytes between entries of the table, 0 for one entry per line
+            :param default_feed: Feed rate in mm/min while the file has not set one
+        """
+        self.resolution = resolution
+        self.default_feed = default_feed
+        self.reset()
+
+    def reset(self):
+        self.offsets = numpy.zeros(1, dtype=numpy.int64)
+        self.times = numpy.zeros(1, dtype=numpy.float32)
+        self.layer_offsets = numpy.zeros(0, dtype=numpy.int64)
+        self.layer_numbers = numpy.zeros(0, dtype=numpy.int32)
+        self.size = 0
+        self.total = 0.0
+        self._chunks = []
+        self._layers = []
+        self._bucket = -1
+        self._top = -numpy.inf
+
+    def add(self, blocks):
+        """
+            Add the next chunk of a file while it is analysed
+            :param blocks: Array of BLOCK_DTYPE
+        """
+        lengths = segment_lengths(blocks)
+        moving = numpy.isin(blocks['code'], MOTION_CODES) & (lengths > 0)
+        feed = numpy.where(numpy.isnan(blocks['f']), self.default_feed, blocks['f'])
+        duration = numpy.where(moving, lengths / (numpy.maximum(feed, 1e-9) / 60.0), 0.0)
+        before = self.total + numpy.cumsum(duration) - duration
+        self.total += float(duration.sum())
+
+        offsets = blocks['offset'].astype(numpy.int64)
+        if self.resolution:
+            bucket = offsets // self.resolution
+            keep = numpy.empty(len(bucket), dtype=bool)
+            keep[:1] = bucket[:1] != self._bucket
+            keep[1:] = bucket[1:] != bucket[:-1]
+            if len(bucket):
+                self._bucket = bucket[-1]
+        else:
+            keep = numpy.ones(len(offsets), dtype=bool)
+        self._chunks.append((offsets[keep], before[keep]))
+
+        printing = moving & (blocks['de'] > 0)
+        if printing.any():
+            top = numpy.maximum.accumulate(numpy.concatenate(([self._top], blocks['z'][printing])))
+            self._layers.append(blocks['offset'][printing][top[1:] > top[:-1] + LAYER_EPSILON])
+            self._top = top[-1]
+
+    def finish(self, size, markers=None):
+        """
+            Build the table after the last chunk
+            :param size: Size of the file in bytes
+            :param markers: List of (line, offset, value) with the layer changes written by the slicer, ej:
+            Diagnostics.markers['layer'], if empty the layers are the increments of the printing Z
+        """
+        offsets = [numpy.zeros(1, dtype=numpy.int64)] + [chunk[0] for chunk in self._chunks] + [[size]]
+        times = [numpy.zeros(1)] + [chunk[1] for chunk in self._chunks] + [[self.total]]
+        offsets = numpy.concatenate(offsets)
+        times = numpy.concatenate(times)
+        unique = numpy.concatenate((offsets[1:] != offsets[:-1], [True]))
+        self.offsets = offsets[unique].astype(numpy.uint32 if size < 1 << 32 else numpy.int64)
+        self.times = times[unique].astype(numpy.float32)
+        if markers:
+            self.layer_offsets = numpy.array([offset for _, offset, _ in markers], dtype=numpy.int64)
+            self.layer_numbers = numpy.array([int(value) for _, _, value in markers], dtype=numpy.int32)
+        elif self._layers:
+            self.layer_offsets = numpy.concatenate(self._layers).astype(numpy.int64)
+            self.layer_numbers = numpy.arange(len(self.layer_offsets), dtype=numpy.int32)
+        self.size = int(size)
+        self._chunks = []
+        self._layers = []
+
+    @classmethod
+    def from_file(cls, instruction_set, file_obj, resolution=1024, default_feed=1000.0, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet used for read the file
+            :param file_obj: File object with the codes
+            :param resolution: Bytes between entries of the table
+            :param default_feed: Feed rate in mm/min while the file has not set one
+            :param kwargs: Parameters for ToolpathProcessor
+            :return: ProgressTable of the file
+            :raise GCodeException: If file_obj is a text file, the newline translation changes the byte offsets
+        """
+        if isinstance(file_obj, io.TextIOWrapper):
+            raise GCodeException('Open the file in binary mode (rb) for the byte offsets of the firmware')
+        table = cls(resolution=resolution, default_feed=default_feed)
+        if kwargs.get('diagnostics', None) is None:
+            kwargs['diagnostics'] = Diagnostics(metadata={'layer': SLICER_METADATA['layer']})
+        processor = ToolpathProcessor(instruction_set, file_obj, **kwargs)
+        for blocks in processor.chunks():
+            table.add(blocks)
+        table.finish(processor.offset, processor.diagnostics.markers.get('layer', None))
+        return table
+
+    def elapsed(self, position):
+        """
+            :param position: Byte offset reported by the firmware
+            :return: Estimated seconds from the start until the position
+        """
+        return float(numpy.interp(position, self.offsets, self.times))
+
+    def layer(self, position):
+        """
+            :param position: Byte offset reported by the firmware
+            :return: Number of the layer in the position or None before the first layer
+        """
+        index = int(numpy.searchsorted(self.layer_offsets, position, side='right')) - 1
+        if index < 0:
+            return None
+        return int(self.layer_numbers[index])
+
+    def lookup(self, position):
+        """
+            :param position: Byte offset reported by the firmware, ej: 1234 of "SD printing byte 1234/56789"
+            :return: Dict with position, elapsed and remaining seconds, progress (0 to 1 of the time) and layer
+        """
+        if position < 0 or position > self.size:
+            raise GCodeException('Position %s out of the file (%s bytes)' % (position, self.size))
+        elapsed = self.elapsed(position)
+        total = float(self.times[-1])
+        return {
+            'position': position,
+            'elapsed': elapsed,
+            'remaining': max(total - elapsed, 0.0),
+            'progress': elapsed / total if total else 1.0,
+            'layer': self.layer(position),
+        }
+
+    def layer_offset(self, layer):
+        """
+            :param layer: Number of a layer
+            :return: Byte offset of the start of the layer, ej: for resume the print with M26
+        """
+        index = numpy.flatnonzero(self.layer_numbers == layer)
+        if not len(index):
+            raise GCodeException('Layer %s not found' % layer)
+        return int(self.layer_offsets[index[0]])
+
+    def save(self, file_obj):
+        """
+            :param file_obj: File object or filename where the table is written (numpy npz)
+        """
+        numpy.savez_compressed(file_obj, offsets=self.offsets, times=self.times, layer_offsets=self.layer_offsets,
+                               layer_numbers=self.layer_numbers, header=numpy.array([self.size, self.resolution]))
+
+    @classmethod
+    def load(cls, file_obj):
+        """
+            :param file_obj: File object or filename written by save
+            :return: ProgressTable
+        """
+        with numpy.load(file_obj) as data:
+            size, resolution = data['header'].tolist()
+            table = cls(resolution=resolution)
+            table.offsets = data['offsets']
+            table.times = data['times']
+            table.layer_offsets = data['layer_offsets']
+            table.layer_numbers = data['layer_numbers']
+        table.size = size
+        table.total = float(table.times[-1])
+        return table
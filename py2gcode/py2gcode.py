@@ -22,14 +22,15 @@ import six
 class GCodeException(Exception):
     def __init__(self, *args, **kwargs):
         self.gcode = kwargs.pop('gcode', None)
-        Exception.__init__(self, *args, **kwargs)
+        self.params = kwargs
+        Exception.__init__(self, *args)
 
 
 class BaseCode:
     FLOAT_RE = re.compile('\\-?\\d+\\.?\\d*')
 
     def __init__(self, codekey, ncode, required_params=[], valid_params=[], param_alias={},
-                 required_min=0, strict=False, callback=[], **kwargs):
+                 required_min=0, strict=False, callback=[], required_any=[], **kwargs):
         """
             BaseCode is a class used for make easy and fast write codes
             The optional parameters are for validate the codes
@@ -43,6 +44,8 @@ class BaseCode:
             :param strict: Boolean for raise error, default=False
             :param callback: List of function with format "callback_funct(gcode=self.gcode, **kwargs)" calling when 
             get() is call with filtered params and only if all is ok, default=None
+            :param required_any: Array of groups of params, at least one of each group is requiered
+            ej: [('x', 'y', 'z'), ('i', 'j', 'k')] for the arcs in any plane
             :param kwargs: **kwargs Use for extend
         """
         self.gcode = "%s%s" % (codekey, ncode)
@@ -51,6 +54,7 @@ class BaseCode:
         self.valid_params = valid_params
         self.param_alias = param_alias
         self.required_min = required_min
+        self.required_any = required_any
         self.strict = strict
         self.error = None
         self.callback = callback
@@ -97,6 +101,12 @@ class BaseCode:
                 if self.strict:
                     raise GCodeException(self.error, gcode=self.gcode, **kwargs)
                 return None
+        for group in self.required_any:
+            if not any(key in req_param for key in group):
+                self.error = "Required one of %s in %s" % (list(group), self.gcode)
+                if self.strict:
+                    raise GCodeException(self.error, gcode=self.gcode)
+                return None
         if len(self.callback) > 0:
             for f in self.callback:
                 f(**callback_kwargs)
@@ -104,25 +114,16 @@ class BaseCode:
 
     def get_re(self):
         """
-            :return re: Regular expresion for valid the code
+            :return re: Regular expresion for valid the code, the params can be in any order (the required ones are
+            checked by get)
         """
         if self._re is None:
-            p_res = {}
+            p_res = []
             for p in self.valid_params:
-                p_res[p] = "([%s%s]\\-?\\d+\\.?\\d*) ?" % (p.lower(), p.upper())
+                p_res.append("([%s%s]\\-?\\d+\\.?\\d*) ?" % (p.lower(), p.upper()))
             valid_re = "(%s) ?" % self.gcode
-
-            if len(self.required_params):
-                p_req = {}
-                for p in self.required_params:
-                    p_req[p] = p_res[p]
-                    del (p_res[p])
-                if len(p_req) == 1:
-                    valid_re += "%s" % (''.join(p_req.values()))
-                else:
-                    valid_re += "(?:%s){%s}" % ('|'.join(p_req.values()), len(p_req))
             if len(p_res) > 0:
-                valid_re += "(?:%s){%s,}" % ('|'.join(p_res.values()), self.required_min)
+                valid_re += "(?:%s)*" % '|'.join(p_res)
             self._re = re.compile(valid_re)
         return self._re
 
@@ -214,6 +215,9 @@ class StandardInstructionSet():
     """
         Implementation of common used Standar GCodes and MCodes see http://www.machinemate.com/StandardCodes.htm
     """
+    MODAL_MOTION = False  # True if the firmware accepts coordinates without G word using the last motion code
+    SUBROUTINES = False  # True if the firmware has O word subroutines and repeat loops (o100 sub, o101 repeat)
+    MEATPACK = False  # True if the firmware can read the MeatPack packed serial stream
 
     def __init__(self, strict=False):
         """
@@ -267,6 +271,9 @@ class StandardInstructionSet():
         }
 
     def __getattr__(self, key):
+        if key.startswith('__') or key in ('code_functions', 'code_supportered'):
+            # Not set yet while unpickling (ej: sent to a process pool)
+            raise AttributeError("%s instance has no attribute '%s'" % (self.__class__, key))
         if key in self.code_functions:
             key = self.code_functions[key]
         key = key.upper()
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+from datetime import timedelta
+
+import numpy
+
+from py2gcode.py2gcode import GCodeException
+from py2gcode.toolpath import AXES
+
+
+class Job():
+    """
+        Job waiting for a machine, the duration is the estimated time in seconds
+    """
+
+    def __init__(self, name, duration, size=None, codes=None, priority=0):
+        """
+            :param name: Unique name of the job
+            :param duration: Estimated seconds (or timedelta) ej: SpeedProcessor.time
+            :param size: Dict {axis: mm} with the dimensions of the job
+            :param codes: Iterable with the codes used by the job, the machine has to support all of them
+            :param priority: Jobs with higher priority are planned first
+        """
+        if isinstance(duration, timedelta):
+            duration = duration.total_seconds()
+        self.name = name
+        self.duration = float(duration)
+        self.size = size or {}
+        self.codes = frozenset(codes or ())
+        self.priority = priority
+
+    @classmethod
+    def from_processor(cls, name, processor, codes=None, priority=0):
+        """
+            :param name: Unique name of the job
+            :param processor: SpeedProcessor already read
+            :param codes: Iterable with the codes used by the job
+            :return: Job
+        """
+        size = {'z': max(processor.size['z'], 0)}
+        for axis in ('x', 'y'):
+            size[axis] = max(processor.size[axis] - max(processor.orig[axis], 0), 0)
+        return cls(name, processor.time, size=size, codes=codes, priority=priority)
+
+    def __repr__(self):
+        return '<Job %s %ss>' % (self.name, self.duration)
+
+
+class Scheduler():
+    """
+        Assign jobs to machines (MachineProfile) minimizing the makespan with a longest processing time first list
+        scheduling: each job goes to the compatible machine where it finishes earlier. The plan can be updated when
+        the jobs start or finish at other times than planned
+    """
+
+    def __init__(self, machines):
+        """
+            :param machines: List of MachineProfile
+        """
+        self.machines = list(machines)
+        self.jobs = {}
+        self.plan_time = 0.0
+        self.assignments = {}
+        self.running = {}
+        self.done = {}
+        self.unassigned = []
+
+    def compatible(self, jobs):
+        """
+            :param jobs: List of Job
+            :return: Boolean array (jobs, machines) with the machines that can run each job
+        """
+        sizes = numpy.array([[job.size.get(axis, 0) for axis in AXES] for job in jobs], dtype=numpy.float64)
+        spans = numpy.array([[machine.span(axis) for axis in AXES] for machine in self.machines])
+        fits = (sizes.reshape(-1, 1, 3) <= spans.reshape(1, -1, 3)).all(axis=2)
+        supported = {}
+        for n, job in enumerate(jobs):
+            if job.codes not in supported:
+                supported[job.codes] = [all(machine.supports(code) for code in job.codes) for machine in self.machines]
+            fits[n] &= supported[job.codes]
+        return fits.reshape(len(jobs), len(self.machines))
+
+    def _free_at(self, now):
+        free = numpy.full(len(self.machines), float(now))
+        for name, (machine, start, end) in self.running.items():
+            free[machine] = max(free[machine], end)
+        return free
+
+    def plan(self, jobs=None, now=0.0):
+        """
+            Plan the pending jobs, the running ones keep their machine
+            :param jobs: List of new Job
+            :param now: Time in seconds of the plan
+            :return: Dict {machine name: [(job name, start, end), ...]}
+        """
+        for job in jobs or []:
+            if job.name in self.jobs:
+                raise GCodeException('Job %s already planned' % job.name)
+            self.jobs[job.name] = job
+        self.plan_time = float(now)
+        pending = [job for name, job in self.jobs.items() if name not in self.running and name not in self.done]
+        pending.sort(key=lambda job: (-job.priority, -job.duration, job.name))
+        self.assignments = {}
+        self.unassigned = []
+        if not pending:
+            return self.schedule()
+        free = self._free_at(now)
+        factors = numpy.array([machine.time_factor for machine in self.machines], dtype=numpy.float64)
+        compatible = self.compatible(pending)
+        for n, job in enumerate(pending):
+            finish = numpy.where(compatible[n], free + job.duration * factors, numpy.inf)
+            machine = int(numpy.argmin(finish))
+            if numpy.isinf(finish[machine]):
+                self.unassigned.append(job.name)
+                continue
+            self.assignments[job.name] = (machine, float(free[machine]), float(finish[machine]))
+            free[machine] = finish[machine]
+        return self.schedule()
+
+    def start(self, name, time):
+        """
+            The job started, it keeps its machine in the next plans
+            :param name: Name of the job
+            :param time: Time in seconds
+        """
+        machine, start, end = self.assignments.pop(name)
+        self.running[name] = (machine, float(time), float(time) + end - start)
+
+    def finish(self, name, time, replan=True):
+        """
+            The job finished, if it was before the planned time the pending jobs are planned again
+            :param name: Name of the job
+            :param time: Time in seconds
+            :param replan: Boolean for plan the pending jobs from time
+            :return: Dict like plan
+        """
+        if name in self.assignments:
+            self.start(name, time)
+        machine, start, _ = self.running.pop(name)
+        self.done[name] = (machine, start, float(time))
+        if replan:
+            return self.plan(now=time)
+        return self.schedule()
+
+    def schedule(self):
+        """
+            :return: Dict {machine name: [(job name, start, end), ...]} with the running and planned jobs
+        """
+        result = dict((machine.name, []) for machine in self.machines)
+        for tasks in (self.running, self.assignments):
+            for name, (machine, start, end) in tasks.items():
+                result[self.machines[machine].name].append((name, start, end))
+        for tasks in result.values():
+            tasks.sort(key=lambda task: task[1])
+        return result
+
+    def makespan(self):
+        """
+            :return: Seconds from the plan time until the last planned job ends
+        """
+        ends = [end for tasks in (self.running, self.assignments) for _, _, end in tasks.values()]
+        if not ends:
+            return 0.0
+        return max(ends) - self.plan_time
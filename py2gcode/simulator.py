@@ -0,0 +1,480 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import six
+
+from py2gcode.processors import LiveProcessor
+from py2gcode.py2gcode import GCodeException
+
+PROTOCOLS = ('marlin', 'grbl')
+LINE_RE = re.compile('^\\s*N(\\d+)\\s*(.*?)\\s*\\*(\\d+)\\s*$', re.IGNORECASE)
+GREETINGS = {'marlin': 'start', 'grbl': "Grbl 1.1h ['$' for help]"}
+
+
+def checksum(text):
+    """
+        :param text: String of a line before the '*' ej: N10 G1 X1
+        :return: Integer with the XOR of the bytes, like Marlin and RepRap
+    """
+    value = 0
+    for char in bytearray(text.encode('utf-8')):
+        value ^= char
+    return value
+
+
+class _Pipe():
+    """
+        One way byte buffer between threads
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        with self.condition:
+            if self.closed:
+                raise GCodeException('Write on a closed stream')
+            self.data.extend(data)
+            self.condition.notify_all()
+        return len(data)
+
+    def readline(self, timeout=None):
+        """
+            :return: Bytes of a line with the newline, the pending bytes when closed or b'' on timeout
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                index = self.data.find(b'\n')
+                if index != -1:
+                    line = bytes(self.data[:index + 1])
+                    del self.data[:index + 1]
+                    return line
+                if self.closed:
+                    line = bytes(self.data)
+                    del self.data[:]
+                    return line
+                wait = None if end is None else end - time.time()
+                if wait is not None and wait <= 0:
+                    return b''
+                self.condition.wait(wait)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class SimulatedStream():
+    """
+        In-process end of a serial link with the serial API used by the senders: write, readline, in_waiting and
+        close
+    """
+
+    def __init__(self, rx, tx, timeout=None):
+        """
+            :param rx: _Pipe read by this end
+            :param tx: _Pipe written by this end
+            :param timeout: Seconds waited by readline, None for wait forever
+        """
+        self.rx = rx
+        self.tx = tx
+        self.timeout = timeout
+
+    @classmethod
+    def pair(cls, timeout=None):
+        """
+            :return: Tuple (host, device) with both ends of a link
+        """
+        forward = _Pipe()
+        backward = _Pipe()
+        return cls(backward, forward, timeout=timeout), cls(forward, backward)
+
+    def write(self, data):
+        return self.tx.write(data)
+
+    def readline(self):
+        return self.rx.readline(self.timeout)
+
+    @property
+    def in_waiting(self):
+        return len(self.rx.data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.tx.close()
+        self.rx.close()
+
+
+class _PtyStream():
+    """
+        Device end of a pseudo terminal
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        os.write(self.fd, data)
+
+    def readline(self):
+        while b'\n' not in self.buffer:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError:
+                data = b''
+            if not data:
+                line = bytes(self.buffer)
+                del self.buffer[:]
+                return line
+            self.buffer.extend(data)
+        index = self.buffer.find(b'\n')
+        line = bytes(self.buffer[:index + 1])
+        del self.buffer[:index + 1]
+        return line
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class _Estimator(LiveProcessor):
+    """
+        LiveProcessor that keeps the dwell time of G4
+    """
+
+    def callback_manager(self, gcode=None, **kwargs):
+        LiveProcessor.callback_manager(self, gcode=gcode, **kwargs)
+        if gcode == 'G4':
+            try:
+                if kwargs.get('p', None) is not None:
+                    self.dwell += float(kwargs['p']) / 1000.0
+                elif kwargs.get('s', None) is not None:
+                    self.dwell += float(kwargs['s'])
+            except ValueError:
+                pass
+
+    def start(self, now=None):
+        LiveProcessor.start(self, now=now)
+        self.dwell = 0.0
+
+
+class SimulatedController():
+    """
+        Firmware simulator for test senders without a machine: it speaks the Marlin or Grbl line protocol over an
+        in-process stream or a pseudo terminal, accepts the codes of the instruction set and runs the moves in a
+        planner buffer of buffer_size moves. A move takes the time of SpeedProcessor (length / feed rate) divided by
+        speed_factor, plus the G4 dwells, and the simulation runs time_scale real seconds for each simulated second.
+        The moves are scheduled one after the other so the sleep errors do not add up, the report has the measured
+        time and the stalls: times the planner was empty when the running move ended
+    """
+
+    def __init__(self, instruction_set, protocol='marlin', buffer_size=16, speed_factor=1.0, time_scale=1.0,
+                 baud=None, default_feed=1000.0, max_events=100):
+        """
+            :param instruction_set: StandardInstructionSet of the firmware, ej: MarlinGCode or GrblGcode
+            :param protocol: marlin (ok, echo:Unknown command, line numbers and checksums) or grbl (ok, error:20,
+            ? status)
+            :param buffer_size: Number of moves of the planner buffer
+            :param speed_factor: Real speed of the machine divided by the estimated speed
+            :param time_scale: Real seconds for each simulated second, ej: 0.01 runs 100 times faster
+            :param baud: Bits per second of the link (10 bits per byte), None for no limit
+            :param default_feed: Feed rate in mm/min while the job has not set one
+            :param max_events: Number of stall events kept
+        """
+        if protocol not in PROTOCOLS:
+            raise GCodeException('Protocol %s not in %s' % (protocol, PROTOCOLS))
+        self.instruction_set = instruction_set
+        self.protocol = protocol
+        self.buffer_size = buffer_size
+        self.speed_factor = float(speed_factor)
+        self.time_scale = float(time_scale)
+        self.baud = baud
+        self.default_feed = default_feed
+        self.max_events = max_events
+        self.stream = None
+        self._slave = None
+        self.threads = []
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        self.estimator = _Estimator(self.instruction_set, default_feed=self.default_feed)
+        self.planner = deque()
+        self.running = False
+        self.closed = False
+        self.line_number = 0
+        self.stats = {'lines': 0, 'codes': 0, 'moves': 0, 'errors': 0, 'resends': 0, 'executed': 0.0,
+                      'stalls': 0, 'stall_time': 0.0}
+        self.events = deque(maxlen=self.max_events)
+        self.first_start = None
+        self.last_end = None
+        self.position = (0.0, 0.0, 0.0)
+
+    def open(self, timeout=None):
+        """
+            Start the simulator with an in-process link
+            :param timeout: Seconds waited by the readline of the host end
+            :return: SimulatedStream for the host
+        """
+        host, device = SimulatedStream.pair(timeout=timeout)
+        self._start(device)
+        return host
+
+    def open_pty(self):
+        """
+            Start the simulator on a pseudo terminal (POSIX only)
+            :return: String with the device path for the host, ej: /dev/pts/3
+        """
+        try:
+            import pty
+            import tty
+        except ImportError:
+            raise GCodeException('Pseudo terminals are not available')
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self._slave = slave
+        self._start(_PtyStream(master))
+        return os.ttyname(slave)
+
+    def _start(self, stream):
+        self.reset()
+        self.stream = stream
+        self.threads = [threading.Thread(target=self._receive), threading.Thread(target=self._execute)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        self._reply(GREETINGS[self.protocol])
+
+    def close(self, wait=True):
+        """
+            :param wait: Boolean for wait until the planner is empty
+        """
+        if wait:
+            self.wait_idle()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.stream is not None:
+            self.stream.close()
+        if self._slave is not None:
+            os.close(self._slave)
+            self._slave = None
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(1.0)
+
+    def wait_idle(self, timeout=None):
+        """
+            :param timeout: Seconds to wait
+            :return: True if the planner is empty and no move is running
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.planner or self.running:
+                wait = None if end is None else end - time.time()
+                if wait is not None and wait <= 0:
+                    return False
+                self.condition.wait(wait)
+        return True
+
+    def _reply(self, text):
+        try:
+            self.stream.write(('%s\n' % text).encode('utf-8'))
+        except (OSError, GCodeException):
+            pass
+
+    def _unwrap(self, line):
+        """
+            Marlin line numbers and checksums
+            :return: String with the code or None if it has to be sent again
+        """
+        match = LINE_RE.match(line)
+        if match is None:
+            return line
+        number = int(match.group(1))
+        if checksum(line[:line.rindex('*')].strip()) != int(match.group(3)):
+            error = 'Error:checksum mismatch, Last Line: %s' % self.line_number
+        elif number != self.line_number + 1 and not match.group(2).upper().startswith('M110'):
+            error = 'Error:Line Number is not Last Line Number+1, Last Line: %s' % self.line_number
+        else:
+            self.line_number = number
+            return match.group(2)
+        self.stats['resends'] += 1
+        self._reply('%s\nResend: %s\nok' % (error, self.line_number + 1))
+        return None
+
+    def _receive(self):
+        while not self.closed:
+            try:
+                raw = self.stream.readline()
+            except (OSError, ValueError):
+                break
+            if not raw:
+                break
+            if self.baud:
+                time.sleep(len(raw) * 10.0 / self.baud * self.time_scale)
+            line = raw.decode('utf-8', 'replace').strip()
+            if self.protocol == 'grbl' and line == '?':
+                self._reply('<%s|MPos:%.3f,%.3f,%.3f>' % (('Run' if self.running or self.planner else 'Idle',) +
+                                                         self.position))
+                continue
+            self.stats['lines'] += 1
+            if self.protocol == 'marlin':
+                line = self._unwrap(line)
+                if line is None:
+                    continue
+            self._handle(line)
+
+    def _handle(self, line):
+        estimator = self.estimator
+        errors = estimator.diagnostics.counts['error']
+        estimated = estimator.estimated
+        estimator.dwell = 0.0
+        code = estimator.push(line)
+        if estimator.diagnostics.counts['error'] != errors:
+            self.stats['errors'] += 1
+            if self.protocol == 'grbl':
+                self._reply('error:20')
+            else:
+                self._reply('echo:Unknown command: "%s"\nok' % line)
+            return
+        if code is None:
+            self._reply('ok')
+            return
+        self.stats['codes'] += 1
+        duration = (estimator.estimated - estimated) / self.speed_factor + estimator.dwell
+        if duration > 0:
+            position = tuple(float(estimator.last_abs_pos[axis]) for axis in ('x', 'y', 'z'))
+            with self.condition:
+                while len(self.planner) >= self.buffer_size and not self.closed:
+                    self.condition.wait()
+                self.planner.append((self.stats['lines'], duration, position))
+                self.condition.notify_all()
+        self._reply('ok')
+
+    def _execute(self):
+        while True:
+            with self.condition:
+                starved = not self.planner
+                while not self.planner and not self.closed:
+                    self.condition.wait()
+                if not self.planner:
+                    break
+                line, duration, position = self.planner.popleft()
+                self.running = True
+                self.condition.notify_all()
+            now = time.time()
+            if self.first_start is None:
+                self.first_start = start = now
+            elif starved and now > self.last_end:
+                start = now
+                stall = (now - self.last_end) / self.time_scale
+                self.stats['stalls'] += 1
+                self.stats['stall_time'] += stall
+                self.events.append((line, stall))
+            else:
+                start = self.last_end
+            end = start + duration * self.time_scale
+            wait = end - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            with self.condition:
+                self.stats['moves'] += 1
+                self.stats['executed'] += duration
+                self.position = position
+                self.last_end = end
+                self.running = False
+                self.condition.notify_all()
+
+    def report(self):
+        """
+            :return: Dict with lines, codes, moves, errors, resends, executed (simulated seconds of the moves),
+            elapsed (simulated seconds from the first move to the end of the last one), estimated (seconds of
+            SpeedProcessor for the received codes), stalls, stall_time and events [(line, seconds)]
+        """
+        report = dict(self.stats)
+        elapsed = 0.0
+        if self.first_start is not None and self.last_end is not None:
+            elapsed = (self.last_end - self.first_start) / self.time_scale
+        report['elapsed'] = elapsed
+        report['estimated'] = self.estimator.estimated
+        report['events'] = list(self.events)
+        return report
+
+
+def send_lines(port, lines, timeout=10.0):
+    """
+        Simple sender: each line is written when the previous one is acknowledged (ok or error)
+        :param port: Stream with write and readline, ej: SimulatedStream or a serial port. While the lines are sent
+        its timeout attribute (if any) is limited to timeout, so readline does not block forever
+        :param lines: Iterable of lines
+        :param timeout: Seconds waited for each acknowledgement
+        :return: Dict with lines, errors, seconds and lines_per_second
+        :raise GCodeException: If an acknowledgement does not arrive
+    """
+    start = time.time()
+    count = errors = 0
+    port_timeout = getattr(port, 'timeout', None)
+    limit_timeout = hasattr(port, 'timeout') and (port_timeout is None or port_timeout > timeout)
+    if limit_timeout:
+        port.timeout = timeout
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(';'):
+                continue
+            port.write(('%s\n' % line).encode('utf-8'))
+            count += 1
+            end = time.time() + timeout
+            while True:
+                answer = port.readline()
+                if isinstance(answer, six.binary_type):
+                    answer = answer.decode('utf-8', 'replace')
+                answer = answer.strip()
+                if answer.startswith('ok'):
+                    break
+                if answer.startswith('error') or answer.startswith('echo:Unknown'):
+                    errors += 1
+                    if answer.startswith('error'):
+                        break
+                if time.time() > end:
+                    raise GCodeException('Acknowledgement of "%s" not received' % line)
+    finally:
+        if limit_timeout:
+            port.timeout = port_timeout
+    seconds = time.time() - start
+    return {'lines': count, 'errors': errors, 'seconds': seconds,
+            'lines_per_second': count / seconds if seconds else 0.0}
@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import numpy
+
+from py2gcode.py2gcode import GCodeException
+from py2gcode.toolpath import ToolpathProcessor, MOTION_CODES, linearize_arcs, segment_lengths
+
+SEGMENT_KEYS = ('x0', 'y0', 'z0', 'x', 'y', 'z')
+MAX_GRID_CELLS = 1 << 22
+
+
+def moves(blocks, tolerance=0.01):
+    """
+        :param blocks: Array of BLOCK_DTYPE
+        :param tolerance: Maximum distance in mm between the arcs and their chords
+        :return: Dict of arrays with the line, rapid (Boolean for G0) and points (SEGMENT_KEYS) of the moves, the
+        arcs are replaced by chords with the line of the arc
+    """
+    blocks = linearize_arcs(blocks[numpy.isin(blocks['code'], MOTION_CODES)], tolerance)
+    blocks = blocks[segment_lengths(blocks) > 0]
+    result = dict((key, numpy.array(blocks[key], dtype=numpy.float64)) for key in SEGMENT_KEYS)
+    result['line'] = numpy.array(blocks['line'], dtype=numpy.int64)
+    result['rapid'] = blocks['code'] == 'G0'
+    return result
+
+
+class SpatialIndex():
+    """
+        Uniform XY grid over the bounding boxes of the moves of a program (arcs as chords within a tolerance) for
+        region and nearest move queries that return the line numbers of the file.
+        The grid is stored as compressed rows: the moves of cell n are items[starts[n]:starts[n + 1]], the moves
+        that cover more than max_cells cells are kept apart and always checked
+    """
+
+    def __init__(self, segments, cell=None, max_cells=64):
+        """
+            :param segments: Dict of arrays of moves()
+            :param cell: Size in mm of the cells, default from the density and length of the moves
+            :param max_cells: Maximum number of cells of a move in the grid
+        """
+        self.segments = segments
+        self.max_cells = max_cells
+        count = len(segments['line'])
+        if count:
+            low = numpy.array([numpy.minimum(segments['x0'], segments['x']).min(),
+                               numpy.minimum(segments['y0'], segments['y']).min()])
+            high = numpy.array([numpy.maximum(segments['x0'], segments['x']).max(),
+                                numpy.maximum(segments['y0'], segments['y']).max()])
+        else:
+            low, high = numpy.zeros(2), numpy.ones(2)
+        span = numpy.maximum(high - low, 1e-6)
+        if cell is None:
+            extent = numpy.maximum(numpy.abs(segments['x'] - segments['x0']), numpy.abs(segments['y'] - segments['y0']))
+            cell = max(numpy.sqrt(span[0] * span[1] * 4.0 / max(count, 1)),
+                       float(numpy.median(extent)) if count else 0.0, 1e-3)
+        cell = max(float(cell), numpy.sqrt(span[0] * span[1] / MAX_GRID_CELLS))
+        self.cell = cell
+        self.origin = low
+        self.shape = (numpy.floor(span / cell).astype(numpy.int64) + 1)
+        self._build()
+
+    def _cells(self, x, y):
+        """
+            :return: Tuple of arrays (column, row) of the cells of the points, clipped to the grid
+        """
+        column = numpy.clip(numpy.floor((x - self.origin[0]) / self.cell), 0, self.shape[0] - 1).astype(numpy.int64)
+        row = numpy.clip(numpy.floor((y - self.origin[1]) / self.cell), 0, self.shape[1] - 1).astype(numpy.int64)
+        return column, row
+
+    def _build(self):
+        segments = self.segments
+        column0, row0 = self._cells(numpy.minimum(segments['x0'], segments['x']),
+                                    numpy.minimum(segments['y0'], segments['y']))
+        column1, row1 = self._cells(numpy.maximum(segments['x0'], segments['x']),
+                                    numpy.maximum(segments['y0'], segments['y']))
+        columns = column1 - column0 + 1
+        counts = columns * (row1 - row0 + 1)
+        big = counts > self.max_cells
+        self.oversize = numpy.flatnonzero(big)
+        ids = numpy.flatnonzero(~big)
+        counts = counts[ids]
+        owner = numpy.repeat(ids, counts)
+        local = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        cells = (row0[owner] + local // columns[owner]) * self.shape[0] + column0[owner] + local % columns[owner]
+        order = numpy.argsort(cells, kind='stable')
+        self.items = owner[order]
+        self.starts = numpy.searchsorted(cells[order], numpy.arange(self.shape[0] * self.shape[1] + 1))
+
+    def _candidates(self, column0, row0, column1, row1):
+        """
+            :return: Array with the unique moves of the cells in the range (included) and the oversize ones
+        """
+        column0, column1 = max(column0, 0), min(column1, self.shape[0] - 1)
+        row0, row1 = max(row0, 0), min(row1, self.shape[1] - 1)
+        parts = [self.oversize]
+        if column0 <= column1:
+            for row in range(row0, row1 + 1):
+                first = row * self.shape[0]
+                parts.append(self.items[self.starts[first + column0]:self.starts[first + column1 + 1]])
+        return numpy.unique(numpy.concatenate(parts))
+
+    def _rapid_filter(self, candidates, rapid):
+        if rapid is None:
+            return candidates
+        return candidates[self.segments['rapid'][candidates] == rapid]
+
+    def region(self, min_x, min_y, max_x, max_y, min_z=-numpy.inf, max_z=numpy.inf, rapid=None):
+        """
+            :param min_x: Box of the region in mm
+            :param rapid: None for all the moves, False for the feed moves and True for the G0 ones
+            :return: Dict with lines (sorted unique line numbers) and moves (indices) that pass through the region
+        """
+        column0, row0 = self._cells(numpy.array([min_x]), numpy.array([min_y]))
+        column1, row1 = self._cells(numpy.array([max_x]), numpy.array([max_y]))
+        outside = (max_x < self.origin[0] or max_y < self.origin[1] or
+                   min_x > self.origin[0] + self.shape[0] * self.cell or
+                   min_y > self.origin[1] + self.shape[1] * self.cell)
+        if outside:
+            candidates = self.oversize
+        else:
+            candidates = self._candidates(int(column0[0]), int(row0[0]), int(column1[0]), int(row1[0]))
+        candidates = self._rapid_filter(candidates, rapid)
+        # Clip the segments against the box (slab test)
+        enter = numpy.zeros(len(candidates))
+        leave = numpy.ones(len(candidates))
+        inside = numpy.ones(len(candidates), dtype=bool)
+        for axis, low, high in (('x', min_x, max_x), ('y', min_y, max_y), ('z', min_z, max_z)):
+            start = self.segments[axis + '0'][candidates]
+            delta = self.segments[axis][candidates] - start
+            moving = delta != 0
+            inside &= moving | ((start >= low) & (start <= high))
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                first = numpy.where(moving, (low - start) / delta, -numpy.inf)
+                second = numpy.where(moving, (high - start) / delta, numpy.inf)
+            enter = numpy.maximum(enter, numpy.minimum(first, second))
+            leave = numpy.minimum(leave, numpy.maximum(first, second))
+        found = candidates[inside & (enter <= leave)]
+        return {
+            'lines': numpy.unique(self.segments['line'][found]),
+            'moves': found,
+        }
+
+    def _distances(self, candidates, x, y, z):
+        squared = numpy.zeros(len(candidates))
+        axes = (('x', x), ('y', y)) + ((('z', z),) if z is not None else ())
+        starts = dict((axis, self.segments[axis + '0'][candidates]) for axis, _ in axes)
+        deltas = dict((axis, self.segments[axis][candidates] - starts[axis]) for axis, _ in axes)
+        length = sum(deltas[axis] ** 2 for axis, _ in axes)
+        dot = sum((value - starts[axis]) * deltas[axis] for axis, value in axes)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            fraction = numpy.clip(numpy.where(length > 0, dot / length, 0), 0, 1)
+        for axis, value in axes:
+            squared += (starts[axis] + fraction * deltas[axis] - value) ** 2
+        return numpy.sqrt(squared), fraction
+
+    def nearest(self, x, y, z=None, max_distance=None, rapid=None):
+        """
+            Search the rings of cells around the point until the nearest move is closer than the searched ring
+            :param x: X of the point
+            :param y: Y of the point
+            :param z: Z of the point, None for the XY distance
+            :param max_distance: Maximum distance in mm, None for no limit
+            :param rapid: None for all the moves, False for the feed moves and True for the G0 ones
+            :return: Dict with line, move (index), distance and point (x, y, z of the nearest point of the move) or
+            None if there is not any move in max_distance
+        """
+        column, row = self._cells(numpy.array([x]), numpy.array([y]))
+        column, row = int(column[0]), int(row[0])
+        # Distance from the point to the grid, the rings are counted from its cell
+        outside = numpy.hypot(max(self.origin[0] - x, 0, x - self.origin[0] - self.shape[0] * self.cell),
+                              max(self.origin[1] - y, 0, y - self.origin[1] - self.shape[1] * self.cell))
+        checked = numpy.zeros(len(self.segments['line']), dtype=bool)
+        best, best_index = numpy.inf, None
+        radius = 0
+        while True:
+            candidates = self._candidates(column - radius, row - radius, column + radius, row + radius)
+            candidates = self._rapid_filter(candidates[~checked[candidates]], rapid)
+            checked[candidates] = True
+            if len(candidates):
+                distances, _ = self._distances(candidates, x, y, z)
+                index = int(numpy.argmin(distances))
+                if distances[index] < best:
+                    best, best_index = float(distances[index]), int(candidates[index])
+            reach = max(outside, radius * self.cell)
+            covered = (column - radius <= 0 and row - radius <= 0 and column + radius >= self.shape[0] - 1 and
+                       row + radius >= self.shape[1] - 1)
+            if best <= reach or covered or (max_distance is not None and reach > max_distance):
+                break
+            radius += 1
+        if best_index is None or (max_distance is not None and best > max_distance):
+            return None
+        _, fraction = self._distances(numpy.array([best_index]), x, y, z)
+        point = tuple(float(self.segments[axis + '0'][best_index] + fraction[0] *
+                            (self.segments[axis][best_index] - self.segments[axis + '0'][best_index]))
+                      for axis in ('x', 'y', 'z'))
+        return {
+            'line': int(self.segments['line'][best_index]),
+            'move': best_index,
+            'distance': best,
+            'point': point,
+        }
+
+    @classmethod
+    def from_blocks(cls, blocks, tolerance=0.01, cell=None, max_cells=64):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :param tolerance: Maximum distance in mm between the arcs and their chords
+            :param cell: Size in mm of the cells, default automatic
+            :param max_cells: Maximum number of cells of a move in the grid
+            :return: SpatialIndex
+        """
+        return cls(moves(blocks, tolerance), cell=cell, max_cells=max_cells)
+
+    @classmethod
+    def from_file(cls, instruction_set, file_obj, tolerance=0.01, cell=None, max_cells=64, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet used for read the file
+            :param file_obj: File object with the codes
+            :param tolerance: Maximum distance in mm between the arcs and their chords
+            :param cell: Size in mm of the cells, default automatic
+            :param max_cells: Maximum number of cells of a move in the grid
+            :param kwargs: Parameters for ToolpathProcessor
+            :return: SpatialIndex
+        """
+        parts = [moves(blocks, tolerance) for blocks in ToolpathProcessor(instruction_set, file_obj,
+                                                                          **kwargs).chunks()]
+        if not parts:
+            raise GCodeException('File without moves')
+        segments = dict((key, numpy.concatenate([part[key] for part in parts])) for key in parts[0])
+        return cls(segments, cell=cell, max_cells=max_cells)
+
+    def save(self, file_obj):
+        """
+            :param file_obj: File object or filename where the index is written (numpy npz)
+        """
+        arrays = dict(('segment_' + key, value) for key, value in self.segments.items())
+        numpy.savez_compressed(file_obj, items=self.items, starts=self.starts, oversize=self.oversize,
+                               header=numpy.array([self.cell, self.origin[0], self.origin[1], self.shape[0],
+                                                   self.shape[1], self.max_cells]), **arrays)
+
+    @classmethod
+    def load(cls, file_obj):
+        """
+            :param file_obj: File object or filename written by save
+            :return: SpatialIndex
+        """
+        index = cls.__new__(cls)
+        with numpy.load(file_obj) as data:
+            cell, origin_x, origin_y, columns, rows, max_cells = data['header'].tolist()
+            index.segments = dict((key[len('segment_'):], data[key]) for key in data.files
+                                  if key.startswith('segment_'))
+            index.items = data['items']
+            index.starts = data['starts']
+            index.oversize = data['oversize']
+        index.cell = cell
+        index.origin = numpy.array([origin_x, origin_y])
+        index.shape = numpy.array([int(columns), int(rows)], dtype=numpy.int64)
+        index.max_cells = int(max_cells)
+        return index
@@ -0,0 +1,562 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+import numpy
+
+from py2gcode.processors import FileProcessor, DistanceProcessor
+
+CHUNK_SIZE = 65536
+MOTION_CODES = ('G0', 'G1', 'G2', 'G3')
+ARC_CODES = ('G2', 'G3')
+POSITION_CODES = ('G0', 'G1', 'G2', 'G3', 'G28', 'G92')
+AXES = ('x', 'y', 'z')
+WORDS = ('x', 'y', 'z', 'e', 'f', 'i', 'j', 'k')
+WORD_MASK = dict((word, 1 << n) for n, word in enumerate(WORDS))
+# Axes (u, v, w) and arc offsets (u, v) for G17, G18 and G19, w is the helical axis
+PLANE_AXES = {17: ('x', 'y', 'z'), 18: ('z', 'x', 'y'), 19: ('y', 'z', 'x')}
+PLANE_OFFSETS = {17: ('i', 'j'), 18: ('k', 'i'), 19: ('j', 'k')}
+
+RAW_DTYPE = numpy.dtype([
+    ('line', numpy.int64), ('offset', numpy.int64), ('code', 'U8'), ('plane', numpy.int8),
+    ('mm', numpy.bool_), ('abs', numpy.bool_), ('eabs', numpy.bool_), ('words', numpy.uint16),
+    ('x', numpy.float64), ('y', numpy.float64), ('z', numpy.float64), ('e', numpy.float64),
+    ('f', numpy.float64), ('i', numpy.float64), ('j', numpy.float64), ('k', numpy.float64),
+])
+"""Codes as read from the file, values in the units and mode of the file and NaN when not present"""
+
+BLOCK_DTYPE = numpy.dtype([
+    ('line', numpy.int64), ('offset', numpy.int64), ('code', 'U8'), ('plane', numpy.int8),
+    ('words', numpy.uint16),
+    ('x0', numpy.float64), ('y0', numpy.float64), ('z0', numpy.float64),
+    ('x', numpy.float64), ('y', numpy.float64), ('z', numpy.float64),
+    ('i', numpy.float64), ('j', numpy.float64), ('k', numpy.float64),
+    ('e', numpy.float64), ('de', numpy.float64), ('f', numpy.float64),
+])
+"""
+    Resolved codes, one row for each cleaned line of the file:
+    line and offset: line number (starting at 1) and byte offset of the line
+    code: Cleaned code ej: G1, plane: 17, 18 or 19, words: Bit mask of WORD_MASK with the words of the line
+    x0, y0, z0 and x, y, z: Absolute position in mm before and after the code
+    i, j, k: Arc center offsets in mm, e: Absolute extruder position, de: Extruded length by the code
+    f: Feed rate in mm/min (NaN while unknown)
+"""
+
+
+def format_number(value, precision=3):
+    """
+        :param value: Number to format
+        :param precision: Maximum number of decimals
+        :return: String without trailing zeros ej: 10, 1.5, -0.25
+    """
+    text = '%.*f' % (precision, value)
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    if text == '-0':
+        text = '0'
+    return text
+
+
+def format_numbers(values, precision=3):
+    """
+        format_number for arrays, the integer and decimal parts are formatted with numpy.char so there is no Python
+        loop over the values
+        :param values: Array of finite numbers
+        :param precision: Maximum number of decimals
+        :return: Array of strings with the shape of values
+    """
+    scaled = numpy.rint(numpy.asarray(values, dtype=numpy.float64) * 10 ** precision)
+    return format_integers(numpy.where(numpy.isfinite(scaled), scaled, 0).astype(numpy.int64), precision)
+
+
+def format_integers(scaled, precision=3):
+    """
+        Exact text of fixed point numbers, ej: 1500 with precision 3 is 1.5
+        :param scaled: Array of integers, the numbers multiplied by 10 ** precision
+        :param precision: Number of decimals of the scale
+        :return: Array of strings without trailing zeros with the shape of scaled
+    """
+    scaled = numpy.asarray(scaled, dtype=numpy.int64)
+    if not scaled.size:
+        return numpy.zeros(scaled.shape, dtype='U1')
+    return numpy.array(_join_lines([_integer_bytes(scaled.ravel(), precision)])).reshape(scaled.shape)
+
+
+def _integer_bytes(scaled, precision=3):
+    """
+        format_integers as ascii, the digits are written with integer operations over the whole array
+        :param scaled: Array (N,) of integers, the numbers multiplied by 10 ** precision
+        :param precision: Number of decimals of the scale
+        :return: Array (N, width) of uint8 with the text of each number, 0 where there is no character
+    """
+    precision = max(precision, 0)
+    negative = scaled < 0
+    rest = numpy.abs(scaled)
+    size = max(len(str(int(rest.max()))) if len(rest) else 1, precision + 1)
+    digits = numpy.empty((len(rest), size), dtype=numpy.uint8)
+    for column in range(size - 1, -1, -1):
+        rest, digits[:, column] = numpy.divmod(rest, 10)
+    integer = size - precision
+    # position of the first digit of the integer part, the units are always written
+    first = numpy.argmax(numpy.column_stack((digits[:, :integer - 1], numpy.ones(len(digits), numpy.uint8))) > 0,
+                         axis=1)
+    # number of decimals without the trailing zeros
+    decimals = precision - numpy.argmax(numpy.column_stack((
+        digits[:, :integer - 1:-1], numpy.ones(len(digits), numpy.uint8))) > 0, axis=1)
+    width = size + 2
+    text = numpy.zeros((len(digits), width), dtype=numpy.uint8)
+    text[:, 1:integer + 1] = digits[:, :integer] + ord('0')
+    text[:, integer + 2:] = digits[:, integer:] + ord('0')
+    text[:, integer + 1] = ord('.')
+    rows = numpy.arange(len(digits))
+    text[rows[negative], first[negative]] = ord('-')
+    start = first + ~negative
+    end = integer + 1 + numpy.where(decimals > 0, decimals + 1, 0)
+    index = numpy.arange(width)
+    text[(index < start[:, None]) | (index >= end[:, None])] = 0
+    return text
+
+
+def _join_lines(columns):
+    """
+        Join the texts of each row of columns in one pass
+        :param columns: List of arrays (N, width) of uint8 with ascii texts, the 0 are skipped, ej: from _integer_bytes
+        :return: List of N strings
+    """
+    if not len(columns[0]):
+        return []
+    text = numpy.hstack(list(columns) + [numpy.full((len(columns[0]), 1), ord('\n'), dtype=numpy.uint8)]).ravel()
+    return text[text > 0].tobytes().decode('ascii').split('\n')[:-1]
+
+
+def _text_bytes(texts):
+    """
+        :param texts: Array (N,) of ascii strings
+        :return: Array (N, width) of uint8 with the texts filled with 0
+    """
+    texts = numpy.asarray(texts).astype(bytes)
+    return texts.view(numpy.uint8).reshape(len(texts), texts.dtype.itemsize)
+
+
+def is_motion(blocks):
+    """
+        :param blocks: Array of BLOCK_DTYPE
+        :return: Boolean array with the G0, G1, G2 and G3 rows
+    """
+    return numpy.isin(blocks['code'], MOTION_CODES)
+
+
+def is_arc(blocks):
+    """
+        :param blocks: Array of BLOCK_DTYPE
+        :return: Boolean array with the G2 and G3 rows
+    """
+    return numpy.isin(blocks['code'], ARC_CODES)
+
+
+def plane_coordinates(blocks):
+    """
+        Coordinates of the blocks in their arc plane, see PLANE_AXES
+        :param blocks: Array of BLOCK_DTYPE
+        :return: Dict with u0, v0, w0, u, v, w, cu, cv (arc center) arrays
+    """
+    size = len(blocks)
+    coords = dict((key, numpy.empty(size)) for key in ('u0', 'v0', 'w0', 'u', 'v', 'w', 'cu', 'cv'))
+    for plane in PLANE_AXES:
+        mask = blocks['plane'] == plane
+        if plane == 17:
+            mask |= ~numpy.isin(blocks['plane'], list(PLANE_AXES))
+        if not mask.any():
+            continue
+        u, v, w = PLANE_AXES[plane]
+        ou, ov = PLANE_OFFSETS[plane]
+        rows = blocks[mask]
+        coords['u0'][mask] = rows[u + '0']
+        coords['v0'][mask] = rows[v + '0']
+        coords['w0'][mask] = rows[w + '0']
+        coords['u'][mask] = rows[u]
+        coords['v'][mask] = rows[v]
+        coords['w'][mask] = rows[w]
+        coords['cu'][mask] = rows[u + '0'] + rows[ou]
+        coords['cv'][mask] = rows[v + '0'] + rows[ov]
+    return coords
+
+
+def arc_geometry(blocks):
+    """
+        Geometry of arcs, G2 turn clockwise (negative sweep) and G3 counter clockwise in the plane coordinates.
+        An arc with the same start and end point is a full circle
+        :param blocks: Array of BLOCK_DTYPE with G2 or G3 codes
+        :return: Dict of plane_coordinates() plus radius, start (angle) and sweep arrays in radians
+    """
+    geometry = plane_coordinates(blocks)
+    du0 = geometry['u0'] - geometry['cu']
+    dv0 = geometry['v0'] - geometry['cv']
+    start = numpy.arctan2(dv0, du0)
+    end = numpy.arctan2(geometry['v'] - geometry['cv'], geometry['u'] - geometry['cu'])
+    clockwise = blocks['code'] == 'G2'
+    sweep = numpy.where(clockwise, -numpy.mod(start - end, 2 * numpy.pi), numpy.mod(end - start, 2 * numpy.pi))
+    full = numpy.isclose(sweep, 0)
+    sweep[full] = numpy.where(clockwise[full], -2 * numpy.pi, 2 * numpy.pi)
+    geometry['radius'] = numpy.hypot(du0, dv0)
+    geometry['start'] = start
+    geometry['sweep'] = sweep
+    return geometry
+
+
+def interpolate_arcs(blocks, counts):
+    """
+        Points along arcs, arc n is split in counts[n] chords of the same angle
+        :param blocks: Array of BLOCK_DTYPE with G2 or G3 codes
+        :param counts: Array with the number of chords of each arc (at least 1)
+        :return: Dict with parents (index of the arc), fraction (of the sweep) and x, y, z arrays with the end point
+        of each chord, the last point of each arc is its end point
+    """
+    counts = numpy.maximum(numpy.asarray(counts, dtype=numpy.int64), 1)
+    geometry = arc_geometry(blocks)
+    parents = numpy.repeat(numpy.arange(len(blocks)), counts)
+    first = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    fraction = (numpy.arange(len(parents)) - first[parents] + 1.0) / counts[parents]
+    angle = geometry['start'][parents] + geometry['sweep'][parents] * fraction
+    radius = geometry['radius'][parents]
+    local = {
+        'u': geometry['cu'][parents] + radius * numpy.cos(angle),
+        'v': geometry['cv'][parents] + radius * numpy.sin(angle),
+        'w': geometry['w0'][parents] + (geometry['w'] - geometry['w0'])[parents] * fraction,
+    }
+    last = fraction == 1
+    for key in ('u', 'v'):
+        local[key][last] = geometry[key][parents[last]]
+    points = {'parents': parents, 'fraction': fraction}
+    for axis in AXES:
+        points[axis] = numpy.empty(len(parents))
+    planes = blocks['plane'][parents]
+    for plane in PLANE_AXES:
+        mask = planes == plane
+        if plane == 17:
+            mask |= ~numpy.isin(planes, list(PLANE_AXES))
+        for key, axis in zip(('u', 'v', 'w'), PLANE_AXES[plane]):
+            points[axis][mask] = local[key][mask]
+    return points
+
+
+def extents(blocks):
+    """
+        Bounding box of each block, arcs included
+        :param blocks: Array of BLOCK_DTYPE
+        :return: Dict with min_x, max_x, min_y, max_y, min_z and max_z arrays
+    """
+    bounds = {}
+    for axis in AXES:
+        bounds['min_' + axis] = numpy.minimum(blocks[axis + '0'], blocks[axis])
+        bounds['max_' + axis] = numpy.maximum(blocks[axis + '0'], blocks[axis])
+    arcs = numpy.flatnonzero(is_arc(blocks))
+    if not len(arcs):
+        return bounds
+    geometry = arc_geometry(blocks[arcs])
+    planes = blocks['plane'][arcs]
+    for angle in (0, numpy.pi / 2, numpy.pi, 3 * numpy.pi / 2):
+        forward = numpy.mod(angle - geometry['start'], 2 * numpy.pi)
+        backward = numpy.mod(geometry['start'] - angle, 2 * numpy.pi)
+        inside = numpy.where(geometry['sweep'] > 0, forward <= geometry['sweep'], backward <= -geometry['sweep'])
+        local = {
+            'u': geometry['cu'] + geometry['radius'] * numpy.cos(angle),
+            'v': geometry['cv'] + geometry['radius'] * numpy.sin(angle),
+        }
+        for plane in PLANE_AXES:
+            mask = inside & (planes == plane)
+            if plane == 17:
+                mask |= inside & ~numpy.isin(planes, list(PLANE_AXES))
+            if not mask.any():
+                continue
+            for key, axis in zip(('u', 'v'), PLANE_AXES[plane][:2]):
+                rows = arcs[mask]
+                bounds['min_' + axis][rows] = numpy.minimum(bounds['min_' + axis][rows], local[key][mask])
+                bounds['max_' + axis][rows] = numpy.maximum(bounds['max_' + axis][rows], local[key][mask])
+    return bounds
+
+
+def segment_lengths(blocks):
+    """
+        :param blocks: Array of BLOCK_DTYPE
+        :return: Array with the travelled distance in mm of each block, arcs included
+    """
+    lengths = numpy.sqrt((blocks['x'] - blocks['x0']) ** 2 + (blocks['y'] - blocks['y0']) ** 2 +
+                         (blocks['z'] - blocks['z0']) ** 2)
+    lengths[blocks['code'] == 'G92'] = 0
+    arcs = is_arc(blocks)
+    if arcs.any():
+        geometry = arc_geometry(blocks[arcs])
+        lengths[arcs] = numpy.hypot(geometry['radius'] * geometry['sweep'], geometry['w'] - geometry['w0'])
+    return lengths
+
+
+def _forward_fill(values, mask, carry):
+    """
+        :param values: Array of values
+        :param mask: Boolean array with the rows that set a new value
+        :param carry: Value before the first row
+        :return: Array where each row has the last set value
+    """
+    index = numpy.where(mask, numpy.arange(len(values)), -1)
+    numpy.maximum.accumulate(index, out=index)
+    return numpy.where(index >= 0, values[numpy.maximum(index, 0)], carry)
+
+
+def resolve(raw, position):
+    """
+        Vectorized resolution of the modal state (units, absolute/relative, extruder mode, feed) of a chunk
+        :param raw: Array of RAW_DTYPE
+        :param position: Dict with x, y, z, e and f before the chunk, it is updated with the values after it
+        :return: Array of BLOCK_DTYPE
+    """
+    blocks = numpy.zeros(len(raw), dtype=BLOCK_DTYPE)
+    for key in ('line', 'offset', 'code', 'plane', 'words'):
+        blocks[key] = raw[key]
+    if len(raw) == 0:
+        return blocks
+    scale = numpy.where(raw['mm'], 1.0, 1.0 / DistanceProcessor.INCH_2_MM)
+    code = raw['code']
+    positional = numpy.isin(code, POSITION_CODES)
+    setting = code == 'G92'
+    homing = code == 'G28'
+    specified = dict((axis, positional & ~numpy.isnan(raw[axis])) for axis in AXES)
+    home_all = homing & ~(specified['x'] | specified['y'] | specified['z'])
+
+    for axis in AXES + ('e',):
+        value = raw[axis] * scale
+        if axis == 'e':
+            given = positional & ~homing & ~numpy.isnan(value)
+            absolute = raw['eabs'] | setting
+            home = numpy.zeros(len(raw), dtype=bool)
+        else:
+            given = specified[axis]
+            absolute = raw['abs'] | setting
+            home = homing & (given | home_all)
+            value = numpy.where(home, 0.0, value)
+        is_set = (given & absolute) | home
+        delta = numpy.where(given & ~is_set, value, 0.0)
+        cumulative = numpy.cumsum(delta)
+        anchor = _forward_fill(value - cumulative, is_set, position[axis])
+        end = anchor + cumulative
+        start = numpy.empty_like(end)
+        start[0] = position[axis]
+        start[1:] = end[:-1]
+        position[axis] = end[-1]
+        if axis == 'e':
+            blocks['e'] = end
+            blocks['de'] = numpy.where(setting, 0.0, end - start)
+        else:
+            blocks[axis + '0'] = start
+            blocks[axis] = end
+
+    feed = numpy.isin(code, MOTION_CODES) & ~numpy.isnan(raw['f'])
+    blocks['f'] = _forward_fill(raw['f'] * scale, feed, position['f'])
+    position['f'] = blocks['f'][-1]
+    for offset in ('i', 'j', 'k'):
+        blocks[offset] = numpy.nan_to_num(raw[offset] * scale)
+    return blocks
+
+
+class ToolpathProcessor(FileProcessor):
+    """
+        File processor that resolves every cleaned code in numpy arrays of BLOCK_DTYPE with absolute
+        millimetres, chunk_size lines at a time so big files are processed with bounded memory
+    """
+
+    def __init__(self, instruction_set, file_obj, mm=True, absolute=True, extruder_absolute=True,
+                 chunk_size=CHUNK_SIZE, diagnostics=None):
+        """
+            :param instruction_set: StandardInstructionSet used for clean the codes
+            :param file_obj: File object with the codes
+            :param mm: Boolean units at start, True for G21 False for G20
+            :param absolute: Boolean mode at start, True for G90 False for G91
+            :param extruder_absolute: Boolean extruder mode at start, True for M82 False for M83
+            :param chunk_size: Number of codes of each chunk
+            :param diagnostics: Diagnostics for the comments and errors
+        """
+        FileProcessor.__init__(self, instruction_set, file_obj, diagnostics=diagnostics)
+        self.init_mm = mm
+        self.init_abs = absolute
+        self.init_extruder_abs = extruder_absolute
+        self.chunk_size = chunk_size
+        self.codes = {}
+        self.reset_state()
+
+    def reset_state(self):
+        self.mm = self.init_mm
+        self.abs = self.init_abs
+        self.extruder_abs = self.init_extruder_abs
+        self.plane = 17
+        self.position = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'e': 0.0, 'f': numpy.nan}
+        self._row = None
+
+    def on_start(self):
+        FileProcessor.on_start(self)
+        self.reset_state()
+        self.codes = {}
+
+    def callback_manager(self, gcode=None, **kwargs):
+        FileProcessor.callback_manager(self, gcode=gcode, **kwargs)
+        self.update_modes(gcode)
+        self._row = self.make_row(gcode, kwargs)
+
+    def update_modes(self, gcode):
+        if gcode in ['G20', 'G21']:
+            self.mm = gcode == 'G21'
+        elif gcode in ['G90', 'G91']:
+            self.abs = gcode == 'G90'
+            self.extruder_abs = self.abs
+        elif gcode in ['M82', 'M83']:
+            self.extruder_abs = gcode == 'M82'
+        elif gcode in ['G17', 'G18', 'G19']:
+            self.plane = int(gcode[1:])
+
+    def make_row(self, gcode, kwargs):
+        """
+            :param gcode: Cleaned code ej: G1
+            :param kwargs: Dict with the words of the code
+            :return: Tuple with the row of RAW_DTYPE of the code
+        """
+        words = 0
+        values = []
+        for word in WORDS:
+            value = kwargs.get(word, None)
+            if value is None:
+                values.append(numpy.nan)
+            else:
+                values.append(float(value))
+                words |= WORD_MASK[word]
+        return (self.line_number, self.offset, gcode, self.plane,
+                self.mm, self.abs, self.extruder_abs, words) + tuple(values)
+
+    def resolve_rows(self, rows):
+        """
+            :param rows: List of rows of make_row
+            :return: Array of BLOCK_DTYPE, self.position is updated with the position after the rows
+        """
+        return resolve(numpy.array(rows, dtype=RAW_DTYPE), self.position)
+
+    def chunks(self, raise_exception=False):
+        """
+            Generator of resolved chunks, while a chunk is used self.codes has the cleaned code of each line
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: Generator of arrays of BLOCK_DTYPE
+        """
+        rows = []
+        for code in self.read(raise_exception=raise_exception):
+            if self._row is None:
+                continue
+            rows.append(self._row)
+            self.codes[self._row[0]] = code.rstrip()
+            self._row = None
+            if len(rows) >= self.chunk_size:
+                yield self.resolve_rows(rows)
+                rows = []
+                self.codes = {}
+        if rows:
+            yield self.resolve_rows(rows)
+        self.codes = {}
+
+    def toolpath(self, raise_exception=False):
+        """
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: Array of BLOCK_DTYPE with all the codes of the file
+        """
+        chunks = list(self.chunks(raise_exception=raise_exception))
+        if not chunks:
+            return self.resolve_rows([])
+        return numpy.concatenate(chunks)
+
+
+def subdivide(blocks, parents, start, end):
+    """
+        Split linear blocks in pieces, the rows not present in parents are kept as they are
+        :param blocks: Array of BLOCK_DTYPE
+        :param parents: Sorted array with the index of the block of each piece
+        :param start: Array with the fraction of the block where each piece starts
+        :param end: Array with the fraction of the block where each piece ends
+        :return: Array of BLOCK_DTYPE with the pieces in place of their blocks
+    """
+    counts = numpy.ones(len(blocks), dtype=numpy.int64)
+    split = numpy.unique(parents)
+    counts[split] = numpy.bincount(parents, minlength=len(blocks))[split]
+    result = numpy.repeat(blocks, counts)
+    fraction0 = numpy.zeros(len(result))
+    fraction1 = numpy.ones(len(result))
+    first = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    pieces = first[parents] + (numpy.arange(len(parents)) - numpy.searchsorted(parents, parents))
+    fraction0[pieces] = start
+    fraction1[pieces] = end
+    for axis in AXES:
+        origin = result[axis + '0'].copy()
+        delta = result[axis] - origin
+        result[axis + '0'] = origin + delta * fraction0
+        result[axis] = origin + delta * fraction1
+    extruded = result['de'].copy()
+    origin = result['e'] - extruded
+    result['e'] = origin + extruded * fraction1
+    result['de'] = extruded * (fraction1 - fraction0)
+    result['words'][fraction0 > 0] &= ~numpy.uint16(WORD_MASK['f'])
+    return result
+
+
+def linearize_arcs(blocks, tolerance=0.01, max_length=None):
+    """
+        Replace the arcs by G1 chords, the number of chords of each arc is the minimum that keeps the distance between
+        the chords and the arc under the tolerance (so it grows with the radius) and the chords under max_length.
+        The extrusion and the helical axis are distributed proportionally to the swept angle
+        :param blocks: Array of BLOCK_DTYPE
+        :param tolerance: Maximum distance in mm between the chords and the arc
+        :param max_length: Maximum length in mm of the chords, None for no limit
+        :return: Array of BLOCK_DTYPE without G2 and G3
+    """
+    arcs = numpy.flatnonzero(is_arc(blocks))
+    if not len(arcs):
+        return blocks
+    rows = blocks[arcs]
+    geometry = arc_geometry(rows)
+    radius = geometry['radius']
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        step = 2 * numpy.arccos(numpy.clip(1 - tolerance / radius, -1, 1))
+        counts = numpy.ceil(numpy.abs(geometry['sweep']) / step)
+    counts = numpy.where(numpy.isfinite(counts), counts, 1)
+    if max_length:
+        length = numpy.hypot(radius * geometry['sweep'], geometry['w'] - geometry['w0'])
+        counts = numpy.maximum(counts, numpy.ceil(length / max_length))
+    counts = numpy.maximum(counts, 1).astype(numpy.int64)
+    points = interpolate_arcs(rows, counts)
+
+    repeat = numpy.ones(len(blocks), dtype=numpy.int64)
+    repeat[arcs] = counts
+    result = numpy.repeat(blocks, repeat)
+    pieces = numpy.repeat(is_arc(blocks), repeat)
+    parents = points['parents']
+    start = numpy.concatenate(([True], parents[1:] != parents[:-1]))
+    for axis in AXES:
+        previous = numpy.concatenate(([0], points[axis][:-1]))
+        result[axis + '0'][pieces] = numpy.where(start, result[axis + '0'][pieces], previous)
+        result[axis][pieces] = points[axis]
+    fraction0 = numpy.where(start, 0, numpy.concatenate(([0], points['fraction'][:-1])))
+    extruded = result['de'][pieces]
+    result['e'][pieces] = result['e'][pieces] - extruded * (1 - points['fraction'])
+    result['de'][pieces] = extruded * (points['fraction'] - fraction0)
+    result['code'][pieces] = 'G1'
+    for offset in ('i', 'j', 'k'):
+        result[offset][pieces] = 0
+    result['words'][pieces] = numpy.where(start, result['words'][pieces] & numpy.uint16(WORD_MASK['f']), 0)
+    return result
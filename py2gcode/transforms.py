@@ -0,0 +1,775 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    author: Victor Torre
+
+    Copyright (C) 2018 [Victor Torre](https://github.com/ehooo)
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy of
+    the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations under
+    the License.
+"""
+from __future__ import absolute_import
+
+from datetime import timedelta
+
+import numpy
+import six
+
+from py2gcode.py2gcode import GCodeException
+from py2gcode.processors import DistanceProcessor, SpeedProcessor
+from py2gcode.toolpath import ToolpathProcessor, CHUNK_SIZE, AXES, MOTION_CODES, PLANE_AXES, WORD_MASK, is_arc, \
+    arc_geometry, format_number, linearize_arcs, segment_lengths, subdivide
+
+MODAL_CODES = ('G20', 'G21', 'G90', 'G91', 'M82', 'M83')
+
+
+class AffineTransform():
+    """
+        Affine transform of XYZ coordinates, the operations are applied in the same order that they are called
+        ej: AffineTransform().rotate(90).translate(x=10)
+    """
+
+    def __init__(self, matrix=None):
+        """
+            :param matrix: 4x4 matrix, default identity
+        """
+        if matrix is None:
+            matrix = numpy.identity(4)
+        self.matrix = numpy.array(matrix, dtype=numpy.float64)
+
+    def _compose(self, matrix, origin=(0, 0, 0)):
+        origin = numpy.resize(numpy.array(origin, dtype=numpy.float64), 3)
+        to_origin = numpy.identity(4)
+        to_origin[:3, 3] = -origin
+        from_origin = numpy.identity(4)
+        from_origin[:3, 3] = origin
+        self.matrix = from_origin.dot(matrix).dot(to_origin).dot(self.matrix)
+        return self
+
+    def translate(self, x=0, y=0, z=0):
+        matrix = numpy.identity(4)
+        matrix[:3, 3] = (x, y, z)
+        return self._compose(matrix)
+
+    def scale(self, x=1, y=None, z=None, origin=(0, 0, 0)):
+        """
+            :param x: Scale factor for X, also used for Y and Z when they are None
+            :param y: Scale factor for Y
+            :param z: Scale factor for Z
+            :param origin: Fixed point of the scale
+        """
+        if y is None:
+            y = x
+        if z is None:
+            z = x
+        return self._compose(numpy.diag((x, y, z, 1.0)), origin)
+
+    def rotate(self, angle, origin=(0, 0, 0)):
+        """
+            :param angle: Counter clockwise angle in degrees around Z axis
+            :param origin: Center of the rotation
+        """
+        rad = numpy.radians(angle)
+        matrix = numpy.identity(4)
+        matrix[:2, :2] = ((numpy.cos(rad), -numpy.sin(rad)), (numpy.sin(rad), numpy.cos(rad)))
+        return self._compose(matrix, origin)
+
+    def mirror(self, x=False, y=False, z=False, origin=(0, 0, 0)):
+        """
+            :param x: Boolean for mirror the X coordinates
+            :param y: Boolean for mirror the Y coordinates
+            :param z: Boolean for mirror the Z coordinates
+            :param origin: Point of the mirror planes
+        """
+        return self._compose(numpy.diag((-1.0 if x else 1.0, -1.0 if y else 1.0, -1.0 if z else 1.0, 1.0)), origin)
+
+    def apply(self, points):
+        """
+            :param points: Nx3 array of points
+            :return: Nx3 array of transformed points
+        """
+        return points.dot(self.matrix[:3, :3].T) + self.matrix[:3, 3]
+
+    def apply_vectors(self, vectors):
+        """
+            :param vectors: Nx3 array of vectors, ej: arc offsets
+            :return: Nx3 array of transformed vectors, the translation is not applied
+        """
+        return vectors.dot(self.matrix[:3, :3].T)
+
+    def flips_arcs(self):
+        """
+            :return: True if the transform mirrors the XY plane, so G2 and G3 have to be swapped
+        """
+        return numpy.linalg.det(self.matrix[:2, :2]) < 0
+
+    def keeps_arcs(self):
+        """
+            :return: True if XY arcs are still circles in the XY plane after the transform
+        """
+        linear = self.matrix[:2, :2]
+        square = linear.T.dot(linear)
+        return (numpy.allclose(square, square[0, 0] * numpy.identity(2)) and
+                numpy.allclose(self.matrix[2, :2], 0) and numpy.allclose(self.matrix[:2, 2], 0))
+
+
+class TransformProcessor(ToolpathProcessor):
+    """
+        Streaming stage that rewrites a file in absolute millimetres (G21, G90 and M82 when supported) applying an
+        AffineTransform, the output is generated by the instruction set.
+        Subclasses can change the geometry overriding transform_chunk
+    """
+
+    def __init__(self, instruction_set, file_obj, transform=None, e_scale=1.0, f_scale=1.0, precision=3,
+                 e_precision=5, mm=True, absolute=True, extruder_absolute=True, chunk_size=CHUNK_SIZE,
+                 diagnostics=None, output_set=None):
+        """
+            :param instruction_set: StandardInstructionSet used for clean and write the codes
+            :param file_obj: File object with the codes
+            :param transform: AffineTransform, default identity so only the units and modes are normalized
+            :param e_scale: Scale factor for the extrusion
+            :param f_scale: Scale factor for the feed rates
+            :param precision: Decimals for the coordinates and feed rates
+            :param e_precision: Decimals for the extrusion
+            :param output_set: StandardInstructionSet used for write the moves, default instruction_set
+        """
+        ToolpathProcessor.__init__(self, instruction_set, file_obj, mm=mm, absolute=absolute,
+                                   extruder_absolute=extruder_absolute, chunk_size=chunk_size,
+                                   diagnostics=diagnostics)
+        if transform is None:
+            transform = AffineTransform()
+        self.transform = transform
+        self.e_scale = e_scale
+        self.f_scale = f_scale
+        self.precision = precision
+        self.e_precision = e_precision
+        self.output_set = output_set if output_set is not None else instruction_set
+        self.last_words = {}
+
+    def on_start(self):
+        ToolpathProcessor.on_start(self)
+        self.last_words = {}
+
+    def transform_chunk(self, blocks):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :return: Array of BLOCK_DTYPE with the transformed geometry
+            :raise GCodeException: If the transform can not be applied to the arcs
+        """
+        arcs = is_arc(blocks)
+        if arcs.any() and not self.transform.keeps_arcs():
+            raise GCodeException('Arcs at line %s can not be transformed, only XY rotation, mirror, translation and '
+                                 'uniform XY scale are valid' % blocks['line'][arcs][0])
+        blocks = blocks.copy()
+        for keys in (('x0', 'y0', 'z0'), AXES):
+            points = self.transform.apply(numpy.column_stack([blocks[key] for key in keys]))
+            for n, key in enumerate(keys):
+                blocks[key] = points[:, n]
+        offsets = self.transform.apply_vectors(numpy.column_stack((blocks['i'], blocks['j'], blocks['k'])))
+        for n, key in enumerate(('i', 'j', 'k')):
+            blocks[key] = offsets[:, n]
+        if self.transform.flips_arcs():
+            clockwise = blocks['code'] == 'G2'
+            blocks['code'][arcs & clockwise] = 'G3'
+            blocks['code'][arcs & ~clockwise] = 'G2'
+        blocks['e'] *= self.e_scale
+        blocks['de'] *= self.e_scale
+        blocks['f'] *= self.f_scale
+        return blocks
+
+    def header(self):
+        """
+            :return: List of codes that set the modes of the output
+        """
+        codes = [self.output_set.set_mm(), self.output_set.set_absolute()]
+        try:
+            codes.append(self.output_set.extruder_absolute())
+        except AttributeError:
+            pass
+        return [code for code in codes if code]
+
+    def _format(self, word, value):
+        if word == 'e':
+            return format_number(value, self.e_precision)
+        return format_number(value, self.precision)
+
+    def emit_block(self, block):
+        """
+            :param block: Row of BLOCK_DTYPE
+            :return: String with the code for the row or None if the row is not written
+        """
+        gcode = str(block['code'])
+        if gcode in MODAL_CODES:
+            return None
+        if gcode == 'G28':
+            for axis in AXES:
+                self.last_words.pop(axis, None)
+        if gcode not in ('G0', 'G1', 'G2', 'G3', 'G92'):
+            return self.codes.get(int(block['line']), None)
+        try:
+            code = getattr(self.output_set, gcode)
+        except AttributeError:
+            raise GCodeException('%s at line %s is not supported by %s' % (
+                gcode, block['line'], self.output_set.__class__.__name__))
+        words = int(block['words'])
+        kwargs = {}
+        required = list(code.required_params)
+        for word in AXES + ('e', 'f', 'i', 'j', 'k'):
+            if word not in code.valid_params:
+                continue
+            if word in ('i', 'j', 'k'):
+                if word in required or words & WORD_MASK[word]:
+                    kwargs[word] = self._format(word, block[word])
+                continue
+            if gcode == 'G92' and not words & WORD_MASK[word]:
+                continue
+            if word == 'e' and not block['de'] and not words & WORD_MASK[word]:
+                continue
+            if word == 'f' and numpy.isnan(block['f']):
+                continue
+            value = self._format(word, block[word])
+            last = self.last_words.get(word, None)
+            if last is None and word in AXES:
+                last = self._format(word, block[word + '0'])
+            if word in required or words & WORD_MASK[word] or last != value:
+                kwargs[word] = value
+        if gcode != 'G92':
+            for word in AXES + ('e', 'f'):
+                if word in kwargs:
+                    self.last_words[word] = kwargs[word]
+        else:
+            for word in kwargs:
+                self.last_words[word] = kwargs[word]
+        if not kwargs:
+            return None
+        return code.get(**kwargs)
+
+    def process(self, raise_exception=False):
+        """
+            Generator with the transformed codes of the file
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: Generator of strings with the codes
+        """
+        for code in self.header():
+            yield "%s\r\n" % code
+        for blocks in self.chunks(raise_exception=raise_exception):
+            for block in self.transform_chunk(blocks):
+                code = self.emit_block(block)
+                if code is None:
+                    continue
+                yield "%s\r\n" % code
+
+    def write(self, file_obj, raise_exception=False):
+        """
+            :param file_obj: File object for write the transformed codes
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+        """
+        for code in self.process(raise_exception=raise_exception):
+            file_obj.write(code)
+
+    def report(self, raise_exception=False):
+        """
+            Transform the file in memory and estimate the time of the original and the transformed codes with
+            SpeedProcessor
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: Dict with before, after and saved (timedelta) and ratio (after / before)
+        """
+        output = six.StringIO()
+        self.write(output, raise_exception=raise_exception)
+        output.seek(0)
+        times = []
+        for instruction_set, file_obj, mm, absolute in ((self.instruction_set, self.file, self.init_mm, self.init_abs),
+                                                        (self.output_set, output, True, True)):
+            processor = SpeedProcessor(instruction_set, file_obj, mm=mm, absolute=absolute)
+            for _ in processor.read():
+                pass
+            times.append(processor.time)
+        before, after = times
+        return {
+            'before': before,
+            'after': after,
+            'saved': before - after,
+            'ratio': after.total_seconds() / before.total_seconds() if before.total_seconds() else 1.0,
+        }
+
+
+class BedMesh():
+    """
+        Probed heights of the bed in a regular grid, heights[row][column] is the height at
+        x = origin[0] + column * spacing[0], y = origin[1] + row * spacing[1]
+    """
+
+    def __init__(self, heights, origin=(0, 0), spacing=(10, 10)):
+        """
+            :param heights: 2D array with at least 2x2 heights
+            :param origin: X and Y of heights[0][0]
+            :param spacing: Distance between columns (X) and rows (Y)
+        """
+        self.heights = numpy.array(heights, dtype=numpy.float64)
+        if self.heights.ndim != 2 or min(self.heights.shape) < 2:
+            raise GCodeException('The mesh needs at least 2x2 heights')
+        self.origin = (float(origin[0]), float(origin[1]))
+        self.spacing = (float(spacing[0]), float(spacing[1]))
+
+    @classmethod
+    def from_probes(cls, points):
+        """
+            :param points: List of (x, y, z) probed in a regular grid
+            :return: BedMesh
+        """
+        points = numpy.array(points, dtype=numpy.float64)
+        xs = numpy.unique(points[:, 0])
+        ys = numpy.unique(points[:, 1])
+        heights = numpy.full((len(ys), len(xs)), numpy.nan)
+        heights[numpy.searchsorted(ys, points[:, 1]), numpy.searchsorted(xs, points[:, 0])] = points[:, 2]
+        if numpy.isnan(heights).any():
+            raise GCodeException('The probed points are not a full grid')
+        return cls(heights, origin=(xs[0], ys[0]), spacing=(numpy.diff(xs).mean(), numpy.diff(ys).mean()))
+
+    def offset(self, x, y):
+        """
+            Bilinear interpolation of the heights, outside the mesh the border heights are used
+            :param x: Array of X
+            :param y: Array of Y
+            :return: Array with the Z offsets
+        """
+        rows, columns = self.heights.shape
+        u = numpy.clip((numpy.asarray(x, dtype=numpy.float64) - self.origin[0]) / self.spacing[0], 0, columns - 1)
+        v = numpy.clip((numpy.asarray(y, dtype=numpy.float64) - self.origin[1]) / self.spacing[1], 0, rows - 1)
+        column = numpy.minimum(u.astype(numpy.int64), columns - 2)
+        row = numpy.minimum(v.astype(numpy.int64), rows - 2)
+        fu = u - column
+        fv = v - row
+        bottom = self.heights[row, column] * (1 - fu) + self.heights[row, column + 1] * fu
+        top = self.heights[row + 1, column] * (1 - fu) + self.heights[row + 1, column + 1] * fu
+        return bottom * (1 - fv) + top * fv
+
+
+class MeshCompensationProcessor(TransformProcessor):
+    """
+        TransformProcessor that adds the BedMesh offset to Z, the G0 and G1 moves are split where the chord
+        separates from the surface more than the tolerance
+    """
+    SAMPLES = 7
+
+    def __init__(self, instruction_set, file_obj, mesh, tolerance=0.01, fade_height=None, max_depth=10, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet used for clean and write the codes
+            :param file_obj: File object with the codes
+            :param mesh: BedMesh
+            :param tolerance: Maximum Z error in mm between the moves and the surface
+            :param fade_height: Height in mm where the compensation is faded out, None for always compensate
+            :param max_depth: Maximum number of times a move is halved
+            :param kwargs: Parameters for TransformProcessor
+        """
+        TransformProcessor.__init__(self, instruction_set, file_obj, **kwargs)
+        self.mesh = mesh
+        self.tolerance = tolerance
+        self.fade_height = fade_height
+        self.max_depth = max_depth
+
+    def z_offset(self, x, y, z):
+        """
+            :return: Array with the Z offset for the points
+        """
+        offset = self.mesh.offset(x, y)
+        if self.fade_height:
+            offset *= numpy.clip(1 - numpy.asarray(z) / self.fade_height, 0, 1)
+        return offset
+
+    def split_moves(self, blocks):
+        """
+            Halve the linear moves while the surface separates from the chord of the piece more than the tolerance
+            :param blocks: Array of BLOCK_DTYPE
+            :return: Array of BLOCK_DTYPE
+        """
+        moves = numpy.isin(blocks['code'], ('G0', 'G1'))
+        moves &= (blocks['x'] != blocks['x0']) | (blocks['y'] != blocks['y0'])
+        parents = numpy.flatnonzero(moves)
+        start = numpy.zeros(len(parents))
+        end = numpy.ones(len(parents))
+        done = ([], [], [])
+        samples = numpy.arange(1, self.SAMPLES + 1) / (self.SAMPLES + 1.0)
+        for depth in range(self.max_depth + 1):
+            if not len(parents):
+                break
+            rows = blocks[parents]
+            fractions = numpy.column_stack((start, start[:, None] + (end - start)[:, None] * samples, end))
+            points = {}
+            for axis in AXES:
+                origin = rows[axis + '0'][:, None]
+                delta = rows[axis][:, None] - origin
+                points[axis] = origin + delta * fractions
+            surface = self.z_offset(points['x'], points['y'], points['z'])
+            chord = surface[:, :1] + (surface[:, -1:] - surface[:, :1]) * numpy.append(0, numpy.append(samples, 1))
+            error = numpy.abs(surface - chord).max(axis=1)
+            split = error > self.tolerance
+            if depth == self.max_depth:
+                split[:] = False
+            for n, values in enumerate((parents, start, end)):
+                done[n].append(values[~split])
+            middle = (start[split] + end[split]) / 2
+            parents = numpy.concatenate((parents[split], parents[split]))
+            start, end = numpy.concatenate((start[split], middle)), numpy.concatenate((middle, end[split]))
+        if not done[0]:
+            return blocks
+        parents, start, end = [numpy.concatenate(values) for values in done]
+        order = numpy.lexsort((start, parents))
+        return subdivide(blocks, parents[order], start[order], end[order])
+
+    def transform_chunk(self, blocks):
+        blocks = self.split_moves(TransformProcessor.transform_chunk(self, blocks))
+        arcs = is_arc(blocks)
+        if arcs.any():
+            code = getattr(self.output_set, str(blocks['code'][arcs][0]))
+            if 'z' not in code.valid_params:
+                raise GCodeException('Arc at line %s can not be compensated without Z support in %s' %
+                                     (blocks['line'][arcs][0], code.gcode))
+        for suffix in ('0', ''):
+            blocks['z' + suffix] += self.z_offset(blocks['x' + suffix], blocks['y' + suffix], blocks['z' + suffix])
+        return blocks
+
+
+class ArcLinearizer(TransformProcessor):
+    """
+        TransformProcessor that replaces the G2 and G3 arcs (G17, G18 and G19 planes and helical) by G1 chords, for
+        firmwares without arcs. The file is read with an instruction set with arcs and written with output_set
+        ej: ArcLinearizer(Printer3D(), file_obj, output_set=RepRapGCode()).
+        As the arcs are removed before the transform any AffineTransform can be used
+    """
+
+    def __init__(self, instruction_set, file_obj, tolerance=0.01, max_length=None, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet with G2 and G3 used for read the file
+            :param file_obj: File object with the codes
+            :param tolerance: Maximum distance in mm between the chords and the arcs
+            :param max_length: Maximum length in mm of the chords, None for no limit
+            :param kwargs: Parameters for TransformProcessor, ej: output_set
+        """
+        TransformProcessor.__init__(self, instruction_set, file_obj, **kwargs)
+        self.tolerance = tolerance
+        self.max_length = max_length
+
+    def process_line(self, line, raise_exception=False):
+        """
+            As TransformProcessor but an arc rejected by the instruction set raises GCodeException, dropping it would
+            lose the move
+        """
+        gcode = TransformProcessor.process_line(self, line, raise_exception=raise_exception)
+        if gcode is None:
+            code = self.raw_read(line).split(';', 1)[0].strip()
+            key = code.split(' ', 1)[0].upper()
+            if key in ('G2', 'G3'):
+                arc = self.instruction_set.code_supportered.get(key, None)
+                raise GCodeException('Arc at line %s can not be read: %s' % (
+                    self.line_number, arc.error if arc is not None and arc.error else code), gcode=key)
+        return gcode
+
+    def transform_chunk(self, blocks):
+        return TransformProcessor.transform_chunk(self, linearize_arcs(blocks, self.tolerance, self.max_length))
+
+
+class FeedrateOptimizer(TransformProcessor):
+    """
+        TransformProcessor that writes in each move the highest feed rate allowed by a MachineProfile: the feed of
+        each axis (max_feed, lowered by the M203 codes of the file), the centripetal acceleration (max_acceleration)
+        in the arcs and in the corners between linear moves, and the caps of each move type.
+        The moves without XYZ motion (retractions) keep their feed rate unless it is over the limit of E
+    """
+
+    def __init__(self, instruction_set, file_obj, profile, caps=None, codes=MOTION_CODES, feed_step=1.0, **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet used for clean and write the codes
+            :param file_obj: File object with the codes
+            :param profile: MachineProfile with max_feed (mm/min) and max_acceleration (mm/s^2) of the axes
+            :param caps: Dict {move type: mm/min} with the maximum feed rate of G0, G1, G2, G3 or 'extrude' (moves
+            with positive extrusion)
+            :param codes: Move codes whose feed rate is rewritten, ej: ('G1', 'G2', 'G3') for CNC rapids
+            :param feed_step: The feed rates are rounded down to multiples of feed_step mm/min
+            :param kwargs: Parameters for TransformProcessor
+        """
+        TransformProcessor.__init__(self, instruction_set, file_obj, **kwargs)
+        self.profile = profile
+        self.caps = caps or {}
+        self.move_codes = codes
+        self.feed_step = feed_step
+        self.max_feed = dict(profile.max_feed)
+        self._feed_changes = []
+
+    def on_start(self):
+        TransformProcessor.on_start(self)
+        self.max_feed = dict(self.profile.max_feed)
+        self._feed_changes = []
+
+    def callback_manager(self, gcode=None, **kwargs):
+        TransformProcessor.callback_manager(self, gcode=gcode, **kwargs)
+        if gcode == 'M203':
+            scale = 60.0 if self.mm else 60.0 / DistanceProcessor.INCH_2_MM
+            feeds = dict((axis, float(kwargs[axis]) * scale) for axis in AXES + ('e',) if kwargs.get(axis, None))
+            self._feed_changes.append((self.line_number, feeds))
+
+    def _axis_limits(self, blocks):
+        """
+            :return: Dict {axis: array} with the maximum feed rate of each axis in each block
+        """
+        limits = dict((axis, numpy.full(len(blocks), self.max_feed.get(axis, numpy.inf))) for axis in AXES + ('e',))
+        for line, feeds in self._feed_changes:
+            after = blocks['line'] > line
+            for axis, feed in feeds.items():
+                self.max_feed[axis] = min(self.profile.max_feed.get(axis, numpy.inf), feed)
+                limits[axis][after] = self.max_feed[axis]
+        self._feed_changes = []
+        return limits
+
+    def feed_limits(self, blocks):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :return: Array with the highest feed rate in mm/min of each block, infinite when nothing limits it
+        """
+        lengths = segment_lengths(blocks)
+        moving = lengths > 0
+        divisor = numpy.where(moving, lengths, 1)
+        arcs = is_arc(blocks)
+        axis_limits = self._axis_limits(blocks)
+        limit = numpy.full(len(blocks), numpy.inf)
+        acceleration = numpy.full(len(blocks), numpy.inf)
+        for axis in AXES + ('e',):
+            if axis == 'e':
+                delta = numpy.abs(blocks['de'])
+                share = numpy.where(moving, delta / divisor, delta > 0)
+            else:
+                share = numpy.abs(blocks[axis] - blocks[axis + '0']) / divisor
+                planes = [plane for plane in PLANE_AXES if axis in PLANE_AXES[plane][:2]]
+                share = numpy.where(arcs & numpy.isin(blocks['plane'], planes), 1.0, share)
+            with numpy.errstate(divide='ignore'):
+                limit = numpy.minimum(limit, axis_limits[axis] / share)
+                if axis in self.profile.max_acceleration:
+                    acceleration = numpy.minimum(acceleration, self.profile.max_acceleration[axis] / share)
+
+        if arcs.any():
+            radius = arc_geometry(blocks[arcs])['radius']
+            centripetal = numpy.where(radius > 0, numpy.sqrt(acceleration[arcs] * radius) * 60, numpy.inf)
+            limit[arcs] = numpy.minimum(limit[arcs], centripetal)
+
+        moves = numpy.flatnonzero(numpy.isin(blocks['code'], MOTION_CODES) & moving)
+        first, second = moves[:-1], moves[1:]
+        linear = ~arcs[first] & ~arcs[second]
+        first, second = first[linear], second[linear]
+        if len(first):
+            vectors = numpy.column_stack([blocks[axis] - blocks[axis + '0'] for axis in AXES]) / divisor[:, None]
+            cosine = numpy.clip((vectors[first] * vectors[second]).sum(axis=1), -1, 1)
+            angle = numpy.arccos(cosine)
+            with numpy.errstate(divide='ignore'):
+                radius = numpy.where(angle > 1e-9, (lengths[first] + lengths[second]) / (2 * angle), numpy.inf)
+            corner = numpy.sqrt(numpy.minimum(acceleration[first], acceleration[second]) * radius) * 60
+            for rows in (first, second):
+                numpy.minimum.at(limit, rows, corner)
+
+        for kind, cap in self.caps.items():
+            if kind == 'extrude':
+                mask = moving & (blocks['de'] > 0)
+            else:
+                mask = blocks['code'] == kind
+            limit[mask] = numpy.minimum(limit[mask], cap)
+        return limit
+
+    def transform_chunk(self, blocks):
+        blocks = TransformProcessor.transform_chunk(self, blocks)
+        limit = self.feed_limits(blocks)
+        if self.feed_step:
+            rounded = numpy.floor(limit / self.feed_step) * self.feed_step
+            limit = numpy.where(rounded > 0, rounded, limit)
+        rewrite = numpy.isin(blocks['code'], self.move_codes) & numpy.isfinite(limit) & (limit > 0)
+        still = segment_lengths(blocks) == 0
+        blocks['f'] = numpy.where(rewrite & ~still, limit, blocks['f'])
+        slower = rewrite & still & ~(blocks['f'] <= limit)
+        blocks['f'][slower] = limit[slower]
+        return blocks
+
+
+class RetractionOptimizer(TransformProcessor):
+    """
+        TransformProcessor for 3D printers that removes the retraction, Z hop and prime of the short travels: the
+        travels shorter than min_travel and, with island, the travels that end inside the XY bounding box of the
+        extrusions of the current island (printed since the last kept retraction in the same layer).
+        The pattern is a retraction (negative E without XYZ motion), moves without extrusion (G0 or G1 travels, Z
+        lifts and G92 E resets) and a prime (positive E without XYZ motion) that ends in the same Z. The extruder
+        positions after the prime are not changed, if the prime is longer than the retraction the difference is
+        still extruded so the net extrusion is kept
+    """
+
+    def __init__(self, instruction_set, file_obj, min_travel=2.0, island=True, max_travel=None, margin=0.0,
+                 **kwargs):
+        """
+            :param instruction_set: StandardInstructionSet used for clean and write the codes
+            :param file_obj: File object with the codes
+            :param min_travel: Travels shorter than it in mm (XY distance) are done without retraction
+            :param island: Boolean for remove the retraction of the travels inside the current island
+            :param max_travel: Maximum distance in mm of the travels inside an island, None for no limit
+            :param margin: Distance in mm added to the bounding box of the island
+            :param kwargs: Parameters for TransformProcessor
+        """
+        TransformProcessor.__init__(self, instruction_set, file_obj, **kwargs)
+        self.min_travel = min_travel
+        self.island = island
+        self.max_travel = max_travel
+        self.margin = margin
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.removed = 0
+        self.kept = 0
+        self.zhops = 0
+        self.retraction_time = 0.0
+        self._held = None
+        self._held_codes = {}
+        self._island = None
+        self._layer_z = numpy.nan
+
+    def on_start(self):
+        TransformProcessor.on_start(self)
+        self.reset_counters()
+
+    def _grow_island(self, blocks):
+        """
+            :param blocks: Array of BLOCK_DTYPE with the extrusions, the island starts again on a new layer
+        """
+        if not len(blocks):
+            return
+        z = numpy.concatenate(([self._layer_z], blocks['z']))
+        changes = numpy.flatnonzero(~(numpy.abs(numpy.diff(z)) <= 1e-6))
+        if len(changes):
+            blocks = blocks[changes[-1]:]
+            self._island = None
+            self._layer_z = float(z[-1])
+        x = numpy.concatenate((blocks['x0'], blocks['x']))
+        y = numpy.concatenate((blocks['y0'], blocks['y']))
+        box = numpy.array([x.min(), y.min(), x.max(), y.max()])
+        if self._island is not None:
+            box[:2] = numpy.minimum(box[:2], self._island[:2])
+            box[2:] = numpy.maximum(box[2:], self._island[2:])
+        self._island = box
+
+    def removable(self, blocks, retract, prime):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :param retract: Index of the retraction
+            :param prime: Index of the prime
+            :return: Boolean, True if the travel between them can be done without retraction
+        """
+        if abs(blocks['z'][prime] - blocks['z0'][retract]) > 1e-6:
+            return False
+        x, y = blocks['x'][prime], blocks['y'][prime]
+        distance = numpy.hypot(x - blocks['x0'][retract], y - blocks['y0'][retract])
+        if distance <= self.min_travel:
+            return True
+        if not self.island or self._island is None:
+            return False
+        if self.max_travel is not None and distance > self.max_travel:
+            return False
+        min_x, min_y, max_x, max_y = self._island
+        margin = self.margin
+        return min_x - margin <= x <= max_x + margin and min_y - margin <= y <= max_y + margin
+
+    def _remove(self, blocks, keep, retract, prime):
+        amount = -blocks['de'][retract]
+        net = blocks['de'][retract] + blocks['de'][prime]
+        travel = slice(retract + 1, prime)
+        blocks['e'][travel] += amount
+        base = blocks['z0'][retract]
+        if (numpy.abs(blocks['z'][travel] - base) > 1e-6).any():
+            self.zhops += 1
+        moves = blocks[travel]
+        keep[travel] &= (moves['code'] == 'G92') | (moves['x'] != moves['x0']) | (moves['y'] != moves['y0'])
+        blocks['z0'][travel] = base
+        blocks['z'][travel] = base
+        keep[retract] = False
+        saved = [(amount, blocks['f'][retract]), (blocks['de'][prime] - abs(net), blocks['f'][prime])]
+        if abs(net) > 1e-9:
+            blocks['de'][prime] = net
+        else:
+            keep[prime] = False
+        for length, feed in saved:
+            if feed > 0:
+                self.retraction_time += length / feed
+        self.removed += 1
+
+    def optimize(self, blocks, final=False):
+        """
+            :param blocks: Array of BLOCK_DTYPE
+            :param final: Boolean, False if more blocks follow, an unfinished travel at the end is kept for them
+            :return: Array of BLOCK_DTYPE without the removed retractions
+        """
+        motion = numpy.isin(blocks['code'], MOTION_CODES)
+        moving = motion & (segment_lengths(blocks) > 0)
+        still = motion & ~moving
+        xyz_words = numpy.uint16(WORD_MASK['x'] | WORD_MASK['y'] | WORD_MASK['z'])
+        travel = (motion & (blocks['de'] == 0)) | ((blocks['code'] == 'G92') & ((blocks['words'] & xyz_words) == 0))
+        primes = still & (blocks['de'] > 0)
+        extruding = moving & (blocks['de'] > 0)
+        keep = numpy.ones(len(blocks), dtype=bool)
+        size = len(blocks)
+        cursor = 0
+        for retract in numpy.flatnonzero(still & (blocks['de'] < 0)):
+            if retract < cursor:
+                continue
+            self._grow_island(blocks[cursor:retract][extruding[cursor:retract]])
+            prime = retract + 1
+            while prime < size and travel[prime]:
+                prime += 1
+            if prime == size and not final:
+                self._held = blocks[retract:]
+                self._held_codes = dict((line, self.codes[line]) for line in self._held['line'].tolist()
+                                        if line in self.codes)
+                return blocks[:retract][keep[:retract]]
+            cursor = prime
+            if prime < size and primes[prime] and self.removable(blocks, retract, prime):
+                self._remove(blocks, keep, retract, prime)
+            else:
+                self.kept += 1
+                self._island = None
+        self._grow_island(blocks[cursor:][extruding[cursor:]])
+        return blocks[keep]
+
+    def transform_chunk(self, blocks):
+        blocks = TransformProcessor.transform_chunk(self, blocks)
+        if self._held is not None:
+            blocks = numpy.concatenate((self._held, blocks))
+            self.codes.update(self._held_codes)
+            self._held = None
+        return self.optimize(blocks)
+
+    def process(self, raise_exception=False):
+        for code in TransformProcessor.process(self, raise_exception=raise_exception):
+            yield code
+        if self._held is not None:
+            blocks, self._held = self._held, None
+            self.codes.update(self._held_codes)
+            for block in self.optimize(blocks, final=True):
+                code = self.emit_block(block)
+                if code is not None:
+                    yield "%s\r\n" % code
+            self.codes = {}
+
+    def report(self, raise_exception=False):
+        """
+            :param raise_exception: Boolean for raise GCodeException on not supported codes
+            :return: Dict of TransformProcessor.report (moves time of SpeedProcessor) with removed, kept and zhops
+            (number of retractions) and retraction_saved (timedelta of the removed extruder moves) and total_saved
+        """
+        result = TransformProcessor.report(self, raise_exception=raise_exception)
+        retraction = timedelta(minutes=self.retraction_time)
+        result.update({
+            'removed': self.removed,
+            'kept': self.kept,
+            'zhops': self.zhops,
+            'retraction_saved': retraction,
+            'total_saved': result['saved'] + retraction,
+        })
+        return result